@@ -1,15 +1,17 @@
-import asyncio
+import openai
 from loguru import logger as log
 import uuid
-from collections.abc import Callable
+from collections.abc import AsyncIterator, Callable, Iterator
 from lolapy_lite_agent.agents.lola import LolaAgent
+from lolapy_lite_agent.background_loop import BackgroundLoop, background_loop
 from lolapy_lite_agent.chat_lead import ChatLead
 from lolapy_lite_agent.client_command import ClientCommand, parse_client_command
 from lolapy_lite_agent.nlp_job import AgentJob
+from lolapy_lite_agent.stream_coalescer import FlushPolicy
 
 # on_function_call is a callable that will be called when a function call is detected
 # has 3 arguments: lead, function_name, function_arguments
-# and should return a response string
+# and should return a response string, or an awaitable resolving to it
 
 class AgentController:
     def __init__(self, 
@@ -20,7 +22,13 @@ class AgentController:
                  on_function_call: Callable[[ChatLead, str, str], str] = None,
                  on_update_state: callable = None,
                  redis_url: str = None,
-                 init_state: dict = None):
+                 init_state: dict = None,
+                 loop: BackgroundLoop = None,
+                 flush_policy: FlushPolicy = None,
+                 sentences=False,
+                 tools=False,
+                 base_url: str = None,
+                 client: openai.AsyncOpenAI = None):
         # prompt
         self.prompt = prompt
         self.user_id = user_id
@@ -30,6 +38,12 @@ class AgentController:
         self.init_state = init_state
         self.on_update_state = on_update_state
         self.processing = False
+        # TokenSplit of the last request sent for the last message
+        self.tokens = None
+        # rtc consumers feed speech synthesis, they can get whole sentences (see LolaAgent.process)
+        self.sentences = sentences
+        # loop driving the sync wrappers, the async methods run on the caller's loop
+        self._loop = loop or background_loop
 
         # ChatLead
         self.lead = ChatLead(user_id, "rtc", "tenant1", "assistant1")
@@ -40,45 +54,58 @@ class AgentController:
                         on_text_received=self.on_text_received,
                         on_function_call=self.on_function_call,
                         redis_url=redis_url,
+                        flush_policy=flush_policy,
+                        tools=tools,
+                        base_url=base_url,
+                        client=client,
                     )
 
 
 
     def process_message(self, message: str):
+        """Sync wrapper of aprocess_message, blocks the calling thread while the message runs on the background loop.
+
+        The callbacks don't run on the calling thread: on_text_received and on_update_state run on the loop's thread,
+        a sync on_function_call on a worker thread of the loop (an async one on the loop), see call_function.
+        Callbacks touching state of the calling thread (e.g. a UI toolkit) must hand the work back to it.
+        """
+        return self._loop.run(self.aprocess_message(message))
+
+    def stream_message(self, message: str) -> Iterator[str]:
+        """Sync wrapper of astream_message, each piece of text is produced on the background loop.
+        The callbacks run on the same threads as with process_message"""
+        return self._loop.iterate(self.astream_message(message))
+
+    async def aprocess_message(self, message: str):
+        """Processes a user message on the caller's loop and returns the whole response, None for a client command
+        or an empty answer. The response is the text of every completion of the turn: the answer after the function
+        calls and, in the rare case the model writes text before calling a function, that text too (the controller
+        used to return only the completion after the call)"""
+        content = ""
+        async for text in self.astream_message(message):
+            content += text
+        return content or None
+
+    async def astream_message(self, message: str) -> AsyncIterator[str]:
+        """Processes a user message on the caller's loop, yielding the response text as it streams.
+        Function calls are answered with on_function_call (sync or async) until the model answers with text,
+        see LolaAgent.respond."""
         cmd = parse_client_command(message)
 
         if cmd:
-            self.process_client_command(cmd)
+            await self.aprocess_client_command(cmd)
             return
 
         job = self.create_user_message_agent_job(message)
 
         self._update_processing_state(True)
-        # process job
-        res = asyncio.run(self.agent.process_results_coro(self.agent.process(job)))
-        content = res.get("content")
-        function_call = res.get("function_call")
-
-        if function_call:
-            # process function call
-            self.agent.add_function_call_message(self.lead, function_call)
-            # TODO: process function call
-            if self.on_function_call:
-                function_response = self.on_function_call(self.lead, function_call.get("name"), function_call.get("arguments"))
-                self.agent.add_function_response_message(self.lead, function_call, function_response)
-
-            # remove message from job, so that the agent can process the function call
-            job.message = None
-            # reprocess job
-            res = asyncio.run(self.agent.process_results_coro(self.agent.process(job)))
-
-            content = res.get("content")
-            function_call = res.get("function_call")
-        
-        self._update_processing_state(False)
-        return content
-
-
+        try:
+            async for res in self.agent.respond(job, self.on_function_call, sentences=self.sentences):
+                if res.get("content"):
+                    yield res["content"]
+        finally:
+            self.tokens = job.tokens
+            self._update_processing_state(False)
 
     def create_user_message_agent_job(self, message: str):
         # generate job_id using uuid short
@@ -94,22 +121,25 @@ class AgentController:
     
 
     def process_client_command(self, cmd: ClientCommand):
-        
+        return self._loop.run(self.aprocess_client_command(cmd))
+
+    async def aprocess_client_command(self, cmd: ClientCommand):
+
         # process client command
         if cmd.command == "/reset":
             if cmd.args == ["all"]:
-                self.agent.clear_history(self.lead)
-                self.agent.clear_state(self.lead)
+                await self.agent.aclear_history(self.lead)
+                await self.agent.aclear_state(self.lead)
                 log.warning("Resetting all")
             else:
-                self.agent.clear_history(self.lead)
+                await self.agent.aclear_history(self.lead)
                 log.warning("Resetting history")
 
         elif cmd.command == "/state":
-            if cmd.args == ["set"]:
+            if cmd.args[:1] == ["set"] and len(cmd.args) >= 3:
                 key = cmd.args[1]
                 value = cmd.args[2]
-                self.agent._stateStore.set_key_value(self.lead, key, value)
+                await self.agent.aset_state_value(self.lead, key, value)
                 log.warning(f"Setting state: {key}={value}")
         else:
             log.warning(f"Unknown command: {cmd.command}")
@@ -0,0 +1,189 @@
+import time
+import uuid
+from collections.abc import AsyncIterator, Callable
+import openai
+from loguru import logger as log
+from lolapy_lite_agent.agents.lola import LolaAgent
+from lolapy_lite_agent.chat_lead import ChatLead
+from lolapy_lite_agent.history.history_buffer import WRITE_THROUGH
+from lolapy_lite_agent.nlp_job import AgentJob
+from lolapy_lite_agent.stream_coalescer import FlushPolicy
+from lolapy_lite_agent.stream_session import StreamSession
+from lolapy_lite_agent.tool_calls import DEFAULT_TOOL_TIMEOUT
+
+# idle leads are dropped from the table after this many seconds
+DEFAULT_IDLE_TIMEOUT = 3600
+PRUNE_EVERY = 1024
+
+
+class _LeadSlot:
+    """Row of the lead table, all a lead costs the runtime while idle"""
+    __slots__ = ('streaming', 'last_active')
+
+    def __init__(self):
+        # session streaming to the lead
+        self.streaming = None
+        self.last_active = 0.0
+
+
+class AgentRuntime:
+    """Serves many leads concurrently with a single LolaAgent.
+
+    The agent, its Redis pools and its OpenAI client are shared by every lead, each response stream
+    gets its own StreamSession. A lead is a slot in a table keyed by its token holding the session streaming to it,
+    so an idle lead costs a few hundred bytes instead of an agent with its own clients.
+
+    A new message for a lead interrupts the response still streaming to it and waits for it to end,
+    so the history of the lead keeps its order.
+    """
+
+    def __init__(self,
+                 api_key,
+                 default_model=None,
+                 redis_url=None,
+                 on_function_call: Callable[[ChatLead, str, str], str] = None,
+                 base_url=None,
+                 client: openai.AsyncOpenAI = None,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 flush_policy: FlushPolicy = None,
+                 tools=False,
+                 tool_timeout=DEFAULT_TOOL_TIMEOUT,
+                 history_durability=WRITE_THROUGH,
+                 raw_history=False):
+        """
+        Args:
+            on_function_call: called with lead, function name and arguments, returns the function response
+                or an awaitable resolving to it
+            flush_policy: how response deltas are batched before they are delivered, see FlushPolicy
+            tools: use the tools API, the calls of a response are answered concurrently
+            tool_timeout: seconds each function call may take
+            history_durability: when the messages of a turn reach Redis, see HistoryBuffer, call aclose on shutdown
+            raw_history: splice the stored history entries into the request body, see LolaAgent
+        """
+        self.agent = LolaAgent(api_key,
+                               default_model=default_model,
+                               redis_url=redis_url,
+                               base_url=base_url,
+                               client=client,
+                               flush_policy=flush_policy,
+                               tools=tools,
+                               history_durability=history_durability,
+                               raw_history=raw_history)
+        self.on_function_call = on_function_call
+        self.tool_timeout = tool_timeout
+        self.idle_timeout = idle_timeout
+        self._leads = {}
+        self._opened = 0
+
+    def _slot(self, lead: ChatLead) -> _LeadSlot:
+        slot = self._leads.get(lead.get_token())
+        if slot is None:
+            slot = self._leads[lead.get_token()] = _LeadSlot()
+        slot.last_active = time.monotonic()
+        return slot
+
+    def session(self, lead: ChatLead) -> StreamSession:
+        """The session streaming to lead, None when idle"""
+        slot = self._leads.get(lead.get_token())
+        return slot.streaming if slot is not None else None
+
+    def interrupt(self, lead: ChatLead):
+        session = self.session(lead)
+        if session:
+            session.interrupt()
+
+    def cancel(self, lead: ChatLead):
+        session = self.session(lead)
+        if session:
+            session.cancel()
+
+    def open_session(self, lead: ChatLead, on_text_received: callable = None) -> StreamSession:
+        """New session for the next message of lead, the response streaming to it (if any) is interrupted"""
+        slot = self._slot(lead)
+        if slot.streaming is not None:
+            slot.streaming.interrupt()
+
+        self._opened += 1
+        if self._opened % PRUNE_EVERY == 0:
+            self.prune()
+        return StreamSession(lead, on_text_received)
+
+    async def stream_message(self,
+                             lead: ChatLead,
+                             prompt: str,
+                             message: str,
+                             init_state: dict = None,
+                             new_state: dict = None,
+                             on_text_received: callable = None,
+                             session: StreamSession = None,
+                             sentences=False) -> AsyncIterator[str]:
+        """Streams the response to message. Pass a session from open_session to keep a handle on the stream,
+        otherwise one is opened here and can be reached with session(lead).
+        With sentences the response comes in whole sentences, see LolaAgent.process."""
+        if session is None:
+            session = self.open_session(lead, on_text_received)
+        slot = self._slot(lead)
+        # one stream per lead at a time, the previous one was interrupted by open_session
+        while slot.streaming is not None:
+            await slot.streaming.wait()
+        if session.cancelled or session.interrupted:
+            return
+        slot.streaming = session
+
+        session.started()
+        try:
+            job = AgentJob(str(uuid.uuid4())[:8], lead, message, prompt=prompt, init_state=init_state, new_state=new_state)
+            async for res in self.agent.respond(job, self.on_function_call, session=session, sentences=sentences,
+                                                tool_timeout=self.tool_timeout):
+                if res.get("content"):
+                    yield res["content"]
+        finally:
+            session.finished()
+            slot.streaming = None
+            slot.last_active = time.monotonic()
+
+    async def process_message(self, lead: ChatLead, prompt: str, message: str, **kwargs) -> str:
+        """Same as stream_message, returns the whole response"""
+        content = ""
+        async for text in self.stream_message(lead, prompt, message, **kwargs):
+            content += text
+        return content or None
+
+    async def aclose(self):
+        """Writes the history still buffered, call it before the event loop ends"""
+        await self.agent.aclose()
+
+    def prune(self, idle_timeout=None):
+        """Drops the leads idle for more than idle_timeout seconds"""
+        limit = time.monotonic() - (self.idle_timeout if idle_timeout is None else idle_timeout)
+        idle = [token for token, slot in self._leads.items() if slot.last_active < limit and slot.streaming is None]
+        for token in idle:
+            del self._leads[token]
+        if idle:
+            log.debug(f"AgentRuntime pruned {len(idle)} idle leads")
+
+    def stats(self):
+        return {
+            'leads': len(self._leads),
+            'streaming': sum(1 for slot in self._leads.values() if slot.streaming is not None),
+        }
+
+
+if __name__ == "__main__":
+    import sys
+    import tracemalloc
+
+    # memory per idle lead: a slot in the table
+    runtime = AgentRuntime.__new__(AgentRuntime)
+    runtime._leads = {}
+    runtime._opened = 0
+    runtime.idle_timeout = DEFAULT_IDLE_TIMEOUT
+    leads = [ChatLead(str(i), "test", "tenant", "assistant") for i in range(10000)]
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for lead in leads:
+        runtime.open_session(lead)
+    after = tracemalloc.take_snapshot()
+    size = sum(s.size_diff for s in after.compare_to(before, 'filename'))
+    print(f"{size / len(leads):.0f} bytes per idle lead (slot {sys.getsizeof(_LeadSlot())} bytes), a streaming session adds {sys.getsizeof(StreamSession())} bytes")
@@ -7,17 +7,36 @@ from typing import AsyncIterable
 import openai
 from lolapy_lite_agent.agents.utils import create_assistant_message, create_function_call_message, create_function_response_message, create_prompt_message, create_user_message
 from lolapy_lite_agent.chat_lead import ChatLead
+from lolapy_lite_agent.chat_request import create_chat_stream, decode_messages
+from lolapy_lite_agent.conversation_snapshot import ConversationSnapshot, load_conversation_snapshot
+from lolapy_lite_agent.history.history_append import DEFAULT_MAX_LENGTH as DEFAULT_HISTORY_MAX_LENGTH
+from lolapy_lite_agent.history.history_buffer import TURN, WRITE_THROUGH, HistoryBuffer
+from lolapy_lite_agent.history.history_redis_async_provider import AsyncRedisHistoryProvider
 from lolapy_lite_agent.history.history_redis_provider import RedisHistoryProvider
+from lolapy_lite_agent.history.history_summarizer import HistorySummarizer, create_summary_message, summary_enabled
 from lolapy_lite_agent.nlp_job import AgentJob
+from lolapy_lite_agent.openai_clients import openai_clients
 from lolapy_lite_agent.prompt_compiler import PromptCompiled, PromptCompiler
+from lolapy_lite_agent.serialization import Codec
+from lolapy_lite_agent.state.state_redis_async_provider import AsyncRedisChatStateProvider
 from lolapy_lite_agent.state.state_redis_provider import RedisChatStateProvider
+from lolapy_lite_agent.sentence_splitter import SentenceSplitter
+from lolapy_lite_agent.stream_coalescer import PER_CHUNK, FlushPolicy, TextCoalescer
+from lolapy_lite_agent.stream_session import StreamSession
+from lolapy_lite_agent.turn_context import TurnContext
+from lolapy_lite_agent.tool_calls import DEFAULT_MAX_TOOL_ROUNDS, DEFAULT_TOOL_TIMEOUT, FunctionHandler, run_function_call, run_tool_calls
+from lolapy_lite_agent.token_counter import MESSAGE_OVERHEAD, TokenSplit, count_functions_tokens, count_message_tokens, count_tokens, load_encoding, orphan_responses, select_history_window
 import logging
 from loguru import logger as log
 
 DEFAULT_MODEL = "gpt-4-1106-preview"
 DEFAULT_MAX_TOKENS = 1500
 DEFAULT_MAX_HISTORY = 10
+# messages read from the history when the window is selected by tokens (max_history_tokens setting)
+DEFAULT_MAX_BUDGET_HISTORY = 100
 TIMEOUT_ERROR_MESSAGE = "Sorry, I'm taking too long to respond. Please try again later."
+# seconds to wait for the completion to start, TIMEOUT_ERROR_MESSAGE is the response after that
+REQUEST_TIMEOUT = 10
 
 class LolaAgent:
 
@@ -26,30 +45,206 @@ class LolaAgent:
                  default_model=None,
                  redis_url=None,
                  on_text_received: callable = None,
-                 on_function_call: callable = None):
-        self._stateStore = RedisChatStateProvider(redis_url=redis_url)
-        self._historyStore = RedisHistoryProvider(redis_url=redis_url)
+                 on_function_call: callable = None,
+                 base_url=None,
+                 client: openai.AsyncOpenAI = None,
+                 flush_policy: FlushPolicy = None,
+                 tools=False,
+                 history_max_length=DEFAULT_HISTORY_MAX_LENGTH,
+                 history_durability=WRITE_THROUGH,
+                 codec: Codec = None,
+                 raw_history=False):
+        """
+        Args:
+            base_url: OpenAI compatible endpoint, the default OpenAI API when None
+            client: AsyncOpenAI client to use instead of the shared one from openai_clients
+            flush_policy: how response deltas are batched before on_text_received and the stream consumer
+                get them, every delta on its own when None
+            tools: send the functions with the tools API, the model can then call several of them in one
+                response (see respond). The legacy functions API, one call per response, when False
+            history_max_length: messages kept in the history of a lead, the oldest are dropped on append,
+                every message is kept when None
+            history_durability: when the messages of a turn reach Redis, see HistoryBuffer. With TURN or BACKGROUND
+                they are written behind the response instead of before the prompt is compiled and after the reply,
+                call aclose before the event loop ends
+            codec: how history entries and state values are stored in Redis, JSON when None. Any codec reads
+                what the others wrote
+            raw_history: history entries stored as JSON go into the request body as they are read from Redis,
+                without decoding them into dicts for the client to encode again. They are decoded when the
+                prompt template reads the history or the window is selected by tokens
+        """
+        self._stateStore = RedisChatStateProvider(redis_url=redis_url, codec=codec)
+        self._historyStore = RedisHistoryProvider(redis_url=redis_url, max_length=history_max_length, codec=codec)
+        # async providers are used by the streaming path (process/request_stream)
+        # so Redis round trips never block the event loop
+        self._asyncStateStore = AsyncRedisChatStateProvider(redis_url=redis_url, codec=codec)
+        self._asyncHistoryStore = AsyncRedisHistoryProvider(redis_url=redis_url, max_length=history_max_length, codec=codec)
         self._api_key = api_key
         self._default_model = default_model or DEFAULT_MODEL
-        self._client = openai.AsyncOpenAI(api_key=self._api_key)
-        self._producing_response = False
-        self._needs_interrupt = False
+        self._base_url = base_url
+        self._own_client = client
         self._on_text_received = on_text_received
         self._on_function_call = on_function_call
-
-    async def process(self, job: AgentJob):
-        # impact message history
-        if job.message:
-            self.add_user_message(job.lead, job.message)
-
-        # compile prompt
-        prompt_compiler = PromptCompiler(job, job.prompt, self._historyStore, self._stateStore) 
-        ctx = prompt_compiler.process(init_state=job.init_state, new_state=job.new_state)
+        self._flush_policy = flush_policy or PER_CHUNK
+        self._tools = tools
+        self._raw_history = raw_history
+        # turns answering function calls by lead token, see invalidate_turn
+        self._turns = {}
+        # every async history write goes through it, so buffered and direct writes keep their order
+        self._historyBuffer = HistoryBuffer(self._asyncHistoryStore, history_durability)
+        # folds the messages falling out of the window into a summary, after the turn (summarize_history setting)
+        self._summarizer = HistorySummarizer(self._asyncHistoryStore, lambda: self._client, self._default_model,
+                                             buffer=self._historyBuffer)
+
+    @property
+    def _client(self) -> openai.AsyncOpenAI:
+        # agents with the same credentials share one client and its connection pool
+        if self._own_client is not None:
+            return self._own_client
+        return openai_clients.get(self._api_key, self._base_url)
+
+    async def wait_summaries(self):
+        """Waits for the history summaries being updated in the background"""
+        await self._summarizer.wait()
+
+    async def flush_history(self, lead: ChatLead = None):
+        """Waits until the buffered messages of lead (of every lead when None) are in Redis"""
+        await self._historyBuffer.flush(lead)
+
+    async def aclose(self):
+        """Writes the buffered history, call it on shutdown"""
+        await self._historyBuffer.close()
+
+    async def warm_up(self, connections=1):
+        """Opens connections to the OpenAI API and loads the tokenizer ahead of the first message, call it at startup"""
+        await load_encoding()
+        if self._own_client is None:
+            await openai_clients.warm_up(self._api_key, self._base_url, connections)
+
+    async def process(self, job: AgentJob, session: StreamSession = None, sentences=False, turn: TurnContext = None):
+        """Streams the response to job, pass a session to interrupt or cancel it.
+
+        Args:
+            sentences: stream whole sentences (or clauses of long ones) instead of deltas, for speech synthesis.
+                True, or the language of the abbreviations to know ("en", "es")
+            turn: context of the previous completion of the turn, its compiled prompt is reused when still valid
+        """
+        turn = turn or TurnContext(job)
+        await self._prepare_turn(turn)
 
         # request stream
-        async for text in self.request_stream(job, ctx):
+        async for text in self.request_stream(job, turn.compiled, snapshot=turn.snapshot, session=session, sentences=sentences):
             yield text     
 
+    async def _prepare_turn(self, turn: TurnContext):
+        if turn.reusable:
+            return
+        # the first load of the tokenizer may download it, not on the loop
+        await load_encoding()
+        job = turn.job
+        if turn.compiler is None:
+            turn.compiler = PromptCompiler(job, job.prompt, self._asyncHistoryStore, self._asyncStateStore)
+
+        if not turn.loaded:
+            artifact = turn.compiler.artifact
+            message = create_user_message(job.message) if job.message else None
+            # messages are counted for a max_history_tokens budget, settings depending on the context aren't known yet
+            tokens = not artifact.is_static or bool(artifact.settings.get("max_history_tokens"))
+            buffer = self._historyBuffer
+            if buffer.enabled and message:
+                # written behind the read, the snapshot gets it from the buffer
+                await buffer.append(job.lead, [message], tokens)
+                message = None
+            async with buffer.reading(job.lead) as pending:
+                # impact message history
+                # and read back the history + state the turn needs, all in one round trip
+                turn.snapshot = await load_conversation_snapshot(
+                    self._asyncHistoryStore,
+                    self._asyncStateStore,
+                    job.lead,
+                    append=message,
+                    dependencies=artifact.dependencies,
+                    history_count=self._history_window(artifact),
+                    summary=not artifact.is_static or summary_enabled(artifact.settings),
+                    pending=pending,
+                    raw=self._raw_history,
+                    tokens=tokens,
+                )
+            turn.stale = False
+
+        # compile prompt
+        turn.compiled = await turn.compiler.process_async(init_state=job.init_state, new_state=job.new_state, snapshot=turn.snapshot)
+        turn.compiles += 1
+
+    def invalidate_turn(self, lead: ChatLead):
+        """Call it when a function handler writes the state of lead by other means than the agent's setters,
+        the completion answering the function reads the state again instead of reusing the compiled prompt"""
+        turn = self._turns.get(lead.get_token())
+        if turn is not None:
+            turn.invalidate()
+
+    async def respond(self,
+                      job: AgentJob,
+                      on_function_call: FunctionHandler = None,
+                      session: StreamSession = None,
+                      sentences=False,
+                      max_rounds=DEFAULT_MAX_TOOL_ROUNDS,
+                      tool_timeout=DEFAULT_TOOL_TIMEOUT):
+        """Streams the response to job like process, answering the functions the model calls.
+
+        The calls of a response run concurrently with on_function_call (see run_tool_calls), each limited to
+        tool_timeout seconds, their results are appended to the history in one write and the job runs again,
+        until the model answers with text or max_rounds rounds of calls were answered.
+        The completions after the first reuse the compiled prompt of the turn, see TurnContext.
+        The token split of the last completion is on job.tokens (and on session.tokens).
+        """
+        session = session or StreamSession(job.lead)
+        owner = not session.active
+        if owner:
+            session.started()
+        turn = self._turns[job.lead.get_token()] = TurnContext(job)
+        try:
+            for rounds_done in range(max_rounds + 1):
+                entries = None
+                async for res in self.process(job, session=session, sentences=sentences, turn=turn):
+                    if not res.get("tool_calls") and not res.get("function_call"):
+                        yield res
+                    elif rounds_done == max_rounds:
+                        # the handler doesn't run for calls whose results would never be sent
+                        log.warning(f"{job.lead.get_token()} still calling functions after {max_rounds} rounds")
+                    elif res.get("tool_calls"):
+                        entries = await run_tool_calls(on_function_call, job.lead, res["tool_calls"], tool_timeout)
+                    else:
+                        entries = await run_function_call(on_function_call, job.lead, res["function_call"], tool_timeout)
+
+                if not entries or session.interrupted:
+                    break
+                turn.append(await self._historyBuffer.append(job.lead, entries, turn.counts_tokens))
+                # run the job again without the message, so that the agent answers with the function results
+                job.message = None
+            if turn.compiles > 1:
+                log.debug(f"Prompt compiled {turn.compiles} times in the turn of {job.lead.get_token()}")
+            if self._historyBuffer.durability == TURN:
+                # the consumer has the whole response already
+                await self._historyBuffer.flush(job.lead)
+        finally:
+            if self._turns.get(job.lead.get_token()) is turn:
+                del self._turns[job.lead.get_token()]
+            if owner:
+                session.finished()
+
+    def _history_window(self, artifact):
+        # when the prompt doesn't read the history only the last max_history_length messages are sent,
+        # the setting is known before compiling when the settings don't depend on the context
+        if artifact.dependencies.history or not artifact.is_static:
+            return None
+        settings = artifact.settings
+        default = DEFAULT_MAX_BUDGET_HISTORY if settings.get("max_history_tokens") else DEFAULT_MAX_HISTORY
+        try:
+            return int(settings.get("max_history_length", default))
+        except ValueError:
+            return None
+
     def is_first_message(self, lead: ChatLead):
         res = self._historyStore.get_history(lead)
         return len(res) == 0
@@ -59,15 +254,18 @@ class LolaAgent:
 
     def clear_state(self, lead: ChatLead):
         self._stateStore.clear_store(lead)
+        self.invalidate_turn(lead)
 
     def set_state(self, lead: ChatLead, state: dict):
         self._stateStore.set_store(lead, state)
+        self.invalidate_turn(lead)
 
     def get_state(self, lead: ChatLead):
         return self._stateStore.get_store(lead)
     
     def set_state_value(self, lead: ChatLead, key: str, value):
         state = self._stateStore.set_key_value(lead, key, value)
+        self.invalidate_turn(lead)
         return state
 
 
@@ -87,10 +285,55 @@ class LolaAgent:
         msg = create_function_response_message(function_call.get("name"), response)
         self._historyStore.append_to_history(lead, msg)
 
+    # async counterparts, safe to call from inside the event loop
+
+    async def ais_first_message(self, lead: ChatLead):
+        async with self._historyBuffer.reading(lead) as pending:
+            res = await self._asyncHistoryStore.get_last_messages(lead, 1)
+        return len(res) == 0 and not pending
+
+    async def aclear_history(self, lead: ChatLead):
+        await self._historyBuffer.discard(lead)
+        await self._asyncHistoryStore.clear_history(lead)
+
+    async def aclear_state(self, lead: ChatLead):
+        await self._asyncStateStore.clear_store(lead)
+        self.invalidate_turn(lead)
+
+    async def aset_state(self, lead: ChatLead, state: dict):
+        await self._asyncStateStore.set_store(lead, state)
+        self.invalidate_turn(lead)
+
+    async def aget_state(self, lead: ChatLead):
+        return await self._asyncStateStore.get_store(lead)
+
+    async def aset_state_value(self, lead: ChatLead, key: str, value):
+        state = await self._asyncStateStore.set_key_value(lead, key, value)
+        self.invalidate_turn(lead)
+        return state
+
+    async def aadd_user_message(self, lead: ChatLead, message: str):
+        msg = create_user_message(message)
+        await self._historyBuffer.append(lead, [msg])
+
+    async def aadd_assistant_message(self, lead: ChatLead, message: str, tokens=True):
+        msg = create_assistant_message(message)
+        await self._historyBuffer.append(lead, [msg], tokens)
+
+    async def aadd_function_call_message(self, lead: ChatLead, function_call: dict):
+        msg = create_function_call_message(function_call.get("name"), function_call.get("arguments"))
+        await self._historyBuffer.append(lead, [msg])
+
+    async def aadd_function_response_message(self, lead: ChatLead, function_call: dict, response: str):
+        msg = create_function_response_message(function_call.get("name"), response)
+        await self._historyBuffer.append(lead, [msg])
+
 
     async def blend_message_into_context(self, lead: ChatLead, message: str, history_length=3, max_tokens=None, model=None):
 
-        chat_messages = self._historyStore.get_last_messages(lead, history_length)
+        async with self._historyBuffer.reading(lead) as pending:
+            chat_messages = await self._asyncHistoryStore.get_last_messages(lead, history_length)
+        chat_messages = (chat_messages + pending)[-history_length:]
 
         dialog = ""
         for msg in chat_messages:
@@ -109,10 +352,10 @@ class LolaAgent:
                     model=model or self._default_model,
                     n=1,
                     stream=False,
-                    messages=chat_messages,
+                    messages=decode_messages(chat_messages),
                     max_tokens=int(max_tokens or DEFAULT_MAX_TOKENS)
                 ),
-                10,
+                REQUEST_TIMEOUT,
             )
 
             return chat.choices[0].message.content
@@ -121,22 +364,63 @@ class LolaAgent:
 
     
 
-    async def request_stream(self, job: AgentJob, ctx: PromptCompiled) -> AsyncIterable[dict]:
+    async def request_stream(self, job: AgentJob, ctx: PromptCompiled, snapshot: ConversationSnapshot = None, session: StreamSession = None, sentences=False) -> AsyncIterable[dict]:
+        # each stream has its own session, concurrent streams of the agent don't share interrupt flags
+        session = session or StreamSession(job.lead)
+        on_text_received = session.on_text_received or self._on_text_received
 
         # get model from settings
         model = ctx.get("settings", {}).get("model", self._default_model)
         max_tokens = ctx.get("settings", {}).get("max_tokens", DEFAULT_MAX_TOKENS)
         max_history =  int(ctx.get("settings", {}).get("max_history_length", DEFAULT_MAX_HISTORY))
+        max_history_tokens = ctx.get("settings", {}).get("max_history_tokens")
 
 
         chat_messages = []
         chat_messages.append(create_prompt_message(
             content=ctx.get("prompt", "")
         ))
-
+        tokens = TokenSplit(
+            prompt=MESSAGE_OVERHEAD + count_tokens(ctx.get("prompt", "")),
+            functions=count_functions_tokens(ctx.get("functions", [])),
+        )
+
+        if snapshot is None:
+            # the history is read from Redis below, it must have the buffered messages
+            await self._historyBuffer.flush(job.lead)
+        if max_history_tokens:
+            # newest messages fitting in the budget, max_history_length still caps them when set
+            budget = int(max_history_tokens)
+            cap = max_history if "max_history_length" in ctx.get("settings", {}) else None
+            if snapshot:
+                history_messages, tokens.history = snapshot.window(budget, cap)
+            else:
+                entries, counts = await self._asyncHistoryStore.get_last_messages_with_tokens(job.lead, cap or DEFAULT_MAX_BUDGET_HISTORY)
+                start = select_history_window(entries, counts, budget, cap)
+                history_messages, tokens.history = entries[start:], sum(counts[start:])
         # get history messages up to max_history
-        
-        history_messages = self._historyStore.get_last_messages(job.lead, max_history)
+        # their tokens are the stored counts, the messages written without one are counted
+        elif snapshot:
+            history_messages = snapshot.last_messages(max_history, raw=self._raw_history)
+            tokens.history = snapshot.last_tokens(len(history_messages))
+        else:
+            entries, counts = await self._asyncHistoryStore.get_last_messages_with_tokens(job.lead, max_history)
+            # a window starting inside a group of function calls would send responses without their call
+            start = orphan_responses(entries)
+            history_messages, tokens.history = entries[start:], sum(counts[start:])
+        tokens.history_messages = len(history_messages)
+
+        # summary of the messages before the window
+        summarize = summary_enabled(ctx.get("settings", {}))
+        if summarize:
+            summary = snapshot.summary if snapshot else await self._asyncHistoryStore.get_summary(job.lead)
+            if summary:
+                summary_message = create_summary_message(summary)
+                chat_messages.append(summary_message)
+                tokens.prompt += count_message_tokens(summary_message)
+        # on the job too, callers that don't pass a session read it there
+        job.tokens = session.tokens = tokens
+        log.debug(f"Tokens prompt: {tokens.prompt} functions: {tokens.functions} history: {tokens.history} ({tokens.history_messages} messages)")
 
         # append history messages to the chat messages
         for message in history_messages:
@@ -147,28 +431,43 @@ class LolaAgent:
         #     log.info(f"{idx} -> {message}")
             
 
+        functions = ctx.get("functions", [])
+        if not self._tools:
+            request = {"functions": functions}
+        elif functions:
+            request = {"tools": [{"type": "function", "function": f} for f in functions]}
+        else:
+            request = {}
+
         try:
             chat_stream = await asyncio.wait_for(
-                self._client.chat.completions.create(
+                create_chat_stream(
+                    self._client,
                     model=model,
                     n=1,
-                    stream=True,
                     messages=chat_messages,
                     max_tokens=int(max_tokens or DEFAULT_MAX_TOKENS),
-                    functions=ctx.get("functions", []),
+                    **request,
                 ),
-                10,
+                REQUEST_TIMEOUT,
             )
         except TimeoutError:
-            yield TIMEOUT_ERROR_MESSAGE
+            # same shape as the chunks of the response
+            yield {"content": TIMEOUT_ERROR_MESSAGE}
             return
 
-        self._producing_response = True
+        # the session may span several completions (function call follow-ups), it ends with the outermost one
+        owner = not session.active
+        if owner:
+            session.started()
+        session.producing = True
         complete_response = ""
         func_call = {
             "name": None,
             "arguments": "",
         }
+        # tools API: the calls of the response by index, their arguments stream interleaved
+        tool_calls = {}
 
         async def anext_util(aiter):
             async for item in aiter:
@@ -176,61 +475,126 @@ class LolaAgent:
 
             return None
 
-        while True:
-            try:
-                chunk = await asyncio.wait_for(anext_util(chat_stream), 5)
-            except TimeoutError:
-                break
-            except asyncio.CancelledError:
-                self._producing_response = False
-                self._needs_interrupt = False
-                break
-
-            if chunk is None:
-                break
-
-            content = None
-            delta = chunk.choices[0].delta
-            if delta.function_call:
-                if delta.function_call.name:
-                    func_call["name"] = delta.function_call.name
-                if delta.function_call.arguments:
-                    func_call["arguments"] += delta.function_call.arguments
-            if delta.content:
-                content = delta.content
+        splitter = SentenceSplitter(sentences if isinstance(sentences, str) else None) if sentences else None
+
+        def deliver(text, final=False):
+            # text released by the coalescer, cut into sentences in sentence mode
+            pieces = [text] if text else []
+            if splitter is not None:
+                pieces = splitter.push(text) if text else []
+                rest = splitter.flush() if final else None
+                if rest:
+                    pieces.append(rest)
+            for piece in pieces:
+                if on_text_received:
+                    on_text_received(piece)
+            return [{"content": piece} for piece in pieces]
+
+        loop = asyncio.get_running_loop()
+        coalescer = TextCoalescer(self._flush_policy)
+        next_chunk = None
 
-            if chunk.choices[0].finish_reason == "function_call":
-                # function call here using func_call
-                # print("Function call: ", func_call)
-                yield {
-                    "content": None,
-                    "function_call": func_call
-                }
-                break             
-
-            if self._needs_interrupt:
-                self._needs_interrupt = False
-                logging.info("ChatGPT interrupted")
-                break
-
-            if content is not None:
-                complete_response += content
-                if self._on_text_received:
-                    self._on_text_received(content)
-                yield {
-                    "content": content
-                }
-
-
-
-
-        if complete_response:
-            self.add_assistant_message(job.lead, complete_response)
-
-        self._producing_response = False        
+        try:
+            while True:
+                if next_chunk is None:
+                    next_chunk = asyncio.ensure_future(anext_util(chat_stream))
+                    deadline = loop.time() + 5
+                # wait for the next chunk, or until the buffered text is due
+                timeout = deadline - loop.time()
+                due = coalescer.due
+                if due is not None:
+                    timeout = min(timeout, due - loop.time())
+                try:
+                    chunk = await asyncio.wait_for(asyncio.shield(next_chunk), max(timeout, 0))
+                except TimeoutError:
+                    if loop.time() < deadline:
+                        for res in deliver(coalescer.flush()):
+                            yield res
+                        continue
+                    break
+                except asyncio.CancelledError:
+                    if session.cancelled:
+                        raise
+                    break
+                next_chunk = None
+
+                if chunk is None:
+                    break
+
+                content = None
+                delta = chunk.choices[0].delta
+                if delta.function_call:
+                    if delta.function_call.name:
+                        func_call["name"] = delta.function_call.name
+                    if delta.function_call.arguments:
+                        func_call["arguments"] += delta.function_call.arguments
+                if getattr(delta, "tool_calls", None):
+                    for tc in delta.tool_calls:
+                        call = tool_calls.get(tc.index)
+                        if call is None:
+                            call = tool_calls[tc.index] = {"id": None, "type": "function", "function": {"name": None, "arguments": ""}}
+                        if tc.id:
+                            call["id"] = tc.id
+                        if tc.function:
+                            if tc.function.name:
+                                call["function"]["name"] = tc.function.name
+                            if tc.function.arguments:
+                                call["function"]["arguments"] += tc.function.arguments
+                if delta.content:
+                    content = delta.content
+
+                if chunk.choices[0].finish_reason == "function_call":
+                    for res in deliver(coalescer.flush(), final=True):
+                        yield res
+                    # function call here using func_call
+                    # print("Function call: ", func_call)
+                    yield {
+                        "content": None,
+                        "function_call": func_call
+                    }
+                    break             
+
+                if chunk.choices[0].finish_reason == "tool_calls" and tool_calls:
+                    for res in deliver(coalescer.flush(), final=True):
+                        yield res
+                    yield {
+                        "content": None,
+                        "tool_calls": [tool_calls[index] for index in sorted(tool_calls)]
+                    }
+                    break
+
+                if session.interrupted:
+                    logging.info("ChatGPT interrupted")
+                    break
+
+                if content is not None:
+                    complete_response += content
+                    for res in deliver(coalescer.push(content, loop.time())):
+                        yield res
+
+            # the rest of the buffered text, on interrupt or timeout too: it is part of complete_response
+            for res in deliver(coalescer.flush(), final=True):
+                yield res
+
+            if complete_response:
+                await self.aadd_assistant_message(job.lead, complete_response, tokens=bool(max_history_tokens))
+                if snapshot:
+                    snapshot.append(create_assistant_message(complete_response))
+
+            if summarize:
+                # in the background, the response is already out
+                self._summarizer.schedule(job.lead, len(history_messages), ctx.get("settings", {}))
+        finally:
+            if next_chunk is not None:
+                next_chunk.cancel()
+            session.producing = False
+            if owner:
+                session.finished()
 
 
     async def process_results_coro(self, stream):
+        """The content and function call of a streamed response. When it runs on a loop of its own
+        (asyncio.run) await redis_pools.aclose before the loop ends, see RedisPoolRegistry"""
         response = {
             "content": "",
             "function_call": None
@@ -313,8 +677,18 @@ if __name__ == "__main__":
     print("Is first message (False): ", is_first_msg)
 
 
+    from lolapy_lite_agent.redis_pool import redis_pools
+
+    async def run_job():
+        try:
+            return await agent.process_results_coro(agent.process(job))
+        finally:
+            # the Redis pools of a loop aren't disconnected when asyncio.run closes it
+            await agent.aclose()
+            await redis_pools.aclose()
+
     # process job
-    res = asyncio.run(agent.process_results_coro(agent.process(job)))
+    res = asyncio.run(run_job())
     content = res.get("content")
     function_call = res.get("function_call")
 
@@ -328,7 +702,7 @@ if __name__ == "__main__":
         # remove message from job, so that the agent can process the function call
         job.message = None
         # reprocess job
-        res = asyncio.run(agent.process_results_coro(agent.process(job)))
+        res = asyncio.run(run_job())
 
         content = res.get("content")
         function_call = res.get("function_call")
@@ -67,5 +67,26 @@ def create_function_response_message(name: str, response: str):
     return output
 
 
+# tools API, an assistant message may hold several tool calls
+# {"role": "assistant", "content": null, "tool_calls": [{"id": "call_1", "type": "function", "function": {"name": "get_price", "arguments": "{...}"}}]}
+# {"role": "tool", "tool_call_id": "call_1", "content": "..."}
+
+def create_tool_calls_message(tool_calls: list):
+    output = {
+        "role": "assistant",
+        "content": None,
+        "tool_calls": tool_calls
+    }
+    return output
+
+def create_tool_response_message(tool_call_id: str, response: str):
+    output = {
+        "role": "tool",
+        "tool_call_id": tool_call_id,
+        "content": response
+    }
+    return output
+
+
 if __name__ == "__main__":
     pass
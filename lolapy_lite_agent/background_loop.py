@@ -0,0 +1,126 @@
+import asyncio
+import atexit
+import threading
+from typing import AsyncIterator, Awaitable, Iterator, TypeVar
+
+T = TypeVar("T")
+
+# seconds stop waits for the tasks still running on the loop, e.g. history writes behind the responses
+DEFAULT_STOP_TIMEOUT = 5.0
+
+
+class BackgroundLoop:
+    """An event loop running forever on a daemon thread, for sync callers of the async API.
+
+    Unlike asyncio.run per call, the loop survives between calls, so the OpenAI and Redis clients
+    bound to it (see openai_clients and redis_pools) keep their warm connections from one message to the next.
+    """
+
+    def __init__(self, name="lola-loop"):
+        self.name = name
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """The running loop, started on first use"""
+        if self._loop is None:
+            with self._lock:
+                if self._loop is None:
+                    self._start()
+        return self._loop
+
+    def _start(self):
+        loop = asyncio.new_event_loop()
+        ready = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(loop)
+            loop.call_soon(ready.set)
+            loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name=self.name, daemon=True)
+        self._thread.start()
+        ready.wait()
+        self._loop = loop
+
+    def run(self, coro: Awaitable[T], timeout=None) -> T:
+        """Runs coro on the loop and waits for its result"""
+        loop = self.loop
+        if threading.current_thread() is self._thread:
+            if asyncio.iscoroutine(coro):
+                coro.close()
+            raise RuntimeError("BackgroundLoop.run called from its own loop, await the coroutine instead")
+        return asyncio.run_coroutine_threadsafe(coro, loop).result(timeout)
+
+    def iterate(self, agen: AsyncIterator[T]) -> Iterator[T]:
+        """Iterates an async generator from sync code, each item is produced on the loop"""
+        try:
+            while True:
+                try:
+                    yield self.run(agen.__anext__())
+                except StopAsyncIteration:
+                    return
+        finally:
+            aclose = getattr(agen, "aclose", None)
+            if aclose is not None and self._loop is not None and not self._loop.is_closed():
+                self.run(aclose())
+
+    def stop(self, timeout=DEFAULT_STOP_TIMEOUT):
+        """Stops the loop and waits for its thread, the next call starts a new one.
+        The tasks still running on the loop get up to timeout seconds to finish first"""
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            self._loop = self._thread = None
+        if loop is None:
+            return
+        if timeout and threading.current_thread() is not thread:
+            try:
+                asyncio.run_coroutine_threadsafe(_drain(timeout), loop).result(timeout + 1)
+            except Exception:
+                pass
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+async def _drain(timeout):
+    tasks = asyncio.all_tasks() - {asyncio.current_task()}
+    if tasks:
+        await asyncio.wait(tasks, timeout=timeout)
+
+
+# process wide loop shared by the sync wrappers
+background_loop = BackgroundLoop()
+atexit.register(background_loop.stop)
+
+
+if __name__ == "__main__":
+    import time
+    from lolapy_lite_agent.redis_pool import redis_pools
+
+    # per message overhead of the event loop: the old controller ran asyncio.run twice per message
+    # (first completion and the function call follow-up), creating the loop and the loop bound clients each time
+    redis_url = "redis://localhost:6379/0"
+
+    async def turn():
+        # clients are per loop, a new loop means a new pool (and new connections on first use)
+        redis_pools.async_client(redis_url)
+        await asyncio.sleep(0)
+
+    n = 1000
+    start = time.perf_counter()
+    for i in range(n):
+        asyncio.run(turn())
+        asyncio.run(turn())
+    before = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(n):
+        background_loop.run(turn())
+        background_loop.run(turn())
+    after = time.perf_counter() - start
+
+    print(f"asyncio.run x2 per message:  {before / n * 1e6:.1f} us/message")
+    print(f"background loop per message: {after / n * 1e6:.1f} us/message")
@@ -1,13 +1,13 @@
 
-import json
 import threading
 import time
 import cachetools
 from line_profiler import profile
-import redis
 
 from example.event_generator import gen_event
 from lolapy_lite_agent.caching.cache_store import CacheStore
+from lolapy_lite_agent.redis_pool import redis_pools
+from lolapy_lite_agent.serialization import Codec, default_codec
 
 
 
@@ -20,16 +20,17 @@ class MemRedisCacheAside(CacheStore):
     The in-memory cache is used for fast access, while the Redis cache provides persistence and can be shared across multiple instances.
 
     Attributes:
-        redis_client: A StrictRedis client connected to the Redis server.
+        redis_client: A Redis client on the shared connection pool of redis_url.
         cache: An in-memory LRU cache.
         key_prefix: A prefix added to all keys stored in the Redis cache.
         ttl: The time-to-live (in seconds) for keys in the Redis cache.
         wait_for_redis: A flag indicating whether to wait for Redis operations to complete.
     """
 
-    def __init__(self, redis_url, key_prefix, memory_maxsize=1000, ttl=60, wait_for_redis=False):
-        """Initializes the cache with the given parameters."""
-        self.redis_client = redis.StrictRedis.from_url(redis_url)
+    def __init__(self, redis_url, key_prefix, memory_maxsize=1000, ttl=60, wait_for_redis=False, codec: Codec = None):
+        """Initializes the cache with the given parameters, codec stores the values in Redis (JSON when None)."""
+        self.redis_client = redis_pools.client(redis_url)
+        self.codec = codec or default_codec
         self.cache = cachetools.LRUCache(maxsize=memory_maxsize)
         self.key_prefix = key_prefix
         self.ttl = ttl
@@ -54,7 +55,7 @@ class MemRedisCacheAside(CacheStore):
 
         data = self.redis_client.get(self.key_prefix + key)
         if data is not None:
-            data = json.loads(data)
+            data = self.codec.decode(data)
             self.cache[key] = data
             return data
         
@@ -78,10 +79,10 @@ class MemRedisCacheAside(CacheStore):
 
         if not self.wait_for_redis:
             # update redis in a separate thread in background
-            threading.Thread(target=self.redis_client.setex, args=(self.key_prefix + key, self.ttl, json.dumps(value))).start()
+            threading.Thread(target=self.redis_client.setex, args=(self.key_prefix + key, self.ttl, self.codec.encode(value))).start()
         else:
             #avoid  redis.exceptions.DataError: Invalid input of type: 'dict'. Convert to a bytes, string, int or float first.
-            self.redis_client.setex(self.key_prefix + key, self.ttl, json.dumps(value))
+            self.redis_client.setex(self.key_prefix + key, self.ttl, self.codec.encode(value))
 
 
 
@@ -0,0 +1,152 @@
+from collections.abc import Mapping
+from lolapy_lite_agent.serialization import FORMAT_VERSION, Codec, default_codec, dumps_json, loads_json
+
+# keys of a message, in the order they are written
+FIELDS = ('role', 'content', 'name', 'function_call', 'tool_calls', 'tool_call_id')
+_FIELD_SET = frozenset(FIELDS)
+
+
+class ChatMessage(Mapping):
+    """A history message, read like the dict the OpenAI client takes (message["role"], message.get("name")).
+
+    Slots instead of a dict per message, and the message keeps its JSON and its token count once they are
+    known: a message read from Redis is sent and re-appended with the bytes it was stored as, a new one is
+    encoded and counted once. role and content are always keys, the other fields only when set,
+    keys the model doesn't have are kept in extra. Messages are read-only, to_dict returns a dict to modify.
+    """
+    __slots__ = FIELDS + ('extra', 'tokens', '_json')
+
+    def __init__(self, role, content=None, name=None, function_call=None, tool_calls=None, tool_call_id=None,
+                 extra: dict = None, tokens: int = None, encoded: bytes = None):
+        """
+        Args:
+            tokens: token count, set by count_message_tokens when None
+            encoded: the message as JSON, e.g. as read from Redis, encoded on the first write when None
+        """
+        self.role = role
+        self.content = content
+        self.name = name
+        self.function_call = function_call
+        self.tool_calls = tool_calls
+        self.tool_call_id = tool_call_id
+        self.extra = extra
+        self.tokens = tokens
+        self._json = encoded
+
+    @classmethod
+    def from_dict(cls, value, tokens: int = None, encoded: bytes = None):
+        """Message of a dict, values that aren't dicts (a ChatMessage, None) are returned as they are"""
+        if type(value) is not dict:
+            return value
+        # set slot by slot, read back from Redis for every history entry
+        message = object.__new__(cls)
+        get = value.get
+        message.role = get('role')
+        message.content = get('content')
+        message.name = get('name')
+        message.function_call = get('function_call')
+        message.tool_calls = get('tool_calls')
+        message.tool_call_id = get('tool_call_id')
+        message.extra = None if value.keys() <= _FIELD_SET else {k: v for k, v in value.items() if k not in _FIELD_SET}
+        message.tokens = tokens
+        message._json = encoded
+        return message
+
+    @classmethod
+    def from_json(cls, data: bytes, tokens: int = None):
+        """Message of its JSON, the bytes are kept and written as they are"""
+        return cls.from_dict(loads_json(data), tokens, bytes(data))
+
+    def __getitem__(self, key):
+        if key in _FIELD_SET:
+            value = getattr(self, key)
+            if value is not None or key == 'role' or key == 'content':
+                return value
+        elif self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        if key in _FIELD_SET:
+            value = getattr(self, key)
+            return default if value is None and key != 'role' and key != 'content' else value
+        return self.extra.get(key, default) if self.extra else default
+
+    def __contains__(self, key):
+        if key in _FIELD_SET:
+            return key == 'role' or key == 'content' or getattr(self, key) is not None
+        return bool(self.extra) and key in self.extra
+
+    def __iter__(self):
+        yield 'role'
+        yield 'content'
+        for key in FIELDS[2:]:
+            if getattr(self, key) is not None:
+                yield key
+        if self.extra:
+            yield from self.extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def to_dict(self) -> dict:
+        """The message as the OpenAI client takes it"""
+        output = {'role': self.role, 'content': self.content}
+        if self.name is not None:
+            output['name'] = self.name
+        if self.function_call is not None:
+            output['function_call'] = self.function_call
+        if self.tool_calls is not None:
+            output['tool_calls'] = self.tool_calls
+        if self.tool_call_id is not None:
+            output['tool_call_id'] = self.tool_call_id
+        if self.extra:
+            output.update(self.extra)
+        return output
+
+    def json(self) -> bytes:
+        if self._json is None:
+            self._json = dumps_json(self.to_dict())
+        return self._json
+
+    def encode(self, codec: Codec = default_codec) -> bytes:
+        """The message as codec stores it, JSON codecs write the cached JSON"""
+        if codec.serializer == "json":
+            return codec.frame(self.json())
+        return codec.encode(self.to_dict())
+
+    def __repr__(self):
+        return f"ChatMessage({self.to_dict()!r})"
+
+
+def load_messages(values, codec: Codec = default_codec) -> list:
+    """History entries as read from Redis, decoded as ChatMessage. The ones stored as plain JSON keep their bytes"""
+    from_dict = ChatMessage.from_dict
+    return [from_dict(loads_json(v), None, v) if v and v[0] != FORMAT_VERSION else from_dict(codec.decode(v))
+            for v in values]
+
+
+if __name__ == "__main__":
+    import sys
+    import timeit
+
+    stored = [dumps_json({"role": "user" if i % 2 == 0 else "assistant", "content": f"Message number {i} " * 5})
+              for i in range(1000)]
+    dicts = default_codec.decode_many(stored)
+    messages = load_messages(stored)
+    print(messages[0], messages[0] == dicts[0], dict(messages[1]) == dicts[1])
+    print(f"size dict {sys.getsizeof(dicts[0])} bytes, ChatMessage {sys.getsizeof(messages[0])} bytes")
+
+    # the create_* helpers return dicts callers may modify, the providers store them as ChatMessage
+    import json
+    from lolapy_lite_agent.agents.utils import create_function_call_message, create_user_message
+    for message in (create_user_message("Hello"), create_function_call_message("get_price", '{"cryptocurrency": "BTC"}')):
+        message["name"] = "john"
+        message.update(extra="kept")
+        assert loads_json(ChatMessage.from_dict(message).json()) == json.loads(json.dumps(message)), message
+
+    number = 20
+    for name, encode in (("dict", lambda: [default_codec.encode(d) for d in dicts]),
+                         ("ChatMessage", lambda: [m.encode() for m in messages])):
+        seconds = min(timeit.repeat(encode, number=number, repeat=5)) / number
+        print(f"{name:12} encode 1000 entries {seconds * 1e3:7.3f} ms")
@@ -0,0 +1,58 @@
+from typing import List
+import openai
+from loguru import logger as log
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+from lolapy_lite_agent.chat_message import ChatMessage
+from lolapy_lite_agent.serialization import dumps_json, loads_json
+
+# openai versions that encode every body themselves can't send a prebuilt one, found on the first request
+_raw_bodies = True
+
+
+class RawJSON(bytes):
+    """A history entry as stored, valid JSON that is written into the request body without being decoded"""
+    __slots__ = ()
+
+    def decode_json(self, tokens: int = None) -> ChatMessage:
+        return ChatMessage.from_json(self, tokens)
+
+
+def decode_messages(messages: List) -> List[dict]:
+    """The messages as dicts, RawJSON entries decoded and ChatMessage converted, for clients that take dicts"""
+    return [loads_json(m) if isinstance(m, RawJSON) else m.to_dict() if isinstance(m, ChatMessage) else m
+            for m in messages]
+
+
+def encode_request(body: dict) -> bytes:
+    """JSON body of a chat completions request, the RawJSON messages and the JSON of the ChatMessage ones
+    are spliced in as they are"""
+    messages = b",".join(m if isinstance(m, RawJSON) else m.json() if isinstance(m, ChatMessage) else dumps_json(m)
+                         for m in body.get("messages") or [])
+    rest = dumps_json({k: v for k, v in body.items() if k != "messages"})
+    return b'{"messages":[' + messages + (b"]," + rest[1:] if len(rest) > 2 else b"]}")
+
+
+async def create_chat_stream(client, **params):
+    """Streams a chat completion like client.chat.completions.create(stream=True, **params).
+
+    When the messages hold RawJSON entries and client is an AsyncOpenAI, the request body is built here with the
+    stored entries spliced in, instead of decoding them into dicts for the client to encode again.
+    Other clients (testing doubles, wrappers), and openai versions that can't send a bytes body,
+    get the messages decoded.
+    """
+    global _raw_bodies
+    messages = params.get("messages") or []
+    if _raw_bodies and isinstance(client, openai.AsyncOpenAI) and any(isinstance(m, RawJSON) for m in messages):
+        try:
+            return await client.post(
+                "/chat/completions",
+                body=encode_request({**params, "stream": True}),
+                cast_to=ChatCompletion,
+                stream=True,
+                stream_cls=openai.AsyncStream[ChatCompletionChunk],
+            )
+        except TypeError as e:
+            # raised building the request, before anything is sent
+            log.warning(f"openai {openai.__version__} can't send a prebuilt body, history entries are decoded: {e}")
+            _raw_bodies = False
+    return await client.chat.completions.create(stream=True, **{**params, "messages": decode_messages(messages)})
@@ -0,0 +1,174 @@
+import asyncio
+from redis.exceptions import NoScriptError
+from dataclasses import dataclass, field
+from lolapy_lite_agent.chat_lead import ChatLead
+from lolapy_lite_agent.chat_message import ChatMessage
+from lolapy_lite_agent.chat_request import RawJSON
+from lolapy_lite_agent.history.history_redis_async_provider import AsyncRedisHistoryProvider
+from lolapy_lite_agent.state.state_redis_async_provider import AsyncRedisChatStateProvider
+from lolapy_lite_agent.template_dependencies import ALL_DEPENDENCIES, TemplateDependencies
+from lolapy_lite_agent.token_counter import complete_token_counts, count_message_tokens, known_tokens, orphan_responses, select_history_window
+
+
+def _decode_entry(entry):
+    return entry.decode_json() if isinstance(entry, RawJSON) else entry
+
+
+@dataclass
+class ConversationSnapshot:
+    """History and state of a lead as read once at the beginning of a turn.
+    PromptCompiler and LolaAgent.request_stream both read from it instead of going back to Redis.
+    Only what the prompt reads is loaded: entries may be the last messages of the history (complete is False)
+    and state may hold only some keys.
+    """
+    lead: ChatLead
+    entries: list = field(default_factory=list)
+    state: dict = None
+    complete: bool = True
+    # token count of each entry, as stored in the history, None when it wasn't counted
+    token_counts: list = None
+    # running summary of the entries before the window, see HistorySummarizer
+    summary: str = None
+    # entries may still be RawJSON, they are decoded the first time they are read as messages
+    raw: bool = False
+
+    def _decode(self):
+        if self.raw:
+            counts = self.token_counts or [None] * len(self.entries)
+            self.entries = [e.decode_json(tokens) if isinstance(e, RawJSON) else e
+                            for e, tokens in zip(self.entries, counts)]
+            self.raw = False
+
+    @property
+    def history(self):
+        # same as RedisHistoryProvider.get_history, None elements are removed
+        self._decode()
+        return [e for e in self.entries if e]
+
+    def last_messages(self, count, raw=False):
+        """Same semantics as lrange(key, -count, -1), without the function responses the window starts with,
+        see orphan_responses. With raw the entries may be RawJSON, for the request body"""
+        if not raw:
+            self._decode()
+        entries = self.entries[-count:]
+        return entries[orphan_responses(entries, _decode_entry if raw else None):]
+
+    def last_tokens(self, count) -> int:
+        """Tokens of the last count entries, the ones written without a count are counted once"""
+        if not count:
+            return 0
+        if self.token_counts is None:
+            self.token_counts = [None] * len(self.entries)
+        counts = self.token_counts
+        for i in range(max(len(self.entries) - count, 0), len(self.entries)):
+            if counts[i] is None:
+                counts[i] = count_message_tokens(_decode_entry(self.entries[i]))
+        return sum(counts[-count:])
+
+    def window(self, budget, max_messages=None):
+        """Newest entries fitting in a budget of tokens, see select_history_window.
+        Returns the entries and their tokens."""
+        # the window reads the roles of the entries
+        self._decode()
+        counts = self.token_counts
+        if counts is None:
+            counts = self.token_counts = [count_message_tokens(e) for e in self.entries]
+        else:
+            complete_token_counts(self.entries, counts)
+        start = select_history_window(self.entries, counts, budget, max_messages)
+        return self.entries[start:], sum(counts[start:])
+
+    def append(self, entry):
+        """Keep the snapshot in sync with a message written to the history during the turn"""
+        entry = ChatMessage.from_dict(entry)
+        self.entries.append(entry)
+        if self.token_counts is not None:
+            self.token_counts.append(known_tokens(entry))
+
+
+async def _read(historyStore, stateStore, lead, append, dependencies, history_count, summary, tokens):
+    """Pipeline of load_conversation_snapshot, returns the history replies and the state"""
+    pipe = historyStore.client.pipeline(transaction=False)
+    if append:
+        historyStore.pipe_append(pipe, lead, append, tokens=tokens)
+    historyStore.pipe_get_history(pipe, lead, history_count)
+    historyStore.pipe_get_token_counts(pipe, lead, history_count)
+    if summary:
+        historyStore.pipe_get_summary(pipe, lead)
+
+    if not dependencies.state:
+        replies, state = await pipe.execute(), None
+    elif historyStore.redis_url == stateStore.redis_url:
+        keys = None if dependencies.all_state else list(dependencies.state_keys)
+        # state lives in the same pipeline unless it is stored in another Redis
+        if keys is None:
+            stateStore.pipe_get_store(pipe, lead)
+        else:
+            stateStore.pipe_get_values(pipe, lead, keys)
+        replies = await pipe.execute()
+        if keys is None:
+            state = stateStore.decode_store(replies[-1])
+        else:
+            state = stateStore.decode_values(keys, replies[-1])
+        replies = replies[:-1]
+    else:
+        if dependencies.all_state:
+            read_state = stateStore.get_store(lead)
+        else:
+            read_state = stateStore.get_values(lead, dependencies.state_keys)
+        replies, state = await asyncio.gather(pipe.execute(), read_state)
+    return replies, state
+
+
+async def load_conversation_snapshot(historyStore: AsyncRedisHistoryProvider,
+                                     stateStore: AsyncRedisChatStateProvider,
+                                     lead: ChatLead,
+                                     append: dict = None,
+                                     dependencies: TemplateDependencies = None,
+                                     history_count: int = None,
+                                     summary: bool = False,
+                                     pending: list = None,
+                                     raw: bool = False,
+                                     tokens: bool = True) -> ConversationSnapshot:
+    """Read history and state in a single pipelined round trip.
+    When append is given the message is pushed to the history in that same round trip,
+    before the history is read back.
+
+    Args:
+        dependencies: what the prompt template reads, the state is read with HMGET when the keys are known
+            and not read at all when the template doesn't use it
+        history_count: when the template doesn't read the history only the last history_count entries are read
+        summary: read the history summary too
+        pending: messages appended after the ones in Redis, not written yet (see HistoryBuffer.reading)
+        raw: keep the entries stored as JSON undecoded until they are read as dicts, see ConversationSnapshot.raw
+        tokens: count the tokens of append, see append_args
+    """
+    dependencies = dependencies or ALL_DEPENDENCIES
+    if dependencies.history or not history_count:
+        history_count = None
+
+    history_at = 1 if append else 0
+    try:
+        replies, state = await _read(historyStore, stateStore, lead, append, dependencies, history_count, summary, tokens)
+    except NoScriptError:
+        # the append script isn't loaded yet, the pipeline ran without appending, see pipe_append_many
+        await historyStore.load_scripts()
+        replies, state = await _read(historyStore, stateStore, lead, append, dependencies, history_count, summary, tokens)
+
+    if raw:
+        entries = historyStore.decode_history_raw(replies[history_at])
+    else:
+        entries = historyStore.decode_history(replies[history_at])
+    token_counts = historyStore.decode_token_counts(entries, replies[history_at + 1])
+    if pending:
+        entries += pending
+        token_counts += [known_tokens(e) for e in pending]
+    return ConversationSnapshot(
+        lead=lead,
+        entries=entries,
+        state=state,
+        complete=history_count is None,
+        token_counts=token_counts,
+        summary=historyStore.decode_summary(replies[history_at + 2]) if summary else None,
+        raw=raw,
+    )
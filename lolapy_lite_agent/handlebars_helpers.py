@@ -2,6 +2,7 @@
 
 import json
 from pybars import Compiler
+from lolapy_lite_agent.serialization import json_default
 
 
 def get_handlebars_compiler():
@@ -10,14 +11,8 @@ def get_handlebars_compiler():
 
 
 def get_helpers():
-    return {
-        'if_equals': if_equals,
-        'if_not_equals': if_not_equals,
-        'json': json_helper,
-        'json_pretty': json_pretty,
-        'json_pretty_no_escaping': json_pretty_no_escaping,
-        'key_value': key_value
-    }
+    # built once, pybars copies the helpers dict on every render so it is safe to share
+    return _helpers
 
 def if_equals(this, arg1, arg2, options):
     if arg1 == arg2:
@@ -32,16 +27,26 @@ def if_not_equals(this, arg1, arg2, options):
         return options['inverse'](this)
 
 def json_helper(this, context):
-    return json.dumps(context)
+    return json.dumps(context, default=json_default)
 
 def json_pretty(this, context):
-    return json.dumps(context, indent=2)
+    return json.dumps(context, indent=2, default=json_default)
 
 def json_pretty_no_escaping(this, context):
-    return json.dumps(context, indent=2)
+    return json.dumps(context, indent=2, default=json_default)
 
 def key_value(this, context):
     output = ''
     for key in context:
         output += f'{key}: {context[key]}\n'
-    return output
\ No newline at end of file
+    return output
+
+
+_helpers = {
+    'if_equals': if_equals,
+    'if_not_equals': if_not_equals,
+    'json': json_helper,
+    'json_pretty': json_pretty,
+    'json_pretty_no_escaping': json_pretty_no_escaping,
+    'key_value': key_value
+}
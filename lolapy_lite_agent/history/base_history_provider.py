@@ -6,6 +6,10 @@ class BaseHistoryProvider(ABC):
     def append_to_history(self, lead, entry, metadata=None, ttl=None):
         pass
 
+    def append_many(self, lead, entries, ttl=None):
+        for entry in entries:
+            self.append_to_history(lead, entry, ttl=ttl)
+
     @abstractmethod
     def get_history(self, lead):
         pass
@@ -0,0 +1,60 @@
+import hashlib
+from typing import List
+from lolapy_lite_agent.chat_message import ChatMessage
+from lolapy_lite_agent.serialization import Codec, default_codec
+from lolapy_lite_agent.token_counter import count_message_tokens, known_tokens
+
+# history expiration, refreshed on every append
+DEFAULT_TTL = 86400
+# entries kept per lead, the oldest are trimmed on append
+DEFAULT_MAX_LENGTH = 1000
+
+# Appends entries and their token counts, refreshes the expiration and trims both lists to the newest
+# max_length entries, atomically in one call. The entries trimmed so far are counted in the 'trimmed' field
+# of the summary hash: the position of an entry is its index plus trimmed, it doesn't move when older entries
+# are trimmed, the summary's 'folded' is such a position.
+# KEYS: history, token counts, summary
+# ARGV: ttl, max_length (0 keeps every entry), the entries, then their token counts ('' when not counted)
+# Returns the history length
+APPEND_SCRIPT = """
+local ttl = tonumber(ARGV[1])
+local max_length = tonumber(ARGV[2])
+local count = (#ARGV - 2) / 2
+local length = redis.call('RPUSH', KEYS[1], unpack(ARGV, 3, 2 + count))
+redis.call('RPUSH', KEYS[2], unpack(ARGV, 3 + count, 2 + 2 * count))
+if max_length > 0 and length > max_length then
+    local trimmed = length - max_length
+    redis.call('LTRIM', KEYS[1], trimmed, -1)
+    redis.call('LTRIM', KEYS[2], -max_length, -1)
+    redis.call('HINCRBY', KEYS[3], 'trimmed', trimmed)
+    length = max_length
+end
+redis.call('EXPIRE', KEYS[1], ttl)
+redis.call('EXPIRE', KEYS[2], ttl)
+redis.call('EXPIRE', KEYS[3], ttl)
+return length
+"""
+# the script as EVALSHA runs it, see AsyncRedisHistoryProvider.pipe_append_many
+APPEND_SHA = hashlib.sha1(APPEND_SCRIPT.encode()).hexdigest()
+
+# The entries at positions start..end (inclusive, see APPEND_SCRIPT), the trimmed ones are skipped
+# KEYS: history, summary
+# ARGV: start, end
+RANGE_SCRIPT = """
+local trimmed = tonumber(redis.call('HGET', KEYS[2], 'trimmed') or '0')
+local first = math.max(tonumber(ARGV[1]) - trimmed, 0)
+local last = tonumber(ARGV[2]) - trimmed
+if last < first then
+    return {}
+end
+return redis.call('LRANGE', KEYS[1], first, last)
+"""
+
+
+def append_args(entries: List[dict], ttl=None, max_length=None, codec: Codec = default_codec, tokens=True) -> list:
+    """ARGV of APPEND_SCRIPT, a ChatMessage is written with its cached encoding and token count.
+    Without tokens the entries aren't counted, only the counts already known are written"""
+    counts = [count_message_tokens(entry) for entry in entries] if tokens else [known_tokens(entry) for entry in entries]
+    return ([ttl or DEFAULT_TTL, max_length or 0]
+            + [entry.encode(codec) if isinstance(entry, ChatMessage) else codec.encode(entry) for entry in entries]
+            + ["" if count is None else count for count in counts])
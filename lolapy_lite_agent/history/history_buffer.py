@@ -0,0 +1,163 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Dict, List
+from loguru import logger as log
+from lolapy_lite_agent.chat_lead import ChatLead
+from lolapy_lite_agent.chat_message import ChatMessage
+from lolapy_lite_agent.history.history_redis_async_provider import AsyncRedisHistoryProvider
+from lolapy_lite_agent.token_counter import count_message_tokens
+
+# how long the messages of a turn may live only in the process
+# every append is awaited until Redis has it, the default
+WRITE_THROUGH = "write_through"
+# appends are written in the background while the turn goes on, the turn ends once they are in Redis
+TURN = "turn"
+# appends are written in the background, a crash loses the ones not flushed yet, up to the last turn
+BACKGROUND = "background"
+DURABILITIES = (WRITE_THROUGH, TURN, BACKGROUND)
+
+DEFAULT_MAX_BATCH = 64
+DEFAULT_RETRIES = 3
+DEFAULT_RETRY_DELAY = 0.5
+
+
+class _LeadBuffer:
+    """Messages of a lead not in Redis yet, in the order they were appended"""
+    __slots__ = ('lead', 'entries', 'lock', 'task')
+
+    def __init__(self, lead: ChatLead):
+        self.lead = lead
+        self.entries = []
+        # held while a batch is written and while the history is read, so a reader never sees
+        # a batch both in Redis and in entries
+        self.lock = asyncio.Lock()
+        self.task = None
+
+
+class HistoryBuffer:
+    """Write-behind for the history: appends are held per lead and written to Redis by a background task,
+    one task per lead writing batches in order, so the history keeps the order of the appends.
+
+    Readers of the history add the pending messages to what they read from Redis, see reading.
+    With WRITE_THROUGH every append is written right away, like calling the provider.
+    Call close (LolaAgent.aclose, AgentRuntime.aclose) before the event loop ends, asyncio.run cancels
+    the tasks still writing.
+
+    Args:
+        durability: WRITE_THROUGH, TURN or BACKGROUND
+        max_batch: messages per write
+        retries: failed writes of a batch retried before it is dropped
+    """
+
+    def __init__(self,
+                 historyStore: AsyncRedisHistoryProvider,
+                 durability=WRITE_THROUGH,
+                 max_batch=DEFAULT_MAX_BATCH,
+                 retries=DEFAULT_RETRIES,
+                 retry_delay=DEFAULT_RETRY_DELAY):
+        if durability not in DURABILITIES:
+            raise ValueError(f"Unknown history durability {durability}, expected one of {DURABILITIES}")
+        self.historyStore = historyStore
+        self.durability = durability
+        self.max_batch = max_batch
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._buffers: Dict[str, _LeadBuffer] = {}
+
+    @property
+    def enabled(self) -> bool:
+        """Appends are written in the background"""
+        return self.durability != WRITE_THROUGH
+
+    async def append(self, lead: ChatLead, entries: List[dict], tokens=True) -> List[ChatMessage]:
+        """Appends entries to the history of lead, without tokens they aren't counted, see append_args.
+        Returns the entries as ChatMessage, the messages of the snapshot share their encoding and count"""
+        if not entries:
+            return []
+        entries = [ChatMessage.from_dict(e) for e in entries]
+        if not self.enabled:
+            await self.historyStore.append_many(lead, entries, tokens=tokens)
+            return entries
+        # counted now, the batches are written with the counts their messages have
+        if tokens:
+            for entry in entries:
+                count_message_tokens(entry)
+        buffer = self._buffers.get(lead.get_token())
+        if buffer is None:
+            buffer = self._buffers[lead.get_token()] = _LeadBuffer(lead)
+        buffer.entries.extend(entries)
+        if buffer.task is None:
+            buffer.task = asyncio.get_running_loop().create_task(self._write(buffer))
+        return entries
+
+    def pending(self, lead: ChatLead) -> List[dict]:
+        """Messages of lead not in Redis yet"""
+        buffer = self._buffers.get(lead.get_token())
+        return list(buffer.entries) if buffer else []
+
+    @asynccontextmanager
+    async def reading(self, lead: ChatLead):
+        """Holds the writes of lead while its history is read, yields the messages missing from Redis:
+
+            async with buffer.reading(lead) as pending:
+                entries = await historyStore.get_history(lead) + pending
+        """
+        buffer = self._buffers.get(lead.get_token())
+        if buffer is None:
+            yield []
+            return
+        async with buffer.lock:
+            yield list(buffer.entries)
+
+    async def _write(self, buffer: _LeadBuffer):
+        failures = 0
+        try:
+            while buffer.entries:
+                async with buffer.lock:
+                    batch = buffer.entries[:self.max_batch]
+                    try:
+                        await self.historyStore.append_many(buffer.lead, batch, tokens=False)
+                    except Exception as e:
+                        failures += 1
+                        if failures <= self.retries:
+                            log.warning(f"History write of {buffer.lead.get_token()} failed ({failures}/{self.retries}): {e}")
+                        else:
+                            log.error(f"History write of {buffer.lead.get_token()} failed, {len(batch)} messages dropped: {e}")
+                            del buffer.entries[:len(batch)]
+                            failures = 0
+                        batch = None
+                    else:
+                        del buffer.entries[:len(batch)]
+                        failures = 0
+                if batch is None and failures:
+                    await asyncio.sleep(self.retry_delay * failures)
+        finally:
+            buffer.task = None
+            if not buffer.entries and self._buffers.get(buffer.lead.get_token()) is buffer:
+                del self._buffers[buffer.lead.get_token()]
+
+    async def flush(self, lead: ChatLead = None):
+        """Waits until the pending messages of lead (of every lead when None) are in Redis"""
+        buffers = list(self._buffers.values()) if lead is None else [self._buffers.get(lead.get_token())]
+        for buffer in buffers:
+            while buffer is not None and buffer.task is not None:
+                await asyncio.shield(buffer.task)
+
+    async def discard(self, lead: ChatLead):
+        """Drops the pending messages of lead, waiting for the batch being written, e.g. before clearing its history"""
+        buffer = self._buffers.get(lead.get_token())
+        if buffer is not None:
+            async with buffer.lock:
+                buffer.entries.clear()
+
+    async def close(self):
+        """Flushes every lead, call it on shutdown"""
+        if self._buffers:
+            log.info(f"Flushing the pending history of {len(self._buffers)} leads")
+        await self.flush()
+
+    def stats(self):
+        return {
+            'leads': len(self._buffers),
+            'pending': sum(len(b.entries) for b in self._buffers.values()),
+        }
@@ -0,0 +1,210 @@
+import asyncio
+from lolapy_lite_agent.chat_lead import ChatLead
+from lolapy_lite_agent.chat_message import ChatMessage, load_messages
+from lolapy_lite_agent.chat_request import RawJSON
+from lolapy_lite_agent.history.base_history_provider import BaseHistoryProvider
+from lolapy_lite_agent.history.history_append import APPEND_SCRIPT, APPEND_SHA, DEFAULT_MAX_LENGTH, RANGE_SCRIPT, append_args
+from lolapy_lite_agent.redis_pool import redis_pools
+from lolapy_lite_agent.serialization import FORMAT_VERSION, Codec, default_codec
+from lolapy_lite_agent.token_counter import complete_token_counts
+
+
+class AsyncRedisHistoryProvider(BaseHistoryProvider):
+    """Same storage layout as RedisHistoryProvider but every call is awaited on the running loop,
+    so a slow Redis reply never blocks other streams served by the same process.
+    """
+
+    def __init__(self, redis_url=None, max_length=DEFAULT_MAX_LENGTH, codec: Codec = None):
+        """
+        Args:
+            max_length: entries kept per lead, the oldest are dropped on append. Every entry is kept when None
+            codec: how entries are stored, JSON when None
+        """
+        self.redis_url = redis_url if redis_url else "localhost"
+        self.max_length = max_length
+        self.codec = codec or default_codec
+        # registered on first use, called with the client of the running loop
+        self._append = None
+        self._range = None
+
+    @property
+    def client(self):
+        # shared pool of the running loop, see RedisPoolRegistry
+        return redis_pools.async_client(self.redis_url)
+
+    def get_key(self, lead: ChatLead):
+        return f"h:{lead.get_token()}"
+
+    def get_tokens_key(self, lead: ChatLead):
+        # token count of every history entry, pushed with the entry
+        return f"ht:{lead.get_token()}"
+
+    def get_summary_key(self, lead: ChatLead):
+        # running summary of the history (summary), the position of the first entry it doesn't cover (folded)
+        # and the entries trimmed from the history (trimmed), see APPEND_SCRIPT
+        return f"hs:{lead.get_token()}"
+
+    def _append_keys(self, lead: ChatLead):
+        return [self.get_key(lead), self.get_tokens_key(lead), self.get_summary_key(lead)]
+
+    async def append_to_history(self, lead: ChatLead, entry, metadata=None, ttl=None):
+        return await self.append_many(lead, [entry], ttl)
+
+    async def append_many(self, lead: ChatLead, entries, ttl=None, tokens=True):
+        """Appends entries, refreshes the expiration (24 hours by default) and trims the history to max_length,
+        atomically in one round trip, e.g. the function calls of a response and their results.
+        Without tokens the entries aren't counted (no max_history_tokens budget), see append_args.
+        Returns the history length"""
+        if not entries:
+            return None
+        # dicts are stored as ChatMessage, encoded and counted once
+        entries = [ChatMessage.from_dict(e) for e in entries]
+        client = self.client
+        if self._append is None:
+            # EVALSHA, the script is loaded on the first NOSCRIPT reply
+            self._append = client.register_script(APPEND_SCRIPT)
+        return await self._append(keys=self._append_keys(lead), args=append_args(entries, ttl, self.max_length, self.codec, tokens),
+                                  client=client)
+
+    def pipe_append(self, pipe, lead: ChatLead, entry, ttl=None, tokens=True):
+        """Queue an append on an existing pipeline, see append_many"""
+        self.pipe_append_many(pipe, lead, [entry], ttl, tokens)
+
+    def pipe_append_many(self, pipe, lead: ChatLead, entries, ttl=None, tokens=True):
+        """Queue an append on an existing pipeline. Sent as EVALSHA of APPEND_SHA, scripts registered on a
+        pipeline cost a SCRIPT EXISTS round trip per execute. Until the script is loaded the pipeline raises
+        NoScriptError without appending anything, call load_scripts and execute it again"""
+        entries = [ChatMessage.from_dict(e) for e in entries]
+        keys = self._append_keys(lead)
+        pipe.evalsha(APPEND_SHA, len(keys), *keys, *append_args(entries, ttl, self.max_length, self.codec, tokens))
+
+    async def load_scripts(self):
+        """Loads the script of pipe_append_many, once per Redis (until it restarts or the scripts are flushed)"""
+        await self.client.script_load(APPEND_SCRIPT)
+
+    def pipe_get_history(self, pipe, lead: ChatLead, count=None):
+        """Queue a history read on an existing pipeline, the last count entries or the full history,
+        decode the reply with decode_history"""
+        pipe.lrange(self.get_key(lead), -count if count else 0, -1)
+
+    def decode_history(self, values):
+        return load_messages(values, self.codec)
+
+    def decode_history_raw(self, values):
+        """Like decode_history, but the entries stored as plain JSON are kept as they are (RawJSON),
+        the request body is built with them, see chat_request"""
+        return [RawJSON(v) if v and v[0] != FORMAT_VERSION else self.codec.decode(v) for v in values]
+
+    def pipe_get_token_counts(self, pipe, lead: ChatLead, count=None):
+        """Queue a read of the token counts of the entries read by pipe_get_history with the same count,
+        decode the reply with decode_token_counts"""
+        pipe.lrange(self.get_tokens_key(lead), -count if count else 0, -1)
+
+    def decode_token_counts(self, entries, values):
+        """Token counts aligned with entries. Both lists end with the newest entry, the count is None for
+        entries written without counting them or before the counts were stored, see complete_token_counts"""
+        counts = [int(v) if v else None for v in values[-len(entries):]] if entries else []
+        counts = [None] * (len(entries) - len(counts)) + counts
+        for entry, count in zip(entries, counts):
+            # read messages aren't counted again
+            if isinstance(entry, ChatMessage):
+                entry.tokens = count
+        return counts
+
+    def pipe_get_summary(self, pipe, lead: ChatLead):
+        """Queue a read of the history summary, decode the reply with decode_summary"""
+        pipe.hget(self.get_summary_key(lead), "summary")
+
+    def decode_summary(self, value):
+        return value.decode() if value else None
+
+    async def get_summary(self, lead: ChatLead):
+        return self.decode_summary(await self.client.hget(self.get_summary_key(lead), "summary"))
+
+    async def get_summary_state(self, lead: ChatLead):
+        """The summary, the position of the first entry it doesn't cover and the position after the newest entry.
+        Positions count the trimmed entries, they don't move when the history is trimmed, see get_history_range"""
+        pipe = self.client.pipeline(transaction=True)
+        pipe.hmget(self.get_summary_key(lead), ["summary", "folded", "trimmed"])
+        pipe.llen(self.get_key(lead))
+        (summary, folded, trimmed), length = await pipe.execute()
+        return self.decode_summary(summary), int(folded or 0), int(trimmed or 0) + length
+
+    async def get_history_range(self, lead: ChatLead, start, end):
+        """The entries at positions start..end (inclusive) as given by get_summary_state, in one atomic call.
+        The entries trimmed since are skipped"""
+        client = self.client
+        if self._range is None:
+            self._range = client.register_script(RANGE_SCRIPT)
+        values = await self._range(keys=[self.get_key(lead), self.get_summary_key(lead)], args=[start, end], client=client)
+        return load_messages(values, self.codec)
+
+    async def set_summary(self, lead: ChatLead, summary: str, folded: int, ttl=None):
+        """Stores the summary, folded is the position of the first entry it doesn't cover, see get_summary_state"""
+        key = self.get_summary_key(lead)
+        pipe = self.client.pipeline(transaction=False)
+        pipe.hset(key, mapping={"summary": summary, "folded": folded})
+        # same expiration as the history
+        pipe.expire(key, ttl if ttl else 86400)
+        await pipe.execute()
+
+    async def get_history(self, lead: ChatLead):
+        key = self.get_key(lead)
+        values = await self.client.lrange(key, 0, -1)
+        res = load_messages(values, self.codec)
+        # remove None elements
+        res = [r for r in res if r]
+
+        return res
+
+    async def clear_history(self, lead: ChatLead, keep_last_messages=None):
+        key = self.get_key(lead)
+        if keep_last_messages:
+            # the newest entries and their counts, the summary covered the dropped ones
+            pipe = self.client.pipeline(transaction=True)
+            pipe.ltrim(key, -keep_last_messages, -1)
+            pipe.ltrim(self.get_tokens_key(lead), -keep_last_messages, -1)
+            pipe.delete(self.get_summary_key(lead))
+            await pipe.execute()
+        else:
+            await self.client.delete(key, self.get_tokens_key(lead), self.get_summary_key(lead))
+
+    async def get_history_slice(self, lead: ChatLead, start, end):
+        key = self.get_key(lead)
+        history = await self.client.lrange(key, start, end)
+        return load_messages(history, self.codec)
+
+    async def get_last_messages(self, lead: ChatLead, count):
+        key = self.get_key(lead)
+        history = await self.client.lrange(key, -count, -1)
+        return load_messages(history, self.codec)
+
+    async def get_last_messages_with_tokens(self, lead: ChatLead, count=None):
+        """The last count entries (all when None) and their token counts, in one round trip.
+        The entries written without a count are counted"""
+        pipe = self.client.pipeline(transaction=False)
+        self.pipe_get_history(pipe, lead, count)
+        self.pipe_get_token_counts(pipe, lead, count)
+        history, counts = await pipe.execute()
+        entries = self.decode_history(history)
+        return entries, complete_token_counts(entries, self.decode_token_counts(entries, counts))
+
+    async def close_conversation(self, lead: ChatLead):
+        raise NotImplementedError("Method not implemented.")
+
+
+if __name__ == "__main__":
+
+    async def main():
+        provider = AsyncRedisHistoryProvider(redis_url="redis://localhost:6379/0")
+        lead = ChatLead("123", "test", "tenant", "assistant")
+
+        await provider.clear_history(lead)
+
+        for i in range(15):
+            await provider.append_to_history(lead, f"Message {i}")
+
+        # get the last 5 messages
+        print(await provider.get_last_messages(lead, 5))
+
+    asyncio.run(main())
@@ -1,31 +1,57 @@
-import json
-import redis
+from loguru import logger as log
 from lolapy_lite_agent.chat_lead import ChatLead
+from lolapy_lite_agent.chat_message import ChatMessage, load_messages
 from lolapy_lite_agent.history.base_history_provider import BaseHistoryProvider
+from lolapy_lite_agent.history.history_append import APPEND_SCRIPT, DEFAULT_MAX_LENGTH, append_args
+from lolapy_lite_agent.redis_pool import redis_pools
+from lolapy_lite_agent.serialization import Codec, default_codec
 
 
 class RedisHistoryProvider(BaseHistoryProvider):
 
-    def __init__(self, redis_url=None):
+    def __init__(self, redis_url=None, max_length=DEFAULT_MAX_LENGTH, codec: Codec = None):
+        """
+        Args:
+            max_length: entries kept per lead, the oldest are dropped on append. Every entry is kept when None
+            codec: how entries are stored, JSON when None
+        """
         self.redis_url = redis_url if redis_url else "localhost"
-        print(f"RedisHistoryProvider -> Connecting to redis at {self.redis_url}")
-        self.client = redis.Redis.from_url(self.redis_url)
+        self.max_length = max_length
+        self.codec = codec or default_codec
+        log.debug(f"RedisHistoryProvider -> Connecting to redis at {self.redis_url}")
+        # shared pool, every provider on the same URL uses the same connections
+        self.client = redis_pools.client(self.redis_url)
+        # EVALSHA, the script is loaded on the first NOSCRIPT reply
+        self._append = self.client.register_script(APPEND_SCRIPT)
 
     def get_key(self, lead: ChatLead):
         return f"h:{lead.get_token()}"
 
-    def append_to_history(self, lead: ChatLead, entry, metadata=None, ttl=None):
-        key = self.get_key(lead)
-        value = json.dumps(entry)
-        self.client.rpush(key, value)
+    def get_tokens_key(self, lead: ChatLead):
+        # token count of every history entry, pushed with the entry
+        return f"ht:{lead.get_token()}"
 
-        # set expiration to 24 hours
-        self.client.expire(key, ttl if ttl else 86400)
+    def get_summary_key(self, lead: ChatLead):
+        # running summary of the history, see HistorySummarizer
+        return f"hs:{lead.get_token()}"
+
+    def append_to_history(self, lead: ChatLead, entry, metadata=None, ttl=None):
+        self.append_many(lead, [entry], ttl)
+
+    def append_many(self, lead: ChatLead, entries, ttl=None):
+        """Appends entries, refreshes the expiration (24 hours by default) and trims the history to max_length,
+        atomically in one round trip. Returns the history length"""
+        if not entries:
+            return None
+        # dicts are stored as ChatMessage, encoded and counted once
+        entries = [ChatMessage.from_dict(e) for e in entries]
+        keys = [self.get_key(lead), self.get_tokens_key(lead), self.get_summary_key(lead)]
+        return self._append(keys=keys, args=append_args(entries, ttl, self.max_length, self.codec))
 
     def get_history(self, lead: ChatLead):
         key = self.get_key(lead)
         values = self.client.lrange(key, 0, -1)
-        res = [json.loads(v) for v in values]
+        res = load_messages(values, self.codec)
         # remove None elements
         res = [r for r in res if r]
 
@@ -35,19 +61,24 @@ class RedisHistoryProvider(BaseHistoryProvider):
     def clear_history(self, lead: ChatLead, keep_last_messages=None):
         key = self.get_key(lead)
         if keep_last_messages:
-            self.client.ltrim(key, 0, keep_last_messages)
+            # the newest entries and their counts, the summary covered the dropped ones
+            pipe = self.client.pipeline(transaction=True)
+            pipe.ltrim(key, -keep_last_messages, -1)
+            pipe.ltrim(self.get_tokens_key(lead), -keep_last_messages, -1)
+            pipe.delete(self.get_summary_key(lead))
+            pipe.execute()
         else:
-            self.client.delete(key)
+            self.client.delete(key, self.get_tokens_key(lead), self.get_summary_key(lead))
 
     def get_history_slice(self, lead: ChatLead, start, end):
         key = self.get_key(lead)
         history = self.client.lrange(key, start, end)
-        return [json.loads(h) for h in history]
+        return load_messages(history, self.codec)
 
     def get_last_messages(self, lead: ChatLead, count):
         key = self.get_key(lead)
         history = self.client.lrange(key, -count, -1)
-        return [json.loads(h) for h in history]
+        return load_messages(history, self.codec)
 
     def close_conversation(self, lead: ChatLead):
         raise NotImplementedError("Method not implemented.")
@@ -0,0 +1,121 @@
+import asyncio
+from collections.abc import Callable, Mapping
+import openai
+from loguru import logger as log
+from lolapy_lite_agent.agents.utils import create_prompt_message
+from lolapy_lite_agent.chat_lead import ChatLead
+from lolapy_lite_agent.history.history_buffer import HistoryBuffer
+from lolapy_lite_agent.history.history_redis_async_provider import AsyncRedisHistoryProvider
+
+DEFAULT_SUMMARY_MAX_TOKENS = 400
+SUMMARY_TIMEOUT = 30
+
+SUMMARY_PROMPT = ("You keep a running summary of a conversation between a user and an assistant. "
+                  "Update the summary with the new messages. Keep names, facts, decisions and open questions, "
+                  "drop small talk. Answer only with the updated summary, in the language of the conversation.")
+
+
+def summary_enabled(settings: dict) -> bool:
+    """The summarize_history setting of the prompt"""
+    value = (settings or {}).get("summarize_history")
+    return str(value).lower() in ("true", "1", "yes")
+
+
+def create_summary_message(summary: str):
+    return create_prompt_message(f"Summary of the earlier conversation:\n{summary}")
+
+
+def _dialog(entries):
+    lines = []
+    for entry in entries:
+        if not isinstance(entry, Mapping):
+            continue
+        content = entry.get("content")
+        function_call = entry.get("function_call")
+        if function_call:
+            content = f"calls {function_call.get('name')}({function_call.get('arguments')})"
+        tool_calls = entry.get("tool_calls")
+        if tool_calls:
+            content = "calls " + ", ".join(f"{c['function']['name']}({c['function']['arguments']})" for c in tool_calls)
+        if content:
+            lines.append(f"{entry.get('role')}: {content}")
+    return "\n".join(lines)
+
+
+class HistorySummarizer:
+    """Folds the messages falling out of the history window into a running summary stored next to the history.
+
+    The summary is updated after a turn, in a background task, never while a response is produced.
+    request_stream sends it as a system message before the history window.
+    """
+
+    def __init__(self,
+                 historyStore: AsyncRedisHistoryProvider,
+                 client: Callable[[], openai.AsyncOpenAI],
+                 default_model: str,
+                 buffer: HistoryBuffer = None):
+        self.historyStore = historyStore
+        # the summary is read against the history in Redis, the messages buffered for it are flushed first
+        self.buffer = buffer
+        # returns the client of the running loop
+        self._client = client
+        self.default_model = default_model
+        # leads with a summary being updated
+        self._running = set()
+        self._tasks = set()
+
+    def schedule(self, lead: ChatLead, window: int, settings: dict):
+        """Updates the summary of lead in the background, window is the number of history messages
+        sent with the last request, the ones before them are folded"""
+        token = lead.get_token()
+        if token in self._running:
+            return
+        self._running.add(token)
+        task = asyncio.get_running_loop().create_task(self._update(lead, window, settings))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _update(self, lead: ChatLead, window: int, settings: dict):
+        try:
+            await self.update(lead, window, settings)
+        except Exception as e:
+            log.warning(f"History summary of {lead.get_token()} failed: {e}")
+        finally:
+            self._running.discard(lead.get_token())
+
+    async def update(self, lead: ChatLead, window: int, settings: dict):
+        if self.buffer is not None:
+            await self.buffer.flush(lead)
+        # positions that don't move when appends trim the history while the summary is produced
+        summary, folded, length = await self.historyStore.get_summary_state(lead)
+        # the next turn appends a message, the window then starts one message later. Every message before it
+        # is folded, one left out of both the summary and the window would never reach the model again
+        end = length + 1 - max(window, 1)
+        if end <= folded:
+            return
+
+        entries = await self.historyStore.get_history_range(lead, folded, end - 1)
+        dialog = _dialog(entries)
+        if dialog:
+            summary = await self._summarize(summary, dialog, settings)
+        await self.historyStore.set_summary(lead, summary or "", end)
+        log.debug(f"History summary of {lead.get_token()} folded messages {folded}..{end - 1}")
+
+    async def _summarize(self, summary, dialog, settings):
+        content = f"Current summary:\n{summary}\n\nNew messages:\n{dialog}" if summary else f"New messages:\n{dialog}"
+        chat = await asyncio.wait_for(
+            self._client().chat.completions.create(
+                model=settings.get("summary_model") or settings.get("model") or self.default_model,
+                n=1,
+                stream=False,
+                messages=[create_prompt_message(SUMMARY_PROMPT), {"role": "user", "content": content}],
+                max_tokens=int(settings.get("summary_max_tokens") or DEFAULT_SUMMARY_MAX_TOKENS),
+            ),
+            SUMMARY_TIMEOUT,
+        )
+        return chat.choices[0].message.content
+
+    async def wait(self):
+        """Waits for the summaries being updated, call it before closing the loop"""
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
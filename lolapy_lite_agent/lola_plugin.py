@@ -10,6 +10,7 @@ from lolapy_lite_agent.agents.lola import LolaAgent
 from lolapy_lite_agent.chat_lead import ChatLead
 from lolapy_lite_agent.client_command import ClientCommand
 from lolapy_lite_agent.nlp_job import AgentJob
+from lolapy_lite_agent.stream_session import StreamSession
 
 
 
@@ -22,22 +23,25 @@ class LolaPlugin:
                  openai_api_key: str, 
                  on_text_received: callable = None,
                  on_function_call: Callable[[ChatLead, str, str], str] = None,
-                 init_state: dict = {}):
+                 init_state: dict = {},
+                 tools=False,
+                 redis_url: str = None,
+                 base_url: str = None):
         """
         Args:
             prompt (str): Lola PML compatible prompt
+            on_function_call: called with lead, function name and arguments, returns the function response
+                or an awaitable resolving to it
+            tools: use the tools API, several function calls per response answered concurrently
         """
-        def on_function_call(lead, function_name, function_arguments):
-            print(">>>>>> ",function_name)
-            return f"The Bitcoin price is $1000"
-
-        self.agent = LolaAgent(openai_api_key, on_text_received=on_text_received)
+        self.agent = LolaAgent(openai_api_key, on_text_received=on_text_received, tools=tools,
+                               redis_url=redis_url, base_url=base_url)
                                
         self.prompt = prompt
         self.init_state = init_state
         self.on_function_call = on_function_call
-        self._producing_response = False
-        self._needs_interrupt = False
+        # session of the response being streamed
+        self._session = None
         self.user_id = user_id
          # ChatLead
         self.lead = ChatLead(user_id, "test", "tenant", "assistant")
@@ -48,11 +52,11 @@ class LolaPlugin:
 
     def interrupt(self):
         """Interrupt a currently streaming response (if there is one)"""
-        if self._producing_response:
-            self._needs_interrupt = True
+        if self._session:
+            self._session.interrupt()
 
     async def aclose(self):
-        pass
+        await self.agent.aclose()
 
     # async def send_system_prompt(self) -> AsyncIterable[str]:
     #     """Send the system prompt to the chat and generate a streamed response
@@ -64,11 +68,12 @@ class LolaPlugin:
     #         yield text
 
     async def add_message(
-        self, message: str
+        self, message: str, sentences=False
     ) -> AsyncIterable[str]:
         """Add a message to the chat and generate a streamed response
         Args:
             message (ChatGPTMessage): The message to add
+            sentences: stream whole sentences instead of deltas (for TTS), True or the language ("en", "es")
         Returns:
             AsyncIterable[str]: Streamed ChatGPT response
         """
@@ -81,54 +86,32 @@ class LolaPlugin:
                     init_state=self.init_state
                     )        
 
-        async for text in self.handle_lola_stream(job):
+        async for text in self.handle_lola_stream(job, sentences):
             yield text
 
 
 
-    async def handle_lola_stream(self, job) -> AsyncIterable[str]:
+    async def handle_lola_stream(self, job, sentences=False) -> AsyncIterable[str]:
         """Handle a Lola stream """
 
-        self._producing_response = True
-        complete_content = ""
-        async for delta_dict in self.agent.process(job):
+        session = self._session = StreamSession(self.lead)
+        session.started()
+        try:
+            async for text in self._handle_lola_stream(job, session, sentences):
+                yield text
+        finally:
+            session.finished()
+
+    async def _handle_lola_stream(self, job, session: StreamSession, sentences=False) -> AsyncIterable[str]:
+        # function calls are answered with on_function_call until the model answers with text
+        async for delta_dict in self.agent.respond(job, self.on_function_call, session=session, sentences=sentences):
             content = delta_dict.get("content")
-            function_call = delta_dict.get("function_call")
-
             if content:
-                complete_content += content
                 yield content
 
-        # There was a function call?
-        if function_call:
-            self.agent.add_function_call_message(self.lead, function_call)
-
-            # TODO: process function call
-            self.agent.add_function_response_message(self.lead, function_call, "BTC price is $50,000")
-
-            if self.on_function_call:
-                function_response = self.on_function_call(self.lead, function_call.get("name"), function_call.get("arguments"))
-            # self.agent.add_function_response_message(self.lead, function_call, function_response)            
-
-            # clone job dataclass instance, remove message
-            new_job = AgentJob(
-                job_id=job.job_id, 
-                lead=job.lead, 
-                prompt=job.prompt, 
-                message=None, 
-                init_state=job.init_state)
-            
-            complete_content = ''
-            async for delta in self.agent.process(new_job):
-                content = delta.get("content")
-                if content:
-                    complete_content += content
-                    yield content
-
 
         # add assistant response message
         # self.agent.add_assistant_message(self.lead, complete_content)
-        self._producing_response = False
 
 
 if __name__ == "__main__":
@@ -151,9 +134,13 @@ if __name__ == "__main__":
         </function>
     """
 
+    def on_function_call(lead, function_name, function_arguments):
+        print(">>>>>> ",function_name)
+        return f"The Bitcoin price is $1000"
+
     log.info("Starting Lola Plugin")
 
-    lola = LolaPlugin("123", prompt, OPENAI_API_KEY)
+    lola = LolaPlugin("123", prompt, OPENAI_API_KEY, on_function_call=on_function_call)
 
     lola.agent.clear_history(lola.lead)
 
@@ -11,4 +11,6 @@ class AgentJob:
         self.message = message
         self.prompt = prompt or DEFAULT_PROMPT
         self.init_state = init_state
-        self.new_state = new_state
\ No newline at end of file
+        self.new_state = new_state
+        # TokenSplit of the last request sent for the job, set by LolaAgent.request_stream
+        self.tokens = None
\ No newline at end of file
@@ -0,0 +1,163 @@
+import asyncio
+import threading
+import httpx
+import openai
+from loguru import logger as log
+
+try:
+    import h2  # noqa: F401 needed by httpx for HTTP/2
+except ImportError:
+    h2 = None
+
+DEFAULT_MAX_CONNECTIONS = 100
+DEFAULT_MAX_KEEPALIVE_CONNECTIONS = 20
+DEFAULT_KEEPALIVE_EXPIRY = 60.0
+DEFAULT_TIMEOUT = 600.0
+DEFAULT_CONNECT_TIMEOUT = 5.0
+
+
+class OpenAIClientRegistry:
+    """Process wide AsyncOpenAI clients keyed by API key and base URL.
+
+    Every LolaAgent with the same credentials shares one client, and so one httpx connection pool
+    with warm keep-alive connections, instead of opening a pool per user.
+    httpx connections are bound to the event loop that opened them, so there is one client per running loop
+    and the clients of closed loops are dropped.
+    """
+
+    def __init__(self,
+                 max_connections=DEFAULT_MAX_CONNECTIONS,
+                 max_keepalive_connections=DEFAULT_MAX_KEEPALIVE_CONNECTIONS,
+                 keepalive_expiry=DEFAULT_KEEPALIVE_EXPIRY,
+                 http2=False,
+                 timeout=DEFAULT_TIMEOUT,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT):
+        self._clients = {}
+        # httpx client under each AsyncOpenAI client, used by warm_up
+        self._http_clients = {}
+        self._lock = threading.Lock()
+        self.configure(max_connections=max_connections,
+                       max_keepalive_connections=max_keepalive_connections,
+                       keepalive_expiry=keepalive_expiry,
+                       http2=http2,
+                       timeout=timeout,
+                       connect_timeout=connect_timeout)
+
+    def configure(self,
+                  max_connections=None,
+                  max_keepalive_connections=None,
+                  keepalive_expiry=None,
+                  http2=None,
+                  timeout=None,
+                  connect_timeout=None):
+        """Changes the pool settings, they apply to the clients created from now on.
+        Call it at startup, before the first request."""
+        if max_connections is not None:
+            self.max_connections = max_connections
+        if max_keepalive_connections is not None:
+            self.max_keepalive_connections = max_keepalive_connections
+        if keepalive_expiry is not None:
+            self.keepalive_expiry = keepalive_expiry
+        if http2 is not None:
+            if http2 and h2 is None:
+                log.warning("HTTP/2 needs the h2 package (pip install httpx[http2]), using HTTP/1.1")
+                http2 = False
+            self.http2 = http2
+        if timeout is not None:
+            self.timeout = timeout
+        if connect_timeout is not None:
+            self.connect_timeout = connect_timeout
+
+    def get(self, api_key, base_url=None) -> openai.AsyncOpenAI:
+        """The shared client for api_key and base_url on the running loop"""
+        loop = asyncio.get_running_loop()
+        key = (api_key, base_url, loop)
+        client = self._clients.get(key)
+        if client is not None:
+            return client
+
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                self._clients = {k: c for k, c in self._clients.items() if not k[2].is_closed()}
+                self._http_clients = {k: c for k, c in self._http_clients.items() if k in self._clients}
+                http_client = self._create_http_client()
+                client = openai.AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client)
+                self._clients[key] = client
+                self._http_clients[key] = http_client
+        return client
+
+    def _create_http_client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive_connections,
+                keepalive_expiry=self.keepalive_expiry,
+            ),
+            timeout=httpx.Timeout(self.timeout, connect=self.connect_timeout),
+            http2=self.http2,
+        )
+
+    async def warm_up(self, api_key, base_url=None, connections=1):
+        """Opens connections (DNS, TCP and TLS handshakes) on the running loop before traffic arrives.
+        With HTTP/2 a single connection carries every concurrent request."""
+        client = self.get(api_key, base_url)
+        http_client = self._http_clients[(api_key, base_url, asyncio.get_running_loop())]
+        if self.http2:
+            connections = 1
+        url = str(client.base_url)
+
+        async def touch():
+            try:
+                # any reply will do, the connection stays in the pool for the next request
+                await http_client.head(url)
+            except httpx.HTTPError as e:
+                log.warning(f"OpenAI warm up failed: {e}")
+
+        start = asyncio.get_running_loop().time()
+        await asyncio.gather(*[touch() for _ in range(connections)])
+        log.info(f"OpenAI warm up: {connections} connection(s) to {url} in {asyncio.get_running_loop().time() - start:.3f}s")
+
+    async def aclose(self):
+        """Closes the clients of the running loop"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            keys = [k for k in self._clients if k[2] is loop]
+            clients = [self._clients.pop(k) for k in keys]
+            for k in keys:
+                self._http_clients.pop(k, None)
+        for client in clients:
+            await client.close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'clients': len(self._clients),
+                'max_connections': self.max_connections,
+                'max_keepalive_connections': self.max_keepalive_connections,
+                'keepalive_expiry': self.keepalive_expiry,
+                'http2': self.http2,
+            }
+
+
+# process wide registry used by LolaAgent
+openai_clients = OpenAIClientRegistry()
+
+
+def configure_openai_clients(**options):
+    openai_clients.configure(**options)
+
+
+if __name__ == "__main__":
+    import os
+    from dotenv import load_dotenv
+    load_dotenv(dotenv_path="./example/.env")
+
+    async def main():
+        api_key = os.getenv("OPENAI_API_KEY")
+        await openai_clients.warm_up(api_key, connections=2)
+        print(openai_clients.get(api_key) is openai_clients.get(api_key))
+        print(openai_clients.stats())
+        await openai_clients.aclose()
+
+    asyncio.run(main())
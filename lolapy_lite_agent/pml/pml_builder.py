@@ -3,11 +3,28 @@ import re
 from bs4 import BeautifulSoup
 from typing import List, Dict, Any, Optional
 from bs4 import Comment
+from lolapy_lite_agent.pml.pml_engine import PMLEngine, PMLFallback
+
+
+def prepare_text(text: str):
+    text = re.sub(r'<!--[\s\S]*?-->', '', text)
+    text = re.sub(r'(\r\n|\r|\n){2,}', '$1', text)
+    text = re.sub(r'<br\s*\/?>', '\n', text)
+    text = text.strip()
+    return text
+
 
 class PMLBuilder:
-    def __init__(self, pml: str):
+    def __init__(self, pml: str, engine: str = "fast"):
+        """
+        Args:
+            pml (str): rendered PML
+            engine (str): "fast" compiles with the single pass PMLEngine and only falls back to the
+                BeautifulSoup DOM when the markup needs it, "bs4" always uses the DOM
+        """
         self.hpml = pml
-        self.root = BeautifulSoup(pml, 'lxml')
+        self.engine = engine
+        self._root = None
         self.params = []
         self.settings = {}
         self.parser_settings = {'recognizeSelfClosing': False, 'xmlMode': True, 'decodeEntities': False}
@@ -20,6 +37,13 @@ class PMLBuilder:
         ]
         self.plugins = []
 
+    @property
+    def root(self):
+        # the DOM is only built when the BeautifulSoup path is used
+        if self._root is None:
+            self._root = BeautifulSoup(self.hpml, 'lxml')
+        return self._root
+
     def set_params(self, params: Optional[List[Dict[str, Any]]]):
         self.params = params or []
 
@@ -50,11 +74,7 @@ class PMLBuilder:
             comment.extract()
 
     def prepare_text(self, text: str):
-        text = re.sub(r'<!--[\s\S]*?-->', '', text)
-        text = re.sub(r'(\r\n|\r|\n){2,}', '$1', text)
-        text = re.sub(r'<br\s*\/?>', '\n', text)
-        text = text.strip()
-        return text
+        return prepare_text(text)
 
     def process_plugins(self):
         for plugin in self.plugins:
@@ -72,6 +92,39 @@ class PMLBuilder:
         self.plugins.append(plugin)
 
     def compile(self):
+        if self.engine == "fast":
+            try:
+                return self.compile_fast()
+            except PMLFallback:
+                pass
+        return self.compile_dom()
+
+    def compile_fast(self):
+        """Compiles in a single pass over the source, raises PMLFallback when the markup is not supported"""
+        try:
+            res = PMLEngine(self.system_tags, self.plugins, self).compile(self.hpml)
+            self.settings = res['settings']
+            return {
+                'prompt': self.prepare_text(res['text']),
+                'params': {},
+                'settings': self.settings
+            }
+        except PMLFallback:
+            raise
+        except Exception as e:
+            print(e)
+            return {
+                'error': str(e)
+            }
+
+    def compile_segments(self, marker):
+        """Compiles a PML holding placeholders for the dynamic parts of its template, see PMLEngine.compile_segments.
+        Raises PMLFallback when the markup is not supported, prepare_text() is left to the caller"""
+        res = PMLEngine(self.system_tags, self.plugins, self, marker=marker).compile_segments(self.hpml)
+        self.settings = res['settings']
+        return res
+
+    def compile_dom(self):
         try:
             self.load_settings()
             self.remove_system_tags()
@@ -0,0 +1,639 @@
+import re
+from html import unescape
+from html.entities import html5
+from typing import Any, Dict, List, Pattern
+
+
+# The engine reproduces what BeautifulSoup(pml, 'lxml').get_text() returned for PMLBuilder,
+# that is libxml2's HTML tokenizer and tree rules plus BeautifulSoup's string handling.
+# Constructs it does not model raise PMLFallback so PMLBuilder can use the DOM path instead.
+
+class PMLFallback(Exception):
+    """The PML uses markup the fast engine does not reproduce exactly"""
+
+
+class PMLText(str):
+    """Text node handed to plugins, name is None like a bs4 NavigableString"""
+    name = None
+
+
+class PMLRawText(PMLText):
+    """Content of <script>/<style>, kept as a child but never part of the prompt text"""
+
+
+class PMLDynamicText:
+    """Text run holding the output of dynamic template chunks, parts are strings and chunk indexes.
+    The text is rebuilt on every turn from the chunk outputs, the rest of the document is static.
+    A run opening the body (leading) keeps its leading blanks as a text node of their own."""
+    __slots__ = ('parts', 'leading')
+
+    def __init__(self, parts: List[Any], leading=False):
+        self.parts = parts
+        self.leading = leading
+
+    def render(self, values: List[str]) -> str:
+        text = ''.join(values[p] if isinstance(p, int) else p for p in self.parts)
+        text = _normalize(text)
+        if '&' in text:
+            text = unescape(text)
+        if self.leading:
+            blanks = _BLANKS.match(text).end()
+            if blanks:
+                return _blank_node(text[:blanks]) + text[blanks:]
+        if text and _BLANK.match(text):
+            text = _blank_node(text)
+        return text
+
+
+class PMLElement:
+    """Minimal element handed to plugins in place of a bs4 Tag"""
+    __slots__ = ('name', 'attrs', 'children', 'parent', 'replacement')
+
+    def __init__(self, name: str, attrs: Dict[str, Any], parent: 'PMLElement' = None):
+        self.name = name
+        self.attrs = attrs
+        self.children = []
+        self.parent = parent
+        self.replacement = None
+
+    @property
+    def contents(self):
+        return self.children
+
+    @property
+    def string(self):
+        # same semantics as bs4 Tag.string
+        if len(self.children) != 1:
+            return None
+        child = self.children[0]
+        if isinstance(child, PMLText):
+            return child
+        return child.string
+
+    def find_all(self, name: str):
+        """Elements called name in this subtree (self included), in document order,
+        skipping subtrees already replaced by a plugin"""
+        found = []
+        stack = [self]
+        while stack:
+            element = stack.pop()
+            if element.replacement is not None:
+                continue
+            if element.name == name:
+                found.append(element)
+            stack.extend(c for c in reversed(element.children) if isinstance(c, PMLElement))
+        return found
+
+    def get_text(self):
+        if self.replacement is not None:
+            return self.replacement
+        parts = []
+        for child in self.children:
+            if isinstance(child, PMLElement):
+                parts.append(child.get_text())
+            elif not isinstance(child, PMLRawText):
+                parts.append(child)
+        return ''.join(parts)
+
+
+# libxml2 element tables ----------------------------------------------------------------
+
+VOID_ELEMENTS = frozenset([
+    'area', 'base', 'basefont', 'br', 'col', 'frame', 'hr', 'img', 'input', 'isindex', 'link', 'meta', 'param',
+])
+
+# raw text elements, their content is never part of get_text()
+RAW_TEXT_ELEMENTS = frozenset(['script', 'style'])
+
+HEAD_ELEMENTS = frozenset(['script', 'style', 'meta', 'link', 'base'])
+
+# elements that open the body when they appear at the top of the document head,
+# any other element (all PML tags included) stays inside the head
+BODY_START_ELEMENTS = frozenset([
+    'a', 'abbr', 'acronym', 'address', 'b', 'bdo', 'big', 'blockquote', 'br', 'center', 'cite', 'code', 'dd',
+    'dfn', 'dir', 'div', 'dl', 'dt', 'em', 'fieldset', 'font', 'form', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+    'hr', 'i', 'img', 'kbd', 'li', 'map', 'menu', 'ol', 'p', 'q', 's', 'samp', 'small', 'span', 'strike',
+    'strong', 'sub', 'sup', 'table', 'tt', 'u', 'ul', 'var',
+])
+
+# elements whose parsing rules (rcdata, whitespace preservation, document structure) are not reproduced
+UNSUPPORTED_ELEMENTS = frozenset([
+    'html', 'head', 'body', 'frameset', 'title', 'textarea', 'pre', 'listing', 'xmp', 'plaintext',
+    'iframe', 'noembed', 'noframes', 'template', 'svg', 'math', 'select', 'option', 'optgroup',
+])
+
+# new start tag -> open elements it implicitly closes (only checked against the current element)
+START_CLOSE = {
+    'a': {'a'},
+    'address': {'p', 'ul'},
+    'blockquote': {'p'},
+    'caption': {'p'},
+    'center': {'b', 'font', 'i', 'p'},
+    'colgroup': {'caption', 'colgroup', 'p'},
+    'dd': {'address', 'dir', 'dt', 'listing', 'menu', 'p', 'pre'},
+    'dir': {'p'},
+    'div': {'p'},
+    'dl': {'address', 'dir', 'dt', 'listing', 'menu', 'p', 'pre'},
+    'dt': {'address', 'dd', 'dir', 'listing', 'menu', 'p', 'pre'},
+    'fieldset': {'a', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'legend', 'listing', 'p', 'pre'},
+    'form': {'address', 'dir', 'dl', 'form', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'listing', 'menu', 'ol', 'p', 'pre', 'ul'},
+    'h1': {'p'}, 'h2': {'p'}, 'h3': {'p'}, 'h4': {'p'}, 'h5': {'p'}, 'h6': {'p'},
+    'li': {'address', 'dl', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'li', 'listing', 'p', 'pre'},
+    'menu': {'p', 'ul'},
+    'ol': {'p'},
+    'p': {'b', 'big', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'i', 'p', 's', 'small', 'strike', 'tt', 'u'},
+    'table': {'a', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'listing', 'p', 'pre'},
+    'tbody': {'caption', 'colgroup', 'p', 'tbody', 'td', 'tfoot', 'th', 'thead', 'tr'},
+    'td': {'a', 'b', 'font', 'i', 'p', 'span', 'td', 'th', 'u'},
+    'tfoot': {'caption', 'colgroup', 'p', 'tbody', 'td', 'th', 'thead', 'tr'},
+    'th': {'a', 'b', 'font', 'i', 'p', 'span', 'td', 'th', 'u'},
+    'thead': {'caption', 'colgroup'},
+    'tr': {'caption', 'colgroup', 'p', 'td', 'th', 'tr'},
+    'ul': {'address', 'dir', 'listing', 'menu', 'p', 'pre'},
+}
+
+# an end tag does not close open elements with a higher priority than its own
+END_PRIORITY = {
+    'div': 150, 'td': 160, 'th': 160, 'tr': 170, 'thead': 180, 'tbody': 180, 'tfoot': 180, 'table': 190,
+}
+DEFAULT_END_PRIORITY = 100
+
+# bs4 splits these attributes into lists (HTMLTreeBuilder.DEFAULT_CDATA_LIST_ATTRIBUTES)
+CDATA_LIST_ATTRIBUTES = {
+    '*': ('class', 'accesskey', 'dropzone'),
+    'a': ('rel', 'rev'),
+    'link': ('rel', 'rev'),
+    'td': ('headers',),
+    'th': ('headers',),
+    'form': ('accept-charset',),
+    'object': ('archive',),
+    'area': ('rel',),
+    'icon': ('sizes',),
+    'iframe': ('sandbox',),
+    'output': ('for',),
+}
+
+# tokenizer -------------------------------------------------------------------------------
+
+_WS = re.compile(r'[\t\n\f ]*')
+_BLANKS = re.compile(r'[\t\n ]*')
+_TAG_NAME = re.compile(r'[a-zA-Z][^\t\n\f />]*')
+_ATTR_NAME = re.compile(r'[^\t\n\f />][^\t\n\f /=>]*')
+_UNQUOTED_VALUE = re.compile(r'[^\t\n\f >]*')
+_CHARREF = re.compile(r'&(#[0-9]+;?|#[xX][0-9a-fA-F]+;?|[^\t\n\f <&#;]{1,32};?)')
+_BLANK = re.compile(r'[ \t\n\r\f]*\Z')
+_NONWHITESPACE = re.compile(r'\S+')
+
+
+def _blank_node(text: str) -> str:
+    # bs4 replaces whitespace-only strings by a single newline or space
+    return '\n' if '\n' in text else ' '
+
+
+def _normalize(text: str) -> str:
+    return text.replace('\r\n', '\n').replace('\r', '\n').replace('\x00', '\ufffd')
+
+
+def _attr_charref(match):
+    ref = match.group(1)
+    if ref[0] != '#' and not ref.endswith(';'):
+        # a legacy reference without ';' followed by an alphanumeric or '=' is not decoded inside attributes
+        for k in range(len(ref) - 1, 0, -1):
+            if ref[:k] in html5:
+                if ref[k].isascii() and (ref[k].isalnum() or ref[k] == '='):
+                    return match.group(0)
+                break
+    return unescape(match.group(0))
+
+
+def _unescape_attr(value: str) -> str:
+    if '&' not in value:
+        return value
+    return _CHARREF.sub(_attr_charref, value)
+
+
+class _EndOfInput(Exception):
+    pass
+
+
+# document insertion modes
+_PROLOG, _HEAD, _BODY = 0, 1, 2
+
+
+class PMLEngine:
+    """Single pass PML compiler: extracts settings, drops system tags and comments and dispatches plugin
+    elements while scanning the source once, without building a DOM for the whole document.
+    """
+
+    def __init__(self, system_tags: List[str], plugins: List[Any] = None, builder: Any = None,
+                 marker: Pattern = None):
+        """
+        Args:
+            marker: regex with one group matching the placeholders left by the dynamic chunks of a
+                template, see compile_segments()
+        """
+        self.system_tags = frozenset(system_tags)
+        self.plugins = plugins or []
+        self.plugin_elements = frozenset(p.element_name for p in self.plugins)
+        self.builder = builder
+        self.marker = marker
+
+    def compile(self, pml: str) -> Dict[str, Any]:
+        """Returns the settings and the prompt text before prepare_text()"""
+        self._reset(pml)
+        self._scan()
+        self._process_plugins()
+        text = ''.join(o if isinstance(o, str) else o.get_text() for o in self._output)
+        return {
+            'text': text,
+            'settings': self._settings if self._settings is not None else {},
+        }
+
+    def compile_segments(self, pml: str) -> Dict[str, Any]:
+        """Same as compile() but the text runs holding placeholders are returned as PMLDynamicText
+        segments between the static text. Placeholders found anywhere else (attributes, comments,
+        system tags, plugin elements) are left out of the segments, callers must check that every
+        placeholder made it to one or to 'dropped', the placeholders whose text never reaches the output:
+        quoted attribute values nobody reads ('attr') and text inside system tags ('text')."""
+        self._reset(pml)
+        self._scan()
+        self._process_plugins()
+        segments = []
+        for o in self._output:
+            if isinstance(o, PMLDynamicText):
+                segments.append(o)
+                continue
+            text = o if isinstance(o, str) else o.get_text()
+            if segments and isinstance(segments[-1], str):
+                segments[-1] += text
+            else:
+                segments.append(text)
+        return {
+            'segments': segments,
+            'settings': self._settings if self._settings is not None else {},
+            'dropped': self._dropped,
+        }
+
+    # state
+
+    def _reset(self, pml: str):
+        src = _normalize(pml)
+        if src.startswith('\ufeff'):
+            src = src[1:]
+        self._src = src
+        self._output = []
+        self._roots = []
+        self._settings = None
+        self._pending = []
+        # open elements: [name, removed, node]
+        self._stack = []
+        self._removed = 0
+        self._capture = None
+        self._mode = _PROLOG
+        # only comments seen so far, libxml2 skips the blanks that follow them
+        self._prolog = True
+        # placeholders found where their text is discarded
+        self._dropped = {}
+
+    # scanner
+
+    def _scan(self):
+        src = self._src
+        n = len(src)
+        # libxml2 skips blanks at the beginning of the document
+        pos = _BLANKS.match(src).end()
+
+        while pos < n:
+            lt = src.find('<', pos)
+            if lt < 0:
+                self._pending.append(src[pos:])
+                self._prolog = False
+                break
+            if lt > pos:
+                self._pending.append(src[pos:lt])
+                self._prolog = False
+            try:
+                pos = self._markup(lt)
+            except _EndOfInput:
+                # an unterminated tag swallows the rest of the document
+                break
+
+        self._flush()
+        while self._stack:
+            self._pop()
+
+    def _markup(self, lt: int) -> int:
+        src = self._src
+        n = len(src)
+        nxt = src[lt + 1] if lt + 1 < n else ''
+
+        if nxt == '!' and src.startswith('--', lt + 2):
+            return self._comment(lt + 4)
+
+        if nxt == '?':
+            # processing instruction, parsed as a bogus comment
+            return self._comment_until(src.find('>', lt + 2), self._prolog)
+
+        self._prolog = False
+
+        if nxt.isascii() and nxt.isalpha():
+            return self._start_tag(lt)
+
+        if nxt == '/':
+            c = src[lt + 2] if lt + 2 < n else ''
+            if c.isascii() and c.isalpha():
+                m = _TAG_NAME.match(src, lt + 2)
+                end = src.find('>', m.end())
+                if end < 0:
+                    raise _EndOfInput()
+                self._end_tag(m.group().lower())
+                return end + 1
+            if c == '>':
+                return lt + 3
+            if c == '':
+                self._pending.append('</')
+                return n
+            # bogus comment
+            return self._comment_until(src.find('>', lt + 2))
+
+        if nxt == '!':
+            # doctype, cdata and other declarations are not reproduced
+            raise PMLFallback('markup declaration')
+
+        # not markup, a literal '<'
+        self._pending.append('<')
+        return lt + 1
+
+    def _comment(self, start: int) -> int:
+        src = self._src
+        skip = self._prolog
+        if src.startswith('>', start):
+            return self._comment_until(start, skip)
+        if src.startswith('->', start):
+            return self._comment_until(start + 1, skip)
+        end = src.find('--', start)
+        while end >= 0:
+            if src.startswith('>', end + 2):
+                return self._comment_until(end + 2, skip)
+            if src.startswith('!>', end + 2):
+                return self._comment_until(end + 3, skip)
+            end = src.find('--', end + 1)
+        return self._comment_until(-1, skip)
+
+    def _comment_until(self, end: int, skip_blanks: bool = False) -> int:
+        # comments are dropped from the output, they only end the current text node
+        self._flush()
+        if end < 0:
+            return len(self._src)
+        if skip_blanks:
+            return _BLANKS.match(self._src, end + 1).end()
+        return end + 1
+
+    def _start_tag(self, lt: int) -> int:
+        src = self._src
+        n = len(src)
+        m = _TAG_NAME.match(src, lt + 1)
+        name = m.group().lower()
+        pos = m.end()
+        attrs = {}
+        self_closing = False
+        marked = []
+
+        while True:
+            pos = _WS.match(src, pos).end()
+            if pos >= n:
+                raise _EndOfInput()
+            c = src[pos]
+            if c == '>':
+                pos += 1
+                break
+            if c == '/':
+                if src.startswith('>', pos + 1):
+                    self_closing = True
+                    pos += 2
+                    break
+                pos += 1
+                continue
+            m = _ATTR_NAME.match(src, pos)
+            attr = m.group().lower()
+            pos = _WS.match(src, m.end()).end()
+            value = ''
+            if pos < n and src[pos] == '=':
+                pos = _WS.match(src, pos + 1).end()
+                if pos >= n:
+                    raise _EndOfInput()
+                c = src[pos]
+                if c == '"' or c == "'":
+                    end = src.find(c, pos + 1)
+                    if end < 0:
+                        raise _EndOfInput()
+                    value = src[pos + 1:end]
+                    pos = end + 1
+                    if self.marker is not None:
+                        marked.extend(int(i) for i in self.marker.findall(value))
+                elif c != '>':
+                    m = _UNQUOTED_VALUE.match(src, pos)
+                    value = m.group()
+                    pos = m.end()
+                value = _unescape_attr(value)
+            if attr not in attrs:
+                attrs[attr] = value
+
+        if name in UNSUPPORTED_ELEMENTS:
+            raise PMLFallback(f'<{name}> element')
+
+        self._flush()
+        attrs = self._cdata_lists(name, attrs)
+        self._open(name, attrs)
+        if marked and attrs is not self._settings and self._stack[-1][2] is None:
+            # neither the settings nor an element handed to a plugin, nobody reads these attributes
+            self._dropped.update((i, 'attr') for i in marked)
+
+        if name in VOID_ELEMENTS or self_closing:
+            self._pop()
+            return pos
+
+        if name in RAW_TEXT_ELEMENTS:
+            return self._raw_text(name, pos)
+
+        return pos
+
+    def _raw_text(self, name: str, pos: int) -> int:
+        src = self._src
+        lowered = src.lower()
+        end = lowered.find('</' + name, pos)
+        while end >= 0 and end + len(name) + 2 < len(src) and src[end + len(name) + 2] not in '\t\n\f />':
+            end = lowered.find('</' + name, end + 1)
+        content = src[pos:end] if end >= 0 else src[pos:]
+        if name == 'script' and '<!--' in content:
+            raise PMLFallback('escaped script content')
+        if content and self._capture is not None and not self._removed:
+            self._capture.children.append(PMLRawText(content))
+        if end < 0:
+            self._pop()
+            return len(src)
+        close = src.find('>', end)
+        if close < 0:
+            raise _EndOfInput()
+        self._pop()
+        return close + 1
+
+    def _end_tag(self, name: str):
+        stack = self._stack
+        priority = END_PRIORITY.get(name, DEFAULT_END_PRIORITY)
+        for i in range(len(stack) - 1, -1, -1):
+            if stack[i][0] == name:
+                break
+            if END_PRIORITY.get(stack[i][0], DEFAULT_END_PRIORITY) > priority:
+                return
+        else:
+            # not open, ignored without ending the current text node
+            return
+        self._flush()
+        while len(stack) > i:
+            self._pop()
+
+    def _cdata_lists(self, name: str, attrs: Dict[str, str]):
+        for attr in CDATA_LIST_ATTRIBUTES['*'] + CDATA_LIST_ATTRIBUTES.get(name, ()):
+            if attr in attrs:
+                attrs[attr] = _NONWHITESPACE.findall(attrs[attr])
+        return attrs
+
+    # tree
+
+    def _open(self, name: str, attrs: Dict[str, Any]):
+        stack = self._stack
+        closes = START_CLOSE.get(name)
+        if closes:
+            while stack and stack[-1][0] in closes:
+                self._pop()
+
+        if self._mode == _PROLOG:
+            self._mode = _HEAD if name in HEAD_ELEMENTS else _BODY
+        elif self._mode == _HEAD and not stack and name in BODY_START_ELEMENTS:
+            self._mode = _BODY
+
+        if name == 'settings' and self._settings is None:
+            self._settings = attrs
+
+        removed = name in self.system_tags
+        node = None
+        if not self._removed and not removed:
+            if self._capture is not None:
+                node = PMLElement(name, attrs, self._capture)
+                self._capture.children.append(node)
+                self._capture = node
+            elif name in self.plugin_elements:
+                node = PMLElement(name, attrs)
+                self._roots.append(node)
+                self._output.append(node)
+                self._capture = node
+
+        if removed:
+            self._removed += 1
+        stack.append((name, removed, node))
+
+    def _pop(self):
+        name, removed, node = self._stack.pop()
+        if removed:
+            self._removed -= 1
+        if node is not None:
+            self._capture = node.parent
+
+    def _flush(self):
+        if not self._pending:
+            return
+        text = ''.join(self._pending)
+        self._pending = []
+        if self.marker is not None and self._removed:
+            # text inside system tags never changes the structure and is discarded
+            self._dropped.update((int(i), 'text') for i in self.marker.findall(text))
+            return
+        if self.marker is not None and self._capture is None:
+            parts = self.marker.split(text)
+            leading = False
+            if len(parts) > 1 and self._mode != _BODY and not self._stack:
+                # text at the top of the document opens the body when it isn't blank, known before
+                # the chunks are rendered when its static text isn't blank
+                literal = ''.join(parts[0::2])
+                if '&' in literal:
+                    literal = unescape(literal)
+                if _BLANKS.match(literal).end() < len(literal):
+                    self._mode = _BODY
+                    leading = True
+            if len(parts) > 1 and self._mode == _BODY:
+                # in the body, outside of any removed or plugin element, text can never change the document
+                # structure so the run is left to be rendered on each turn
+                parts[1::2] = [int(p) for p in parts[1::2]]
+                self._output.append(PMLDynamicText(parts, leading))
+                return
+        if '&' in text:
+            text = unescape(text)
+
+        if self._mode != _BODY and not self._stack:
+            # text at the top of the document: leading blanks are a text node of their own
+            # and the rest of the text opens the body
+            blanks = _BLANKS.match(text).end()
+            if blanks < len(text):
+                if blanks:
+                    self._add_text(text[:blanks])
+                    text = text[blanks:]
+                self._mode = _BODY
+        self._add_text(text)
+
+    def _add_text(self, text: str):
+        if _BLANK.match(text):
+            text = _blank_node(text)
+
+        if self._removed:
+            return
+        if self._capture is not None:
+            self._capture.children.append(PMLText(text))
+        else:
+            self._output.append(text)
+
+    # plugins
+
+    def _process_plugins(self):
+        for plugin in self.plugins:
+            elements = []
+            for root in self._roots:
+                elements.extend(root.find_all(plugin.element_name))
+            for element in elements:
+                try:
+                    res = plugin.process(element, element.attrs, element.string, self.builder)
+                    # the element is replaced by the result, a plugin returning None just removes it
+                    if res is None:
+                        element.replacement = ''
+                        if element.parent is not None:
+                            element.parent.children.remove(element)
+                    else:
+                        element.replacement = res if isinstance(res, str) else str(res)
+                except Exception as e:
+                    print(e)
+
+
+if __name__ == "__main__":
+    import io
+    import time
+    from contextlib import redirect_stdout
+    from lolapy_lite_agent.pml.pml_builder import PMLBuilder
+    from lolapy_lite_agent.pml.function_plugin import PmlFunctionsPlugin
+
+    with open("lolapy_lite_agent/pml/sample_prompt.pml", "r") as f:
+        pml = f.read()
+
+    def compile_with(engine, source):
+        builder = PMLBuilder(source, engine=engine)
+        builder.register_plugin(PmlFunctionsPlugin(None, lambda func: None))
+        # bs4 prints an error for every plugin returning None
+        with redirect_stdout(io.StringIO()):
+            return builder.compile()
+
+    for label, source in [('sample', pml), ('sample x50', pml * 50)]:
+        assert compile_with("bs4", source) == compile_with("fast", source)
+        for engine in ["bs4", "fast"]:
+            start = time.time()
+            for i in range(100):
+                compile_with(engine, source)
+            print(f"{label} {engine} x100: {time.time() - start:.4f}s")
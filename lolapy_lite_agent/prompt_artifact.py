@@ -0,0 +1,255 @@
+import re
+from typing import List, Union
+from pybars import Compiler
+from lolapy_lite_agent.handlebars_helpers import get_helpers
+from lolapy_lite_agent.pml.function_plugin import PmlFunctionsPlugin
+from lolapy_lite_agent.pml.pml_builder import PMLBuilder, prepare_text
+from lolapy_lite_agent.pml.pml_engine import PMLDynamicText, PMLFallback
+from lolapy_lite_agent.template_cache import TemplateCache, compile_handlebars, release_template
+from lolapy_lite_agent.template_dependencies import analyze_template
+
+_MUSTACHE = re.compile(r'\{\{\{[\s\S]*?\}\}\}|\{\{[\s\S]*?\}\}')
+# partials, raw blocks and escaped mustaches are rendered with the whole template
+_UNSPLITTABLE = re.compile(r'\{\{\{\{|\{\{#?>|\{\{#\*|\\\{\{')
+# placeholders standing for the dynamic chunks while the static PML is compiled
+_MARKER = re.compile('\ue000([0-9]+)\ue001')
+_MARKER_CHARS = re.compile('[\ue000\ue001]')
+
+
+class _ChunkCompiler(Compiler):
+    # chunks are cut from a source already processed by whitespace_control(),
+    # running it again on a chunk would strip lines that are no longer standalone
+    def whitespace_control(self, source):
+        return source
+
+
+_chunk_compiler = _ChunkCompiler()
+
+
+def _tag_kind(tag: str) -> str:
+    if tag.startswith('{{{'):
+        return 'raw'
+    inner = tag[2:-2].strip()
+    if inner.startswith('!'):
+        return 'comment'
+    if inner.startswith('#') or (inner.startswith('^') and inner[1:].strip()):
+        return 'open'
+    if inner.startswith('/'):
+        return 'close'
+    if inner.startswith('&'):
+        return 'raw'
+    return 'expand'
+
+
+class TemplateChunk:
+    """Part of a template that depends on the render context"""
+    __slots__ = ('source', 'template', 'text_only', 'attr_safe')
+
+    def __init__(self, source: str, template=None):
+        self.source = source
+        self.template = template or _chunk_compiler.compile(source)
+        # escaped expressions can't produce markup or quotes, so unless its own literal text has some
+        # the chunk only ever renders text, or stays inside a quoted attribute value
+        literal = _MUSTACHE.sub('', source)
+        escaped = all(_tag_kind(t) != 'raw' for t in _MUSTACHE.findall(source))
+        self.text_only = escaped and '<' not in literal
+        self.attr_safe = escaped and '"' not in literal and "'" not in literal
+
+    def render(self, ctx) -> str:
+        return str(self.template(ctx, helpers=get_helpers()))
+
+
+def split_template(source: str) -> List[Union[str, TemplateChunk]]:
+    """Splits a handlebars template into static text and chunks holding one top level expression,
+    section or comment each, rendering the chunks one by one gives the same output as the whole template.
+
+    pybars resolves whitespace control and standalone lines with a regex pass over the source before
+    parsing it, the split is made on the processed source so each chunk keeps the whitespace it had.
+    """
+    # compiling the whole template first raises the same errors as before for invalid templates
+    whole = [TemplateChunk(source, compile_handlebars(source))]
+    if _UNSPLITTABLE.search(source):
+        return whole
+
+    processed = Compiler.whitespace_control(_chunk_compiler, source)
+    spans = []
+    depth = 0
+    block_start = 0
+    for m in _MUSTACHE.finditer(processed):
+        kind = _tag_kind(m.group())
+        if kind == 'open':
+            if depth == 0:
+                block_start = m.start()
+            depth += 1
+        elif kind == 'close':
+            depth -= 1
+            if depth < 0:
+                return whole
+            if depth == 0:
+                spans.append((block_start, m.end()))
+        elif depth == 0:
+            spans.append((m.start(), m.end()))
+    if depth != 0:
+        return whole
+
+    chunks = []
+    pos = 0
+    try:
+        for start, end in spans:
+            if start > pos:
+                chunks.append(processed[pos:start])
+            # comments render nothing
+            if not processed.startswith('{{!', start):
+                chunks.append(TemplateChunk(processed[start:end]))
+            pos = end
+    except Exception:
+        # a chunk handlebars can't parse on its own
+        for chunk in chunks:
+            if isinstance(chunk, TemplateChunk):
+                release_template(chunk.template)
+        return whole
+    if pos < len(processed):
+        chunks.append(processed[pos:])
+
+    release_template(whole[0].template)
+
+    # merge consecutive static text
+    res = []
+    for chunk in chunks:
+        if isinstance(chunk, str) and res and isinstance(res[-1], str):
+            res[-1] += chunk
+        else:
+            res.append(chunk)
+    return res
+
+
+class PromptArtifact:
+    """A prompt compiled once and shared by every lead of the assistant.
+
+    The template is split into static text and dynamic chunks. When every dynamic chunk renders plain text
+    into the body of the PML, the PML is compiled once with placeholders in their place: settings and
+    function schemas can't depend on the context, so they are reused by reference on every turn and only
+    the dynamic chunks and the text runs around them are rendered again. Otherwise each turn renders the
+    whole template and compiles the resulting PML as PMLBuilder always did.
+    """
+
+    def __init__(self, prompt: str):
+        self.prompt = prompt
+        # context roots and state keys the template reads
+        self.dependencies = analyze_template(prompt)
+        self.chunks = split_template(prompt)
+        self.dynamic = [c for c in self.chunks if isinstance(c, TemplateChunk)]
+        self.segments = None
+        self.settings = None
+        self.functions = None
+        if all(c.text_only or c.attr_safe for c in self.dynamic) and not _MARKER_CHARS.search(prompt):
+            self._compile_static()
+
+    @property
+    def is_static(self) -> bool:
+        """True when settings and functions are shared by every turn"""
+        return self.segments is not None
+
+    def _compile_static(self):
+        probe = []
+        index = 0
+        for chunk in self.chunks:
+            if isinstance(chunk, str):
+                probe.append(chunk)
+            else:
+                probe.append('\ue000%d\ue001' % index)
+                index += 1
+
+        builder = PMLBuilder(''.join(probe))
+        functions = []
+        builder.register_plugin(PmlFunctionsPlugin(None, lambda func: functions.append(func)))
+        try:
+            res = builder.compile_segments(_MARKER)
+        except PMLFallback:
+            return
+        except Exception:
+            # the turn compile reports it
+            return
+
+        segments = res['segments']
+        placed = {p: 'text' for s in segments if isinstance(s, PMLDynamicText) for p in s.parts if isinstance(p, int)}
+        placed.update(res['dropped'])
+        for index, chunk in enumerate(self.dynamic):
+            where = placed.get(index)
+            if where == 'text' and chunk.text_only or where == 'attr' and chunk.attr_safe:
+                continue
+            # the chunk lands in markup, in the settings or in a plugin element
+            return
+
+        self.segments = segments
+        self.settings = res['settings']
+        self.functions = functions
+
+    def render(self, ctx) -> str:
+        """Renders the whole template, same as compiling the prompt with handlebars"""
+        return ''.join(c if isinstance(c, str) else c.render(ctx) for c in self.chunks)
+
+    def compile(self, ctx) -> dict:
+        if not self.is_static:
+            return self._compile_pml(self.render(ctx), ctx)
+
+        values = [c.render(ctx) for c in self.dynamic]
+        text = ''.join(s if isinstance(s, str) else s.render(values) for s in self.segments)
+        return {
+            'prompt': prepare_text(text),
+            # shared by every turn, must not be modified
+            'settings': self.settings,
+            'functions': self.functions,
+            'context': ctx
+        }
+
+    def _compile_pml(self, pml: str, ctx) -> dict:
+        pml_builder = PMLBuilder(pml)
+
+        functions = []
+        # add a lambda function to the plugin which will be called when the plugin is processed
+        # this function will append the function to the functions list
+        plugin = PmlFunctionsPlugin(None, lambda func: functions.append(func))
+        pml_builder.register_plugin(plugin)
+
+        res = pml_builder.compile()
+
+        return {
+            'prompt': res['prompt'],
+            'settings': res['settings'],
+            'functions': functions,
+            'context': ctx
+        }
+
+    def release(self):
+        for chunk in self.dynamic:
+            release_template(chunk.template)
+
+
+# process wide cache used by PromptCompiler
+artifact_cache = TemplateCache(compile_fn=PromptArtifact)
+
+
+def warm_artifacts(prompts):
+    artifact_cache.warm(prompts)
+
+
+if __name__ == "__main__":
+    import time
+
+    with open("example/prompt.hbr", "r") as f:
+        prompt = f.read()
+
+    artifact = PromptArtifact(prompt)
+    print(f"static: {artifact.is_static} chunks: {len(artifact.chunks)} dynamic: {len(artifact.dynamic)}")
+
+    ctx = {'state': {'assistant_name': 'Lola', 'name': 'John', 'allowed_assests': ['BTC', 'ETH']}, 'history': [], 'message': {}}
+    full = artifact._compile_pml(compile_handlebars(prompt)(ctx, helpers=get_helpers()), ctx)
+    assert artifact.compile(ctx) == full
+
+    for label, fn in [('render + PML', lambda: artifact._compile_pml(artifact.render(ctx), ctx)),
+                      ('artifact', lambda: artifact.compile(ctx))]:
+        start = time.time()
+        for i in range(100):
+            fn()
+        print(f"{label} x100: {time.time() - start:.4f}s")
@@ -1,12 +1,11 @@
+import asyncio
 from dataclasses import dataclass
-from pybars import Compiler
 from lolapy_lite_agent.chat_lead import ChatLead
-from lolapy_lite_agent.handlebars_helpers import get_handlebars_compiler, get_helpers
+from lolapy_lite_agent.conversation_snapshot import ConversationSnapshot
 from lolapy_lite_agent.history.history_redis_provider import RedisHistoryProvider
 from lolapy_lite_agent.nlp_job import AgentJob
-from lolapy_lite_agent.pml.function_plugin import PmlFunctionsPlugin
-from lolapy_lite_agent.pml.pml_builder import PMLBuilder
 from lolapy_lite_agent.state.state_redis_provider import RedisChatStateProvider
+from lolapy_lite_agent.prompt_artifact import PromptArtifact, artifact_cache
 
 @dataclass
 class PromptCompiled:
@@ -23,11 +22,54 @@ class PromptCompiler:
         self.stateStore = stateStore
         self.job = job
 
-    
+    @property
+    def artifact(self) -> PromptArtifact:
+        return artifact_cache.get(self.prompt)
+
+    @property
+    def dependencies(self):
+        """History and state the prompt reads, only those are loaded from Redis"""
+        return self.artifact.dependencies
+
     def context(self, init_state={}, new_state={}):
         """Context for handlebars temaplating"""
-        history = self.historyStore.get_history(self.job.lead)
-        state = self.stateStore.get_store(self.job.lead) or {}
+        deps = self.dependencies
+        lead = self.job.lead
+        history = self.historyStore.get_history(lead) if deps.history else []
+        if not deps.state:
+            state = {}
+        elif deps.all_state:
+            state = self.stateStore.get_store(lead) or {}
+        else:
+            state = self.stateStore.get_values(lead, deps.state_keys)
+        return self._build_context(history, state, init_state, new_state)
+
+    async def context_async(self, init_state={}, new_state={}, snapshot: ConversationSnapshot = None):
+        """Same as context() but reads from the async (redis.asyncio) providers,
+        or from the turn snapshot when one was already loaded"""
+        if snapshot:
+            history = snapshot.history if self.dependencies.history else []
+            return self._build_context(history, snapshot.state or {}, init_state, new_state)
+
+        deps = self.dependencies
+        lead = self.job.lead
+
+        async def no_value():
+            return None
+
+        if not deps.state:
+            read_state = no_value()
+        elif deps.all_state:
+            read_state = self.stateStore.get_store(lead)
+        else:
+            read_state = self.stateStore.get_values(lead, deps.state_keys)
+        history, state = await asyncio.gather(
+            self.historyStore.get_history(lead) if deps.history else no_value(),
+            read_state,
+        )
+        return self._build_context(history or [], state or {}, init_state, new_state)
+
+    def _build_context(self, history, state, init_state, new_state):
         new_state = new_state or {}
 
         # merge the initial state with the state from the store
@@ -47,29 +89,18 @@ class PromptCompiler:
 
 
     def process(self, init_state=None, new_state=None) -> PromptCompiled:
-        hbc = get_handlebars_compiler()        
-        template = hbc.compile(self.prompt)
         ctx = self.context(init_state, new_state)
-        pml = template(ctx, helpers=get_helpers())
+        return self._compile(ctx)
 
-        # create a PML Builder
-        pml_builder = PMLBuilder(pml)
-        # register plugin functions
-        
-        functions = []
-        # add a lambda function to the plugin which will be called when the plugin is processed
-        # this function will append the function to the functions list
-        plugin = PmlFunctionsPlugin(None, lambda func: functions.append(func))
-        pml_builder.register_plugin(plugin)
-            
-        res = pml_builder.compile()
+    async def process_async(self, init_state=None, new_state=None, snapshot: ConversationSnapshot = None) -> PromptCompiled:
+        ctx = await self.context_async(init_state, new_state, snapshot=snapshot)
+        return self._compile(ctx)
 
-        return {
-            'prompt': res['prompt'],
-            'settings': res['settings'],
-            'functions': functions,
-            'context': ctx
-        }
+    def _compile(self, ctx) -> PromptCompiled:
+        # the static part of the prompt is compiled once per prompt, only the dynamic chunks are rendered here.
+        # settings and functions may be shared with other turns, don't modify them
+        artifact = artifact_cache.get(self.prompt)
+        return artifact.compile(ctx)
 
 
         
@@ -0,0 +1,280 @@
+import asyncio
+import socket
+import threading
+import time
+import redis
+import redis.asyncio as aioredis
+from loguru import logger as log
+
+DEFAULT_MAX_CONNECTIONS = 50
+DEFAULT_HEALTH_CHECK_INTERVAL = 30
+# seconds a command waits for a free connection when the pool is exhausted
+DEFAULT_POOL_TIMEOUT = 20
+
+
+class PoolMetrics:
+    """Checkout counters of a connection pool, wait times include opening new connections.
+    failures counts checkouts that timed out on a full pool or couldn't connect."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.in_use = 0
+        self.max_in_use = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.failures = 0
+
+    def checked_out(self, wait):
+        with self._lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+    def released(self):
+        with self._lock:
+            self.in_use -= 1
+
+    def failed(self):
+        with self._lock:
+            self.failures += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'checkouts': self.checkouts,
+                'in_use': self.in_use,
+                'max_in_use': self.max_in_use,
+                'wait_avg': self.wait_total / self.checkouts if self.checkouts else 0.0,
+                'wait_max': self.wait_max,
+                'failures': self.failures,
+            }
+
+
+class MeteredConnectionPool(redis.BlockingConnectionPool):
+    """BlockingConnectionPool recording checkouts and wait time.
+    A full pool makes commands wait for a free connection instead of opening more."""
+
+    def __init__(self, *args, metrics: PoolMetrics = None, **kwargs):
+        self.metrics = metrics or PoolMetrics()
+        # ids of the connections counted as checked out, a connection failing to connect is released unchecked
+        self._checked_out = set()
+        super().__init__(*args, **kwargs)
+
+    def get_connection(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            connection = super().get_connection(*args, **kwargs)
+        except redis.ConnectionError:
+            self.metrics.failed()
+            raise
+        self._checked_out.add(id(connection))
+        self.metrics.checked_out(time.perf_counter() - start)
+        return connection
+
+    def release(self, connection):
+        super().release(connection)
+        if id(connection) in self._checked_out:
+            self._checked_out.discard(id(connection))
+            self.metrics.released()
+
+
+class AsyncMeteredConnectionPool(aioredis.BlockingConnectionPool):
+    """redis.asyncio counterpart of MeteredConnectionPool"""
+
+    def __init__(self, *args, metrics: PoolMetrics = None, **kwargs):
+        self.metrics = metrics or PoolMetrics()
+        # ids of the connections counted as checked out, a connection failing to connect is released unchecked
+        self._checked_out = set()
+        super().__init__(*args, **kwargs)
+
+    async def get_connection(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            connection = await super().get_connection(*args, **kwargs)
+        except redis.ConnectionError:
+            self.metrics.failed()
+            raise
+        self._checked_out.add(id(connection))
+        self.metrics.checked_out(time.perf_counter() - start)
+        return connection
+
+    async def release(self, connection):
+        await super().release(connection)
+        if id(connection) in self._checked_out:
+            self._checked_out.discard(id(connection))
+            self.metrics.released()
+
+
+def _close_stale_pool(pool):
+    """Closes the connections of an async pool whose loop is closed, they can't be awaited anymore.
+    Their sockets are shut down, the server sees them closed right away, and the pool forgets them,
+    the file descriptors are released when the connections are garbage-collected"""
+    connections = [*getattr(pool, '_available_connections', ()), *getattr(pool, '_in_use_connections', ())]
+    for connection in connections:
+        writer = getattr(connection, '_writer', None)
+        sock = writer.get_extra_info('socket') if writer is not None else None
+        if sock is None:
+            continue
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    pool.reset()
+
+
+class RedisPoolRegistry:
+    """Process wide Redis connection pools keyed by URL, shared by the history and state providers,
+    MemRedisCacheAside and every agent, so the number of connections no longer grows with the users.
+
+    Sync clients share one thread safe pool per URL. redis.asyncio connections are bound to the loop
+    that opened them, so async clients get a pool per URL and running loop. The pools of closed loops are closed
+    and dropped when the next pool is created, their sockets shut down without the loop (see _close_stale_pool).
+    A caller running its own loops (asyncio.run per call) should still await aclose before each loop ends,
+    so the connections are closed cleanly. AgentController runs on a BackgroundLoop, one loop as long as the process lives.
+    """
+
+    def __init__(self,
+                 max_connections=DEFAULT_MAX_CONNECTIONS,
+                 health_check_interval=DEFAULT_HEALTH_CHECK_INTERVAL,
+                 timeout=DEFAULT_POOL_TIMEOUT):
+        self.max_connections = max_connections
+        self.health_check_interval = health_check_interval
+        self.timeout = timeout
+        self._clients = {}
+        self._async_clients = {}
+        # connection classes and their options by URL, see set_connection_class
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def configure(self, max_connections=None, health_check_interval=None, timeout=None):
+        """Changes the pool settings, they apply to the pools created from now on.
+        Call it at startup, before the first client is requested."""
+        if max_connections is not None:
+            self.max_connections = max_connections
+        if health_check_interval is not None:
+            self.health_check_interval = health_check_interval
+        if timeout is not None:
+            self.timeout = timeout
+
+    def set_connection_class(self, redis_url, connection_class, async_connection_class, **options):
+        """The pools of redis_url open connections of these classes, created with options, e.g. fakeredis'
+        FakeConnection with its server for a Redis in memory (see testing/load). Call it before the first client
+        of redis_url is requested."""
+        self._connections[redis_url] = (connection_class, async_connection_class, options)
+
+    def _pool_options(self, redis_url, asynchronous=False):
+        options = {
+            'max_connections': self.max_connections,
+            'timeout': self.timeout,
+            'health_check_interval': self.health_check_interval,
+        }
+        connection = self._connections.get(redis_url)
+        if connection is not None:
+            connection_class, async_connection_class, connection_options = connection
+            options['connection_class'] = async_connection_class if asynchronous else connection_class
+            options.update(connection_options)
+        return options
+
+    def client(self, redis_url) -> redis.Redis:
+        """Redis client on the shared pool of redis_url"""
+        client = self._clients.get(redis_url)
+        if client is not None:
+            return client
+        with self._lock:
+            client = self._clients.get(redis_url)
+            if client is None:
+                pool = MeteredConnectionPool.from_url(redis_url, **self._pool_options(redis_url))
+                client = redis.Redis(connection_pool=pool)
+                self._clients[redis_url] = client
+                log.info(f"Redis pool for {redis_url} (max {self.max_connections} connections)")
+        return client
+
+    def async_client(self, redis_url) -> aioredis.Redis:
+        """redis.asyncio client on the shared pool of redis_url for the running loop,
+        await aclose before the loop ends to disconnect it"""
+        loop = asyncio.get_running_loop()
+        key = (redis_url, loop)
+        client = self._async_clients.get(key)
+        if client is not None:
+            return client
+        with self._lock:
+            client = self._async_clients.get(key)
+            if client is None:
+                stale = [k for k in self._async_clients if k[1].is_closed()]
+                for stale_key in stale:
+                    _close_stale_pool(self._async_clients.pop(stale_key).connection_pool)
+                pool = AsyncMeteredConnectionPool.from_url(redis_url, **self._pool_options(redis_url, asynchronous=True))
+                client = aioredis.Redis(connection_pool=pool)
+                self._async_clients[key] = client
+        return client
+
+    def stats(self):
+        """Pool metrics per URL, async pools of the same URL are added up"""
+        with self._lock:
+            sync_pools = [(url, c.connection_pool) for url, c in self._clients.items()]
+            async_pools = [(key[0], c.connection_pool) for key, c in self._async_clients.items()]
+
+        res = {}
+        for url, pool in sync_pools:
+            res.setdefault(url, {})['sync'] = pool.metrics.snapshot()
+        for url, pool in async_pools:
+            current = res.setdefault(url, {}).get('async')
+            metrics = pool.metrics.snapshot()
+            if current:
+                metrics = {
+                    'checkouts': current['checkouts'] + metrics['checkouts'],
+                    'in_use': current['in_use'] + metrics['in_use'],
+                    'max_in_use': max(current['max_in_use'], metrics['max_in_use']),
+                    'wait_avg': (current['wait_avg'] * current['checkouts'] + metrics['wait_avg'] * metrics['checkouts'])
+                    / max(current['checkouts'] + metrics['checkouts'], 1),
+                    'wait_max': max(current['wait_max'], metrics['wait_max']),
+                    'failures': current['failures'] + metrics['failures'],
+                }
+            res[url]['async'] = metrics
+        return res
+
+    def close(self):
+        """Disconnects the sync pools"""
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+        for client in clients:
+            client.connection_pool.disconnect()
+
+    async def aclose(self):
+        """Disconnects the async pools of the running loop, call it before the loop ends.
+        The next client requested on the loop opens a new pool"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            keys = [k for k in self._async_clients if k[1] is loop]
+            clients = [self._async_clients.pop(k) for k in keys]
+        for client in clients:
+            await client.connection_pool.disconnect()
+
+
+# process wide registry
+redis_pools = RedisPoolRegistry()
+
+
+def configure_redis_pools(**options):
+    redis_pools.configure(**options)
+
+
+if __name__ == "__main__":
+    redis_url = "redis://localhost:6379/0"
+
+    client = redis_pools.client(redis_url)
+    assert client is redis_pools.client(redis_url)
+    for i in range(100):
+        client.set(f"pool:test:{i}", i)
+
+    async def main():
+        client = redis_pools.async_client(redis_url)
+        await asyncio.gather(*[client.get(f"pool:test:{i}") for i in range(100)])
+        await redis_pools.aclose()
+
+    asyncio.run(main())
+    print(redis_pools.stats())
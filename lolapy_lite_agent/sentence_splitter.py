@@ -0,0 +1,162 @@
+import re
+from typing import List
+
+# abbreviations ending with a period that don't end a sentence, lowercase without the final period
+ABBREVIATIONS = {
+    "en": frozenset([
+        "mr", "mrs", "ms", "dr", "prof", "sr", "jr", "st", "vs", "etc", "e.g", "i.e", "inc", "ltd", "co", "corp",
+        "approx", "dept", "fig", "vol", "ave", "blvd", "mt", "u.s", "u.k", "a.m", "p.m",
+        "jan", "feb", "apr", "jun", "jul", "aug", "sep", "sept", "oct", "nov", "dec",
+    ]),
+    "es": frozenset([
+        "sr", "sra", "srta", "sres", "dr", "dra", "lic", "ing", "arq", "prof", "ud", "uds", "vd", "vds", "etc",
+        "p.ej", "ej", "pág", "págs", "núm", "nro", "aprox", "av", "avda", "sto", "sta", "dto", "depto", "tel",
+        "ee.uu", "a.c", "d.c", "a.m", "p.m", "cía", "s.a", "admón",
+        "ene", "feb", "abr", "jun", "jul", "ago", "sept", "oct", "nov", "dic",
+    ]),
+}
+# words that are abbreviations too ("no", "may", "mar", "est") are left out, a sentence ending with them would
+# wait for the next one. The languages aren't merged, an abbreviation of one is a word of the other
+COMMON_ABBREVIATIONS = frozenset.intersection(*ABBREVIATIONS.values())
+# "no" abbreviates number only before one: "No. 5"
+NUMBER_ABBREVIATIONS = frozenset(["no"])
+
+# sentence end: terminators with the closing quotes and brackets after them, or a line break
+_BOUNDARY = re.compile(r'[.!?…]+["\'”’»)\]]*|\n+')
+_CLAUSE = re.compile(r'[,;:—]\s')
+_TOKEN = re.compile(r'(\S+)$')
+_OPENING = '"\'“‘«([¿¡'
+DEFAULT_MAX_CHARS = 150
+MIN_CLAUSE_CHARS = 30
+
+
+class SentenceSplitter:
+    """Splits streamed text into sentences as soon as their end is seen, for speech synthesis.
+
+    A period doesn't end a sentence after an abbreviation, an initial, a list number or before a lowercase word.
+    Sentences longer than max_chars are cut at their last clause separator (, ; : —) so speech can start
+    on long sentences too. The chunks keep the whitespace after them, joined they give back the text.
+    """
+
+    def __init__(self, language: str = None, max_chars: int = DEFAULT_MAX_CHARS):
+        """
+        Args:
+            language: "en" or "es" for its abbreviations, only the ones both share when None
+            max_chars: cut longer sentences at clause separators, never when None
+        """
+        self.abbreviations = ABBREVIATIONS.get(language, COMMON_ABBREVIATIONS)
+        self.max_chars = max_chars
+        self._buffer = ""
+        # where the search for the next boundary resumes
+        self._scan = 0
+
+    def push(self, text: str) -> List[str]:
+        """Adds streamed text, returns the sentences it completes"""
+        self._buffer += text
+        res = []
+        while True:
+            end = self._next_boundary()
+            cut = self._clause_cut(len(self._buffer) if end is None else end)
+            if cut is not None:
+                end = cut
+            elif end is None:
+                break
+            res.append(self._buffer[:end])
+            self._buffer = self._buffer[end:]
+            self._scan = 0
+        return res
+
+    def flush(self) -> str:
+        """The rest of the text, None when empty"""
+        text = self._buffer
+        self._buffer = ""
+        self._scan = 0
+        return text or None
+
+    def _next_boundary(self):
+        """End of the first sentence in the buffer including the whitespace after it, None when not known yet"""
+        buffer = self._buffer
+        for m in _BOUNDARY.finditer(buffer, self._scan):
+            end = m.end()
+            if m.group()[0] == "\n":
+                return end
+            # the end of the sentence is known with the whitespace after it and the next word
+            rest = len(buffer) - len(buffer[end:].lstrip())
+            if rest == len(buffer):
+                self._scan = m.start()
+                return None
+            if rest == end:
+                # 3.5, e.g. or a closing quote glued to the next word
+                continue
+            if "." in m.group() and not self._ends_sentence(m.start(), buffer[rest]):
+                continue
+            return rest
+        self._scan = max(len(buffer) - 1, 0)
+        return None
+
+    def _ends_sentence(self, dot, next_char):
+        if next_char.islower():
+            return False
+        m = _TOKEN.search(self._buffer, 0, dot)
+        if not m:
+            return True
+        token = m.group(1).lstrip(_OPENING)
+        if token.lower() in self.abbreviations:
+            return False
+        if token.lower() in NUMBER_ABBREVIATIONS and next_char.isdigit():
+            return False
+        if len(token) == 1 and token.isupper():
+            # an initial
+            return False
+        if token.isdigit() and not self._buffer[:m.start()].strip():
+            # list number at the start of the sentence
+            return False
+        return True
+
+    def _clause_cut(self, length):
+        """End of the last clause within max_chars of a sentence of length characters longer than max_chars"""
+        if not self.max_chars or length <= self.max_chars:
+            return None
+        cut = None
+        for m in _CLAUSE.finditer(self._buffer, MIN_CLAUSE_CHARS, self.max_chars):
+            cut = m.end()
+        return cut
+
+
+def split_sentences(text: str, language: str = None, max_chars: int = DEFAULT_MAX_CHARS) -> List[str]:
+    splitter = SentenceSplitter(language, max_chars)
+    res = splitter.push(text)
+    rest = splitter.flush()
+    if rest:
+        res.append(rest)
+    return res
+
+
+if __name__ == "__main__":
+    import random
+
+    samples = [
+        "Hello Mr. Smith! The BTC price is $50,123.45 today. Do you want the ETH price too? Let me know...",
+        "Hola Sr. García, ¿cómo está? El precio es de 1.234,56 USD aprox. según EE.UU. hoy. ¡Gracias!",
+        "Steps:\n1. Open the app.\n2. Tap J. Doe's profile, e.g. the first one. Then wait.",
+        "This is a very long sentence without a period that keeps going, and going, with clauses; "
+        "so the speech engine can start before it ends, because waiting for the end would take a while, "
+        "and nobody likes silence on a call",
+    ]
+    for text in samples:
+        # stream it in random 1-4 character deltas
+        splitter = SentenceSplitter()
+        chunks = []
+        pos = 0
+        while pos < len(text):
+            size = random.randint(1, 4)
+            chunks += splitter.push(text[pos:pos + size])
+            pos += size
+        rest = splitter.flush()
+        if rest:
+            chunks.append(rest)
+        assert "".join(chunks) == text
+        assert chunks == split_sentences(text), (chunks, split_sentences(text))
+        for chunk in chunks:
+            print(repr(chunk))
+        print()
@@ -0,0 +1,172 @@
+import json
+import zlib
+from collections.abc import Mapping
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Values written by a codec start with the JSON text, or with this byte followed by a byte naming the
+# serializer (low nibble) and the compression (high nibble). JSON never starts with a control byte,
+# so the values stored before codecs existed read as JSON.
+FORMAT_VERSION = 1
+SERIALIZERS = {"json": 0, "msgpack": 1}
+COMPRESSIONS = {None: 0, "zlib": 1, "zstd": 2}
+# values this size or larger are compressed when the codec compresses, in bytes
+DEFAULT_COMPRESS_THRESHOLD = 1024
+
+_SERIALIZER_NAMES = {v: k for k, v in SERIALIZERS.items()}
+_COMPRESSION_NAMES = {v: k for k, v in COMPRESSIONS.items()}
+
+
+def json_default(value):
+    """default of json.dumps for the mappings that aren't dicts, e.g. ChatMessage"""
+    if isinstance(value, Mapping):
+        return dict(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps_json(value) -> bytes:
+    if orjson is not None:
+        try:
+            return orjson.dumps(value, default=json_default, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            # e.g. integers beyond 64 bits, the stdlib takes them
+            pass
+    return json.dumps(value, default=json_default).encode()
+
+
+def loads_json(data):
+    if orjson is not None:
+        # orjson takes exact bytes, a memoryview of a subclass (RawJSON) avoids copying it
+        return orjson.loads(data if type(data) in (bytes, str) else memoryview(data))
+    return json.loads(data)
+
+
+class Codec:
+    """Turns the values stored in Redis (history entries, state fields, cache entries) into bytes and back.
+
+    JSON goes through orjson when it is installed, the stdlib otherwise, both write plain JSON as before.
+    msgpack (pip install msgpack) is binary and a little more compact, only readable through a Codec,
+    orjson decodes faster than it. Compression trades decode time for memory and bandwidth on large values.
+    Values of compress_threshold bytes or more are compressed with zlib or zstd (pip install zstandard).
+    Any codec decodes what any other wrote, JSON values without a header included.
+
+    Args:
+        serializer: "json" or "msgpack"
+        compression: None, "zlib" or "zstd"
+        level: compression level, the library's default when None
+    """
+    __slots__ = ('serializer', 'compression', 'compress_threshold', 'level', '_header', '_compressed_header',
+                 '_zstd_compressor')
+
+    def __init__(self, serializer="json", compression=None, compress_threshold=DEFAULT_COMPRESS_THRESHOLD, level=None):
+        if serializer not in SERIALIZERS:
+            raise ValueError(f"Unknown serializer {serializer}, expected one of {list(SERIALIZERS)}")
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression {compression}, expected one of {list(COMPRESSIONS)}")
+        if serializer == "msgpack" and msgpack is None:
+            raise ValueError("The msgpack serializer needs msgpack, pip install msgpack")
+        if compression == "zstd" and zstandard is None:
+            raise ValueError("zstd compression needs zstandard, pip install zstandard")
+        self.serializer = serializer
+        self.compression = compression
+        self.compress_threshold = compress_threshold
+        self.level = level
+        # plain JSON is written without a header, like before codecs
+        self._header = b"" if serializer == "json" else bytes((FORMAT_VERSION, SERIALIZERS[serializer]))
+        self._compressed_header = bytes((FORMAT_VERSION, SERIALIZERS[serializer] | COMPRESSIONS[compression] << 4))
+        self._zstd_compressor = None
+
+    def encode(self, value) -> bytes:
+        if self.serializer == "json":
+            data = dumps_json(value)
+        else:
+            data = msgpack.packb(value, default=json_default)
+        return self.frame(data)
+
+    def frame(self, data: bytes) -> bytes:
+        """Header and compression of a value already serialized with the codec's serializer"""
+        if self.compression and len(data) >= self.compress_threshold:
+            return self._compressed_header + self._compress(data)
+        return self._header + data if self._header else data
+
+    def decode(self, data):
+        if isinstance(data, str) or not data or data[0] != FORMAT_VERSION:
+            return loads_json(data)
+        flags = data[1]
+        data = data[2:]
+        compression = _COMPRESSION_NAMES.get(flags >> 4, "unknown")
+        if compression == "zlib":
+            data = zlib.decompress(data)
+        elif compression == "zstd":
+            if zstandard is None:
+                raise ValueError("A zstd compressed value needs zstandard, pip install zstandard")
+            data = zstandard.ZstdDecompressor().decompress(data)
+        elif compression is not None:
+            raise ValueError(f"Unknown compression {flags >> 4} of a stored value")
+        serializer = _SERIALIZER_NAMES.get(flags & 0x0F)
+        if serializer == "json":
+            return loads_json(data)
+        if serializer == "msgpack":
+            if msgpack is None:
+                raise ValueError("A msgpack value needs msgpack, pip install msgpack")
+            return msgpack.unpackb(data, strict_map_key=False)
+        raise ValueError(f"Unknown serializer {flags & 0x0F} of a stored value")
+
+    def decode_many(self, values) -> list:
+        """Decodes values like decode, the ones all stored as plain JSON are parsed in one pass as a JSON array"""
+        values = values if isinstance(values, list) else list(values)
+        if values and all(type(v) is bytes and v and v[0] != FORMAT_VERSION for v in values):
+            decoded = loads_json(b"[" + b",".join(values) + b"]")
+            # a value that isn't a single JSON value shifts the array, decode one by one to raise on it
+            if len(decoded) == len(values):
+                return decoded
+        return [self.decode(v) for v in values]
+
+    def decode_fields(self, fields: Mapping) -> dict:
+        """Decodes a hash as HGETALL replies it, field names to str"""
+        return dict(zip([k.decode('utf-8') for k in fields], self.decode_many(list(fields.values()))))
+
+    def _compress(self, data: bytes) -> bytes:
+        if self.compression == "zlib":
+            return zlib.compress(data, -1 if self.level is None else self.level)
+        if self._zstd_compressor is None:
+            self._zstd_compressor = zstandard.ZstdCompressor(level=3 if self.level is None else self.level)
+        return self._zstd_compressor.compress(data)
+
+    def __repr__(self):
+        return f"Codec({self.serializer!r}, compression={self.compression!r})"
+
+
+# JSON without compression, what the providers wrote before codecs
+default_codec = Codec()
+
+
+if __name__ == "__main__":
+    import timeit
+
+    history = [{"role": "user" if i % 2 == 0 else "assistant", "content": f"Message number {i} of the conversation, " * 3}
+               for i in range(1000)]
+    stdlib = [json.dumps(entry) for entry in history]
+    codecs = {"stdlib json": None, "json": default_codec, "json+zlib": Codec(compression="zlib", compress_threshold=64)}
+    if msgpack is not None:
+        codecs["msgpack"] = Codec("msgpack")
+
+    for name, codec in codecs.items():
+        values = stdlib if codec is None else [codec.encode(entry) for entry in history]
+        decode = (lambda: [json.loads(v) for v in values]) if codec is None else (lambda: codec.decode_many(values))
+        number = 20
+        seconds = min(timeit.repeat(decode, number=number, repeat=5)) / number
+        print(f"{name:12} decode 1000 entries {seconds * 1e3:7.3f} ms, {sum(len(v) for v in values):7d} bytes")
@@ -1,3 +1,4 @@
+import inspect
 from abc import ABC, abstractmethod
 
 from lolapy_lite_agent.chat_lead import ChatLead
@@ -29,4 +30,19 @@ class BaseChatStateProvider(ABC):
 
     @abstractmethod
     def set_store(self, lead: ChatLead, store, ttl=None):
-        pass
\ No newline at end of file
+        pass
+
+    def get_values(self, lead: ChatLead, keys):
+        """Only the given keys of the state, missing keys are left out. Reads the whole store, providers that
+        can read some keys override it. Awaitable when get_store is"""
+        store = self.get_store(lead)
+        if inspect.isawaitable(store):
+            async def values():
+                return _pick(await store, keys)
+            return values()
+        return _pick(store, keys)
+
+
+def _pick(store, keys):
+    store = store or {}
+    return {k: store[k] for k in keys if k in store}
@@ -0,0 +1,107 @@
+import asyncio
+from lolapy_lite_agent.chat_lead import ChatLead
+from lolapy_lite_agent.state.base_state_provider import BaseChatStateProvider
+from lolapy_lite_agent.redis_pool import redis_pools
+from lolapy_lite_agent.serialization import Codec, default_codec
+
+
+class AsyncRedisChatStateProvider(BaseChatStateProvider):
+    """Same storage layout as RedisChatStateProvider, awaited on the running loop."""
+
+    def __init__(self, redis_url=None, codec: Codec = None):
+        """
+        Args:
+            codec: how state values are stored, JSON when None
+        """
+        super().__init__()
+        self.redis_url = redis_url if redis_url else "localhost"
+        self.codec = codec or default_codec
+
+    @property
+    def client(self):
+        # shared pool of the running loop, see RedisPoolRegistry
+        return redis_pools.async_client(self.redis_url)
+
+    def get_key(self, lead):
+        return "s:" + lead.get_token()
+
+    async def set_key_value(self, lead, key, value, ttl_in_seconds=None):
+        hash_key = self.get_key(lead)
+        await self.client.hset(hash_key, key, self.codec.encode(value))
+        if ttl_in_seconds:
+            await self.client.expire(hash_key, ttl_in_seconds)
+
+    async def get_key_value(self, lead, key):
+        hash_key = self.get_key(lead)
+        value = await self.client.hget(hash_key, key)
+        if not value:
+            return None
+        return self.codec.decode(value)
+
+    async def clear_store(self, lead):
+        hash_key = self.get_key(lead)
+        await self.client.delete(hash_key)
+
+    async def clear_all_stores(self, tenant_id, assistant_id):
+        hash_key = "s:" + tenant_id + ":" + assistant_id + ":*"
+        keys = await self.client.keys(hash_key)
+        if not keys:
+            return
+        await self.client.delete(*keys)
+
+    async def get_store(self, lead):
+        hash_key = self.get_key(lead)
+        store = await self.client.hgetall(hash_key)
+        return self.decode_store(store)
+
+    async def get_values(self, lead, keys):
+        """Only the given keys of the state (HMGET), missing keys are left out"""
+        keys = list(keys)
+        values = await self.client.hmget(self.get_key(lead), keys)
+        return self.decode_values(keys, values)
+
+    def pipe_get_values(self, pipe, lead, keys):
+        """Queue a read of some state keys on an existing pipeline, decode the reply with decode_values"""
+        pipe.hmget(self.get_key(lead), list(keys))
+
+    def decode_values(self, keys, values):
+        found = [(k, v) for k, v in zip(keys, values) if v]
+        return dict(zip([k for k, _ in found], self.codec.decode_many([v for _, v in found])))
+
+    def pipe_get_store(self, pipe, lead):
+        """Queue a full state read on an existing pipeline, decode the reply with decode_store"""
+        pipe.hgetall(self.get_key(lead))
+
+    def decode_store(self, store):
+        if not store:
+            return None
+        return self.codec.decode_fields(store)
+
+    async def set_store(self, lead, store, ttl=None):
+        hash_key = self.get_key(lead)
+        if store:
+            await self.client.hset(hash_key, mapping={key: self.codec.encode(store[key]) for key in store})
+        if ttl:
+            await self.client.expire(hash_key, ttl)
+
+
+if __name__ == "__main__":
+
+    async def main():
+        provider = AsyncRedisChatStateProvider(redis_url="redis://localhost:6379/0")
+        lead = ChatLead("123", "test", "tenant", "assistant")
+
+        await provider.set_key_value(lead, "key1", "value1")
+        await provider.set_key_value(lead, "key2", "value2")
+
+        print(await provider.get_key_value(lead, "key1"))
+        print(await provider.get_key_value(lead, "key2"))
+
+        await provider.clear_store(lead)
+
+        state = await provider.get_store(lead) or {}
+        state['test'] = "test_value"
+        await provider.set_store(lead, state)
+        print(await provider.get_store(lead))
+
+    asyncio.run(main())
@@ -1,23 +1,30 @@
-import json
-import redis
+from loguru import logger as log
 from lolapy_lite_agent.chat_lead import ChatLead
 from lolapy_lite_agent.state.base_state_provider import BaseChatStateProvider
+from lolapy_lite_agent.redis_pool import redis_pools
+from lolapy_lite_agent.serialization import Codec, default_codec
 
 
 class RedisChatStateProvider(BaseChatStateProvider):
 
-    def __init__(self, redis_url=None):
+    def __init__(self, redis_url=None, codec: Codec = None):
+        """
+        Args:
+            codec: how state values are stored, JSON when None
+        """
         super().__init__()
         self.redis_url = redis_url if redis_url else "localhost"
-        print("RedisChatStateProvider -> Connecting to redis")
-        self.client = redis.Redis.from_url(self.redis_url)
+        self.codec = codec or default_codec
+        log.debug(f"RedisChatStateProvider -> Connecting to redis at {self.redis_url}")
+        # shared pool, every provider on the same URL uses the same connections
+        self.client = redis_pools.client(self.redis_url)
         
     def get_key(self, lead):
         return "s:" + lead.get_token()
 
     def set_key_value(self, lead, key, value, ttl_in_seconds=None):
         hash_key = self.get_key(lead)
-        self.client.hset(hash_key, key, json.dumps(value))
+        self.client.hset(hash_key, key, self.codec.encode(value))
         if ttl_in_seconds:
             self.client.expire(hash_key, ttl_in_seconds)
 
@@ -26,7 +33,7 @@ class RedisChatStateProvider(BaseChatStateProvider):
         value = self.client.hget(hash_key, key)
         if not value:
             return None
-        return json.loads(value)
+        return self.codec.decode(value)
 
     def clear_store(self, lead):
         hash_key = self.get_key(lead)
@@ -45,14 +52,21 @@ class RedisChatStateProvider(BaseChatStateProvider):
         store = self.client.hgetall(hash_key)
         if not store:
             return None
-        return {k.decode('utf-8'): json.loads(store[k]) for k in store}
+        return self.codec.decode_fields(store)
     
         
 
+    def get_values(self, lead, keys):
+        """Only the given keys of the state (HMGET), missing keys are left out"""
+        keys = list(keys)
+        values = self.client.hmget(self.get_key(lead), keys)
+        found = [(k, v) for k, v in zip(keys, values) if v]
+        return dict(zip([k for k, _ in found], self.codec.decode_many([v for _, v in found])))
+
     def set_store(self, lead, store, ttl=None):
         hash_key = self.get_key(lead)
         for key in store:
-            self.client.hset(hash_key, key, json.dumps(store[key]))
+            self.client.hset(hash_key, key, self.codec.encode(store[key]))
         if ttl:
             self.client.expire(hash_key, ttl)
 
@@ -0,0 +1,56 @@
+import asyncio
+from lolapy_lite_agent.chat_lead import ChatLead
+
+
+class StreamSession:
+    """Handle on one response stream, owns the interrupt and cancel flags that used to live on LolaAgent,
+    so a single agent can stream to many leads at once.
+
+    interrupt() stops the stream after the current chunk and keeps the partial response in the history.
+    cancel() cancels the task consuming the stream, nothing more is written to the history.
+    """
+    __slots__ = ('lead', 'on_text_received', 'producing', 'interrupted', 'cancelled', 'tokens', '_task', '_done')
+
+    def __init__(self, lead: ChatLead = None, on_text_received: callable = None):
+        self.lead = lead
+        # overrides the agent's on_text_received for this stream
+        self.on_text_received = on_text_received
+        self.producing = False
+        self.interrupted = False
+        self.cancelled = False
+        # TokenSplit of the last request of the stream
+        self.tokens = None
+        self._task = None
+        self._done = None
+
+    def started(self):
+        """Called by the stream when it begins, binds the session to the consuming task"""
+        self._task = asyncio.current_task()
+        if self._done is None:
+            self._done = asyncio.Event()
+
+    def finished(self):
+        self.producing = False
+        self._task = None
+        if self._done is not None:
+            self._done.set()
+
+    @property
+    def active(self) -> bool:
+        return self._task is not None
+
+    def interrupt(self):
+        """Interrupt the response if it is streaming"""
+        if self.active:
+            self.interrupted = True
+
+    def cancel(self):
+        """Cancel the stream, a session still waiting for its turn never starts"""
+        self.cancelled = True
+        if self._task is not None:
+            self._task.cancel()
+
+    async def wait(self):
+        """Waits until the stream is over"""
+        if self._done is not None:
+            await self._done.wait()
@@ -0,0 +1,121 @@
+import hashlib
+import sys
+import threading
+from collections import OrderedDict
+from typing import Callable, Iterable
+from lolapy_lite_agent.handlebars_helpers import get_handlebars_compiler
+
+DEFAULT_MAX_TEMPLATES = 128
+
+
+def prompt_hash(prompt: str) -> str:
+    return hashlib.sha1(prompt.encode('utf-8')).hexdigest()
+
+
+def compile_handlebars(prompt: str):
+    return get_handlebars_compiler().compile(prompt)
+
+
+def release_template(template):
+    # pybars registers every compiled template as a module in sys.modules,
+    # drop it so the template can be garbage collected
+    module = getattr(template, '__module__', None)
+    if module and module.startswith('pybars._templates.'):
+        sys.modules.pop(module, None)
+
+
+class TemplateCache:
+    """Bounded LRU of compiled templates keyed by the hash of the prompt source.
+
+    pybars compiles a template by generating Python source and exec'ing it, which is far
+    more expensive than rendering it, and the same prompt is shared by every lead of an assistant.
+    """
+
+    def __init__(self, maxsize=DEFAULT_MAX_TEMPLATES, compile_fn: Callable[[str], object] = None):
+        self.maxsize = maxsize
+        self.compile_fn = compile_fn or compile_handlebars
+        self.hits = 0
+        self.misses = 0
+        self._templates = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, prompt: str):
+        """Returns the compiled template for prompt, compiling it on a miss"""
+        key = prompt_hash(prompt)
+        with self._lock:
+            template = self._templates.get(key)
+            if template is not None:
+                self._templates.move_to_end(key)
+                self.hits += 1
+                return template
+            self.misses += 1
+
+        # compile outside the lock, two threads racing on the same prompt just compile it twice
+        template = self.compile_fn(prompt)
+
+        with self._lock:
+            self._templates[key] = template
+            self._templates.move_to_end(key)
+            while len(self._templates) > self.maxsize:
+                _, evicted = self._templates.popitem(last=False)
+                self._release(evicted)
+        return template
+
+    def warm(self, prompts: Iterable[str]):
+        """Compiles the given prompts ahead of time, call it at startup with the known assistant prompts"""
+        for prompt in prompts:
+            self.get(prompt)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._templates),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / total if total else 0.0,
+            }
+
+    def clear(self):
+        with self._lock:
+            for template in self._templates.values():
+                self._release(template)
+            self._templates.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._templates)
+
+    def __contains__(self, prompt: str):
+        return prompt_hash(prompt) in self._templates
+
+    def _release(self, template):
+        # compiled objects holding templates of their own release them
+        release = getattr(template, 'release', None)
+        if release is not None:
+            release()
+        else:
+            release_template(template)
+
+
+if __name__ == "__main__":
+    import time
+    from lolapy_lite_agent.handlebars_helpers import get_helpers
+
+    with open("example/prompt.hbr", "r") as f:
+        prompt = f.read()
+
+    start = time.time()
+    for i in range(100):
+        compile_handlebars(prompt)
+    print(f"compile x100: {time.time() - start:.4f}s")
+
+    cache = TemplateCache()
+    cache.warm([prompt])
+    start = time.time()
+    for i in range(100):
+        cache.get(prompt)({'state': {}}, helpers=get_helpers())
+    print(f"cached render x100: {time.time() - start:.4f}s")
+    print(cache.stats())
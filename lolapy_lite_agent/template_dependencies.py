@@ -0,0 +1,220 @@
+import re
+from dataclasses import dataclass
+from typing import FrozenSet, Optional
+from lolapy_lite_agent.handlebars_helpers import get_helpers
+
+_MUSTACHE = re.compile(r'\{\{\{[\s\S]*?\}\}\}|\{\{[\s\S]*?\}\}')
+# partials, raw blocks and decorators can read anything
+_OPAQUE = re.compile(r'\{\{~?\{\{\{|\{\{~?#?>|\{\{~?#\*')
+_TOKEN = re.compile(r'"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|[()]|[^\s()]+')
+_SEGMENT = re.compile(r'\[([^\]]*)\]|([^./\[\]]+)')
+_LITERAL = re.compile(r'-?[0-9]+\Z|true\Z|false\Z|null\Z|undefined\Z')
+
+# helpers running their block with the current context
+SAME_SCOPE_HELPERS = frozenset(['if', 'unless', 'if_equals', 'if_not_equals'])
+# helpers running their block with the context of their first argument
+SCOPE_HELPERS = frozenset(['each', 'with'])
+BUILTIN_HELPERS = SAME_SCOPE_HELPERS | SCOPE_HELPERS | frozenset(['lookup', 'log', 'blockHelperMissing', 'helperMissing'])
+
+
+@dataclass(frozen=True)
+class TemplateDependencies:
+    """Parts of the render context a template reads.
+    state_keys is None when the template may read any state key."""
+    history: bool = True
+    state: bool = True
+    state_keys: Optional[FrozenSet[str]] = None
+    message: bool = True
+
+    @property
+    def all_state(self) -> bool:
+        return self.state and self.state_keys is None
+
+
+# used when the template can't be analyzed
+ALL_DEPENDENCIES = TemplateDependencies()
+
+
+class _Collector:
+
+    def __init__(self):
+        self.history = False
+        self.message = False
+        self.state = False
+        self.state_keys = set()
+        self.all_state = False
+
+    def add(self, segments):
+        # segments of a path resolved from the root context
+        if not segments:
+            # the whole context
+            self.history = self.message = self.state = self.all_state = True
+            return
+        root = segments[0]
+        if root == 'history':
+            self.history = True
+        elif root == 'message':
+            self.message = True
+        elif root == 'state':
+            self.state = True
+            if len(segments) > 1:
+                self.state_keys.add(segments[1])
+            else:
+                self.all_state = True
+
+    def result(self) -> TemplateDependencies:
+        return TemplateDependencies(
+            history=self.history,
+            state=self.state,
+            state_keys=None if self.all_state else frozenset(self.state_keys),
+            message=self.message,
+        )
+
+
+def _path(token: str):
+    """Returns (levels up, from @root, segments) or None for data variables"""
+    up = 0
+    while token.startswith('../'):
+        up += 1
+        token = token[3:]
+    if token in ('this', '.', '..'):
+        return up + (token == '..'), False, []
+    for prefix in ('this.', 'this/', './'):
+        if token.startswith(prefix):
+            token = token[len(prefix):]
+            break
+    segments = [a or b for a, b in _SEGMENT.findall(token)]
+    if segments and segments[0] == '@root':
+        return 0, True, segments[1:]
+    if token.startswith('@'):
+        return None
+    return up, False, segments
+
+
+def analyze_template(source: str) -> TemplateDependencies:
+    """Finds which context roots (history, state, message) and which state keys a handlebars template reads.
+
+    Paths inside each/with blocks are relative to the value the block iterates, they depend on that whole value.
+    Anything the analysis can't follow (partials, unknown block helpers, ...) depends on the whole context.
+    """
+    if _OPAQUE.search(source):
+        return ALL_DEPENDENCIES
+
+    helpers = BUILTIN_HELPERS | frozenset(get_helpers())
+    deps = _Collector()
+    # context of each each/with level: the root path of the value it was opened with, None for the root context
+    scopes = [None]
+    # open blocks, True when the block opened a context level
+    blocks = []
+
+    def resolve(token):
+        path = _path(token)
+        if path is None:
+            return None
+        up, from_root, segments = path
+        if from_root:
+            return segments
+        if up >= len(scopes):
+            return []
+        base = scopes[-1 - up]
+        if base is None:
+            return segments
+        # relative to an iterated value, depend on the whole value
+        return base
+
+    def add_args(tokens):
+        helper_next = False
+        for token in tokens:
+            if token == '(':
+                helper_next = True
+                continue
+            if token == ')':
+                continue
+            if helper_next:
+                helper_next = False
+                if token in helpers:
+                    continue
+            if token[0] in '"\'' or _LITERAL.match(token):
+                continue
+            if '=' in token:
+                # hash argument
+                token = token.split('=', 1)[1]
+                if not token or token[0] in '"\'' or _LITERAL.match(token):
+                    continue
+            segments = resolve(token)
+            if segments is not None:
+                deps.add(segments)
+
+    for m in _MUSTACHE.finditer(source):
+        tag = m.group()
+        if tag.startswith('{{{'):
+            inner = tag[3:-3]
+        else:
+            inner = tag[2:-2]
+        inner = inner.strip('~').strip()
+        if inner.startswith('!'):
+            continue
+        kind = inner[:1]
+        if kind in '#^/&':
+            inner = inner[1:].strip()
+        tokens = _TOKEN.findall(inner)
+
+        if kind == '/':
+            if not blocks:
+                return ALL_DEPENDENCIES
+            if blocks.pop():
+                scopes.pop()
+            continue
+
+        if not tokens or tokens[0] == 'else':
+            # {{else}} and {{^}}: the inverse of each/with runs in the context the block was opened in
+            if blocks and blocks[-1]:
+                scopes.pop()
+                blocks[-1] = False
+            if tokens[1:2] == ['if'] or tokens[1:2] == ['unless']:
+                add_args(tokens[2:])
+            continue
+
+        name = tokens[0]
+        if kind == '#':
+            if name in SAME_SCOPE_HELPERS:
+                add_args(tokens[1:])
+                blocks.append(False)
+                continue
+            # sections over a path run in the current context or in the value's depending on the value,
+            # they are left unanalyzed like unknown block helpers
+            if name not in SCOPE_HELPERS or len(tokens) != 2:
+                return ALL_DEPENDENCIES
+            scope = resolve(tokens[1])
+            if scope is None:
+                return ALL_DEPENDENCIES
+            deps.add(scope)
+            blocks.append(True)
+            scopes.append(scope)
+            continue
+
+        if kind == '^':
+            # inverted section, rendered in the current context when the value is empty
+            if name in helpers or len(tokens) > 1:
+                return ALL_DEPENDENCIES
+            add_args(tokens)
+            blocks.append(False)
+            continue
+
+        if name in helpers:
+            add_args(tokens[1:])
+        else:
+            add_args(tokens)
+
+    if blocks:
+        return ALL_DEPENDENCIES
+    return deps.result()
+
+
+if __name__ == "__main__":
+    with open("example/prompt.hbr", "r") as f:
+        prompt = f.read()
+
+    print(analyze_template(prompt))
+    print(analyze_template("{{#each history}}{{this.content}}{{/each}}"))
+    print(analyze_template("{{#each state.items}}{{name}} {{../state.currency}}{{/each}}"))
@@ -0,0 +1,2 @@
+from .fake_openai import FakeOpenAIConfig, FakeOpenAIServer
+from .cassette import Cassette, RecordingClient, ReplayClient
@@ -0,0 +1,272 @@
+import asyncio
+import gzip
+import json
+import time
+from types import SimpleNamespace
+from typing import List
+from loguru import logger as log
+
+CASSETTE_VERSION = 1
+
+
+class _Record:
+    """Attribute view of a recorded dict, missing fields read as None like the unset fields of openai's models"""
+    __slots__ = ('_data',)
+
+    def __init__(self, data: dict):
+        self._data = data
+
+    def __getattr__(self, name):
+        value = self._data.get(name)
+        if isinstance(value, dict):
+            return _Record(value)
+        if isinstance(value, list):
+            return [_Record(v) if isinstance(v, dict) else v for v in value]
+        return value
+
+    def model_dump(self, **kwargs):
+        return self._data
+
+
+def _dump(obj) -> dict:
+    if obj is None:
+        return None
+    if isinstance(obj, dict):
+        return {k: v for k, v in obj.items() if v is not None}
+    if isinstance(obj, _Record):
+        return obj.model_dump()
+    return obj.model_dump(exclude_none=True)
+
+
+def _describe(kwargs) -> dict:
+    # what the request was, for reading the cassette, replay doesn't match on it
+    messages = kwargs.get("messages") or []
+    tools = kwargs.get("tools") or []
+    return {
+        "model": kwargs.get("model"),
+        "stream": bool(kwargs.get("stream")),
+        "messages": len(messages),
+        "last_role": messages[-1].get("role") if messages else None,
+        "functions": [f.get("name") for f in kwargs.get("functions") or []] + [t["function"].get("name") for t in tools],
+    }
+
+
+class Cassette:
+    """Completions recorded from the API with their timing, one JSON line per interaction (gzipped for .gz paths).
+
+    A streamed interaction keeps when create() returned and every chunk as [offset, delta, finish_reason],
+    offsets in milliseconds from the request, deltas without their unset fields.
+    """
+
+    def __init__(self, interactions: List[dict] = None):
+        self.interactions = interactions or []
+
+    @staticmethod
+    def _open(path, mode):
+        return gzip.open(path, mode + "t", encoding="utf-8") if str(path).endswith(".gz") else open(path, mode, encoding="utf-8")
+
+    @classmethod
+    def load(cls, path) -> "Cassette":
+        with cls._open(path, "r") as f:
+            lines = [json.loads(line) for line in f if line.strip()]
+        interactions = [line for line in lines if "cassette" not in line]
+        for header in (line for line in lines if "cassette" in line):
+            if header["cassette"] > CASSETTE_VERSION:
+                raise ValueError(f"Cassette version {header['cassette']} is newer than {CASSETTE_VERSION}")
+        return cls(interactions)
+
+    def save(self, path):
+        with self._open(path, "w") as f:
+            f.write(json.dumps({"cassette": CASSETTE_VERSION}) + "\n")
+            for interaction in self.interactions:
+                f.write(json.dumps(interaction, separators=(",", ":"), ensure_ascii=False) + "\n")
+
+    @classmethod
+    def append_to(cls, path, interaction: dict):
+        """Appends an interaction to the cassette file, creating it when missing"""
+        try:
+            with cls._open(path, "x") as f:
+                f.write(json.dumps({"cassette": CASSETTE_VERSION}) + "\n")
+        except FileExistsError:
+            pass
+        with cls._open(path, "a") as f:
+            f.write(json.dumps(interaction, separators=(",", ":"), ensure_ascii=False) + "\n")
+
+    def add(self, interaction: dict):
+        self.interactions.append(interaction)
+
+    def stats(self):
+        streams = [i for i in self.interactions if "chunks" in i]
+        gaps = [b[0] - a[0] for i in streams for a, b in zip(i["chunks"], i["chunks"][1:])]
+        return {
+            "interactions": len(self.interactions),
+            "streams": len(streams),
+            "chunks": sum(len(i["chunks"]) for i in streams),
+            "ttft_ms": sum(i["chunks"][0][0] for i in streams if i["chunks"]) / max(len(streams), 1),
+            "gap_ms": sum(gaps) / max(len(gaps), 1),
+        }
+
+
+class _RecordingStream:
+    """Passes the chunks of a stream through, the interaction is recorded at the chunk with the finish reason
+    (consumers stop reading there on function calls) or when the stream is exhausted"""
+
+    def __init__(self, stream, recorder: "RecordingClient", interaction: dict, started: float):
+        self._stream = stream.__aiter__()
+        self._recorder = recorder
+        self._interaction = interaction
+        self._started = started
+        self._recorded = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            chunk = await self._stream.__anext__()
+        except StopAsyncIteration:
+            await self._record()
+            raise
+        offset = round((time.perf_counter() - self._started) * 1000, 1)
+        choice = chunk.choices[0] if chunk.choices else None
+        if choice is None:
+            return chunk
+        self._interaction["chunks"].append([offset, _dump(choice.delta) or {}, choice.finish_reason])
+        if choice.finish_reason:
+            await self._record()
+        return chunk
+
+    async def _record(self):
+        if not self._recorded:
+            self._recorded = True
+            await self._recorder._record(self._interaction)
+
+
+class RecordingClient:
+    """Wraps an AsyncOpenAI client and records its chat completions into a cassette, pass it as the client
+    of LolaAgent. Streams are recorded when consumed up to their finish reason, interrupted ones are left out.
+
+    Args:
+        path: cassette file every interaction is appended to as it completes
+        cassette: Cassette the interactions are added to
+    """
+
+    def __init__(self, client, path=None, cassette: Cassette = None):
+        self._client = client
+        self.path = path
+        self.cassette = cassette if cassette is not None else Cassette()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    async def _create(self, **kwargs):
+        interaction = {"request": _describe(kwargs)}
+        started = time.perf_counter()
+        res = await self._client.chat.completions.create(**kwargs)
+        interaction["created"] = round((time.perf_counter() - started) * 1000, 1)
+        if kwargs.get("stream"):
+            interaction["chunks"] = []
+            return _RecordingStream(res, self, interaction, started)
+        interaction["response"] = [_dump(choice) for choice in res.choices]
+        await self._record(interaction)
+        return res
+
+    async def _record(self, interaction):
+        self.cassette.add(interaction)
+        if self.path:
+            await asyncio.to_thread(Cassette.append_to, self.path, interaction)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+class _ReplayStream:
+    def __init__(self, chunks, speed, started):
+        self._chunks = chunks
+        self._speed = speed
+        self._started = started
+        self._index = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._index >= len(self._chunks):
+            raise StopAsyncIteration
+        offset, delta, finish_reason = self._chunks[self._index]
+        self._index += 1
+        await _sleep_until(self._started, offset, self._speed)
+        return _Record({"choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]})
+
+
+async def _sleep_until(started, offset_ms, speed):
+    # against the start of the request, so the time spent by the consumer doesn't add up
+    if not speed:
+        return
+    loop = asyncio.get_running_loop()
+    delay = started + offset_ms / 1000 / speed - loop.time()
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+
+class ReplayClient:
+    """Stands in for AsyncOpenAI, answering chat completions with the interactions of a cassette in order
+    (from the start again after the last one), with their recorded timing.
+
+    Args:
+        speed: 1 replays at the recorded pace, 10 ten times faster, 0 without waiting at all
+    """
+
+    def __init__(self, cassette: Cassette, speed: float = 1.0):
+        if not cassette.interactions:
+            raise ValueError("Empty cassette")
+        self.cassette = cassette
+        self.speed = speed
+        self.replayed = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    async def _create(self, **kwargs):
+        interactions = self.cassette.interactions
+        interaction = interactions[self.replayed % len(interactions)]
+        self.replayed += 1
+        started = asyncio.get_running_loop().time()
+        if bool(kwargs.get("stream")) != ("chunks" in interaction):
+            log.warning(f"Replaying a {'stream' if 'chunks' in interaction else 'completion'} for a request with stream={kwargs.get('stream')}")
+        await _sleep_until(started, interaction.get("created", 0), self.speed)
+        if "chunks" in interaction:
+            return _ReplayStream(interaction["chunks"], self.speed, started)
+        return _Record({"choices": interaction["response"]})
+
+
+if __name__ == "__main__":
+    import argparse
+    import os
+    from lolapy_lite_agent.agents.lola import LolaAgent
+    from lolapy_lite_agent.chat_lead import ChatLead
+    from lolapy_lite_agent.nlp_job import AgentJob
+
+    parser = argparse.ArgumentParser(description="Inspect a cassette or replay it through LolaAgent.request_stream")
+    parser.add_argument("command", choices=["info", "replay"])
+    parser.add_argument("path")
+    parser.add_argument("--speed", type=float, default=0.0)
+    parser.add_argument("--redis-url", default=os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+    args = parser.parse_args()
+
+    cassette = Cassette.load(args.path)
+    print(cassette.stats())
+
+    if args.command == "replay":
+        async def main():
+            client = ReplayClient(cassette, speed=args.speed)
+            agent = LolaAgent(api_key="replay", redis_url=args.redis_url, client=client)
+            lead = ChatLead("cassette", "test", "tenant", "assistant")
+            ctx = {"prompt": "You are a helpful assistant", "settings": {}, "functions": []}
+            chunks = 0
+            start_wall, start_cpu = time.perf_counter(), time.process_time()
+            for _ in cassette.interactions:
+                job = AgentJob("replay", lead, "Hello", prompt=ctx["prompt"])
+                async for _ in agent.request_stream(job, ctx):
+                    chunks += 1
+            wall, cpu = time.perf_counter() - start_wall, time.process_time() - start_cpu
+            await agent.aclear_history(lead)
+            print(f"{client.replayed} completions, {chunks} results in {wall:.3f}s, {cpu / max(chunks, 1) * 1e6:.1f}us CPU per result")
+
+        asyncio.run(main())
@@ -0,0 +1,328 @@
+import asyncio
+import json
+import random
+import re
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import List, Optional
+from loguru import logger as log
+
+# a token is a word with the whitespace before it, close enough to BPE for pacing the stream
+_TOKEN = re.compile(r'\s*\S+')
+DEFAULT_REPLY = ("Sure, I can help you with that. The current price of Bitcoin is around fifty thousand dollars, "
+                 "it moved a little since yesterday. Is there anything else you would like to know?")
+
+
+@dataclass
+class FakeOpenAIConfig:
+    """Behavior of FakeOpenAIServer.
+
+    ttft: seconds before the first token (or the whole response when not streaming)
+    token_delay: seconds between tokens
+    reply: text of every answer
+    function_calls: calls answered when the request offers functions and its last message is from the user,
+        [{"name": ..., "arguments": "{...}"}]. All of them with the tools API, the first one with functions
+    error_rate: share of requests answered with error_status
+    timeout_rate: share of requests that get no response for timeout_seconds, then the connection is closed
+    stall_rate: share of streams that stop sending in the middle of the reply for timeout_seconds
+    """
+    ttft: float = 0.2
+    token_delay: float = 0.02
+    reply: str = DEFAULT_REPLY
+    function_calls: List[dict] = field(default_factory=list)
+    error_rate: float = 0.0
+    error_status: int = 500
+    timeout_rate: float = 0.0
+    stall_rate: float = 0.0
+    timeout_seconds: float = 30.0
+    seed: Optional[int] = None
+
+
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 429: "Too Many Requests",
+            500: "Internal Server Error", 502: "Bad Gateway", 503: "Service Unavailable"}
+
+
+class FakeOpenAIServer:
+    """Local stand-in for the chat completions endpoint of the OpenAI API, streaming with SSE like the real one.
+
+    Point a client at url to benchmark the agent without cost and without the noise of the real API:
+
+        async with FakeOpenAIServer(FakeOpenAIConfig(ttft=0.3)) as server:
+            agent = LolaAgent(api_key="fake", base_url=server.url, redis_url=...)
+
+    HTTP/1.1 with keep-alive, written on asyncio streams so it needs nothing beyond the standard library.
+    Sync code can run it on the shared background loop: background_loop.run(server.start()).
+    Note that the openai client retries 429 and 5xx errors (max_retries) before raising.
+    """
+
+    def __init__(self, config: FakeOpenAIConfig = None, host="127.0.0.1", port=0):
+        self.config = config or FakeOpenAIConfig()
+        self.host = host
+        self.port = port
+        self._server = None
+        # open client connections, Server.wait_closed waits for them on Python 3.12+
+        self._writers = set()
+        self._random = random.Random(self.config.seed)
+        self._stats = {'requests': 0, 'streams': 0, 'errors': 0, 'timeouts': 0, 'stalls': 0, 'active': 0, 'max_active': 0}
+
+    @property
+    def url(self) -> str:
+        """base_url for the openai client"""
+        return f"http://{self.host}:{self.port}/v1"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        log.info(f"Fake OpenAI server on {self.url}")
+        return self
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            # idle keep-alive connections of the clients would hold wait_closed forever
+            for writer in list(self._writers):
+                writer.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start()
+        await self._server.serve_forever()
+
+    def stats(self):
+        return dict(self._stats)
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._writers.add(writer)
+        try:
+            while True:
+                request = await _read_request(reader)
+                if request is None:
+                    break
+                method, path, body = request
+                if not await self._handle(method, path, body, writer):
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # connections still open when the loop shuts down
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _handle(self, method, path, body, writer) -> bool:
+        """Answers a request, False when the connection must be closed"""
+        path = path.split("?")[0].rstrip("/")
+        if method == "GET" and path.endswith("/models"):
+            await _write_json(writer, 200, {"object": "list", "data": [{"id": "fake", "object": "model"}]})
+            return True
+        if method != "POST" or not path.endswith("/chat/completions"):
+            await _write_json(writer, 404, _error("Unknown endpoint", "invalid_request_error"))
+            return True
+        try:
+            payload = json.loads(body or b"{}")
+        except ValueError:
+            await _write_json(writer, 400, _error("Invalid JSON body", "invalid_request_error"))
+            return True
+
+        config = self.config
+        stats = self._stats
+        stats['requests'] += 1
+        stats['active'] += 1
+        stats['max_active'] = max(stats['max_active'], stats['active'])
+        try:
+            if self._random.random() < config.timeout_rate:
+                stats['timeouts'] += 1
+                await asyncio.sleep(config.timeout_seconds)
+                return False
+            if self._random.random() < config.error_rate:
+                stats['errors'] += 1
+                await asyncio.sleep(config.ttft)
+                await _write_json(writer, config.error_status, _error("Injected error", "server_error"))
+                return True
+
+            if payload.get("stream"):
+                stats['streams'] += 1
+                await self._stream(payload, writer)
+            else:
+                await asyncio.sleep(config.ttft + config.token_delay * len(_TOKEN.findall(config.reply)))
+                await _write_json(writer, 200, self._completion(payload))
+            return True
+        finally:
+            stats['active'] -= 1
+
+    def _calls(self, payload):
+        """Function calls to answer the request with, None for a text answer"""
+        messages = payload.get("messages") or []
+        last = messages[-1].get("role") if messages else None
+        if not self.config.function_calls or last != "user":
+            return None
+        if payload.get("tools"):
+            return "tool_calls", self.config.function_calls
+        if payload.get("functions"):
+            return "function_call", self.config.function_calls[:1]
+        return None
+
+    def _reply_tokens(self, payload):
+        tokens = _TOKEN.findall(self.config.reply)
+        max_tokens = payload.get("max_tokens")
+        if max_tokens and len(tokens) > int(max_tokens):
+            return tokens[:int(max_tokens)], "length"
+        return tokens, "stop"
+
+    def _completion(self, payload):
+        message = {"role": "assistant", "content": None}
+        calls = self._calls(payload)
+        if calls and calls[0] == "tool_calls":
+            message["tool_calls"] = [{"id": _call_id(), "type": "function", "function": dict(c)} for c in calls[1]]
+            finish_reason = "tool_calls"
+        elif calls:
+            message["function_call"] = dict(calls[1][0])
+            finish_reason = "function_call"
+        else:
+            tokens, finish_reason = self._reply_tokens(payload)
+            message["content"] = "".join(tokens)
+        res = _chunk(payload, "chat.completion")
+        res["choices"] = [{"index": 0, "message": message, "finish_reason": finish_reason}]
+        res["usage"] = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+        return res
+
+    async def _stream(self, payload, writer):
+        config = self.config
+        writer.write(b"HTTP/1.1 200 OK\r\ncontent-type: text/event-stream\r\ncache-control: no-cache\r\n"
+                     b"transfer-encoding: chunked\r\n\r\n")
+        await asyncio.sleep(config.ttft)
+
+        calls = self._calls(payload)
+        deltas = [{"role": "assistant", "content": ""}]
+        if calls and calls[0] == "tool_calls":
+            for index, call in enumerate(calls[1]):
+                deltas.append({"tool_calls": [{"index": index, "id": _call_id(), "type": "function",
+                                               "function": {"name": call["name"], "arguments": ""}}]})
+                for piece in _TOKEN.findall(call.get("arguments") or ""):
+                    deltas.append({"tool_calls": [{"index": index, "function": {"arguments": piece}}]})
+            finish_reason = "tool_calls"
+        elif calls:
+            call = calls[1][0]
+            deltas.append({"function_call": {"name": call["name"], "arguments": ""}})
+            for piece in _TOKEN.findall(call.get("arguments") or ""):
+                deltas.append({"function_call": {"arguments": piece}})
+            finish_reason = "function_call"
+        else:
+            tokens, finish_reason = self._reply_tokens(payload)
+            deltas += [{"content": token} for token in tokens]
+
+        stall_at = None
+        if self._random.random() < config.stall_rate:
+            self._stats['stalls'] += 1
+            stall_at = len(deltas) // 2
+
+        base = _chunk(payload, "chat.completion.chunk")
+        for i, delta in enumerate(deltas):
+            if i == stall_at:
+                await asyncio.sleep(config.timeout_seconds)
+            elif i > 1:
+                await asyncio.sleep(config.token_delay)
+            await _write_event(writer, {**base, "choices": [{"index": 0, "delta": delta, "finish_reason": None}]})
+        await _write_event(writer, {**base, "choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason}]})
+        _write_chunk(writer, b"data: [DONE]\n\n")
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+
+def _call_id():
+    return "call_" + uuid.uuid4().hex[:24]
+
+
+def _chunk(payload, kind):
+    return {
+        "id": "chatcmpl-" + uuid.uuid4().hex[:24],
+        "object": kind,
+        "created": int(time.time()),
+        "model": payload.get("model") or "fake",
+    }
+
+
+def _error(message, kind):
+    return {"error": {"message": message, "type": kind, "param": None, "code": None}}
+
+
+async def _read_request(reader: asyncio.StreamReader):
+    """Method, path and body of the next request on the connection, None when the client closed it"""
+    line = await reader.readline()
+    if not line:
+        return None
+    method, path, _ = line.decode("latin-1").split(" ", 2)
+    length = 0
+    while True:
+        header = await reader.readline()
+        if header in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = header.decode("latin-1").partition(":")
+        if name.strip().lower() == "content-length":
+            length = int(value.strip())
+    body = await reader.readexactly(length) if length else b""
+    return method, path, body
+
+
+def _write_chunk(writer, data: bytes):
+    writer.write(b"%x\r\n%s\r\n" % (len(data), data))
+
+
+async def _write_event(writer, event):
+    _write_chunk(writer, b"data: " + json.dumps(event).encode() + b"\n\n")
+    await writer.drain()
+
+
+async def _write_json(writer, status, body):
+    data = json.dumps(body).encode()
+    writer.write(b"HTTP/1.1 %d %s\r\ncontent-type: application/json\r\ncontent-length: %d\r\n\r\n%s"
+                 % (status, _REASONS.get(status, "Error").encode(), len(data), data))
+    await writer.drain()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Fake OpenAI chat completions server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--ttft", type=float, default=0.2)
+    parser.add_argument("--token-delay", type=float, default=0.02)
+    parser.add_argument("--reply", default=DEFAULT_REPLY)
+    parser.add_argument("--function-call", action="append", default=[], metavar="NAME:ARGUMENTS",
+                        help='answer with a function call, e.g. get_price:{"cryptocurrency":"BTC"}')
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--timeout-rate", type=float, default=0.0)
+    parser.add_argument("--stall-rate", type=float, default=0.0)
+    parser.add_argument("--timeout-seconds", type=float, default=30.0)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    config = FakeOpenAIConfig(
+        ttft=args.ttft,
+        token_delay=args.token_delay,
+        reply=args.reply,
+        function_calls=[{"name": name, "arguments": arguments or "{}"}
+                        for name, _, arguments in (f.partition(":") for f in args.function_call)],
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        timeout_rate=args.timeout_rate,
+        stall_rate=args.stall_rate,
+        timeout_seconds=args.timeout_seconds,
+        seed=args.seed,
+    )
+    try:
+        asyncio.run(FakeOpenAIServer(config, args.host, args.port).serve_forever())
+    except KeyboardInterrupt:
+        pass
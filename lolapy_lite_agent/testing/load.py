@@ -0,0 +1,343 @@
+import asyncio
+import json
+import os
+import platform
+import resource
+import time
+from dataclasses import asdict, dataclass, field, replace
+from functools import lru_cache
+from importlib import metadata
+from typing import List
+import redis
+from loguru import logger as log
+from lolapy_lite_agent.agent_controller import AgentController
+from lolapy_lite_agent.agent_runtime import AgentRuntime
+from lolapy_lite_agent.chat_lead import ChatLead
+from lolapy_lite_agent.openai_clients import openai_clients
+from lolapy_lite_agent.history.history_buffer import DURABILITIES, WRITE_THROUGH
+from lolapy_lite_agent.redis_pool import redis_pools
+from lolapy_lite_agent.testing.cassette import Cassette, ReplayClient
+from lolapy_lite_agent.testing.fake_openai import FakeOpenAIConfig, FakeOpenAIServer
+
+try:
+    import fakeredis
+    import fakeredis.aioredis
+except ImportError:
+    fakeredis = None
+
+DEFAULT_PROMPT = """
+<settings model="gpt-4-1106-preview" max_tokens="400" max_history_length="10"></settings>
+You are {{state.name}}, the assistant of a bank. Answer in the language of the user.
+<function name="get_cryptocurrency_price" description="Get the current cryptocurrency price">
+    <parameters type="object">
+        <param name="cryptocurrency" type="string" description="The cryptocurrency abbreviation eg. BTC, ETH"/>
+    </parameters>
+</function>
+"""
+
+MESSAGES = [
+    "Puedo sacar un préstamos",
+    "What is the BTC price?",
+    "Cuál es mi saldo?",
+    "Thanks, that's all for now",
+]
+
+# pools of the in-memory Redis of fake_redis runs, their connections go to a fakeredis server in the process
+FAKE_REDIS_URL = "redis://fakeredis:6379/0"
+
+
+@dataclass
+class LoadConfig:
+    """A load run: leads sending turns messages each, all leads at once.
+
+    driver: "runtime" serves every lead with one AgentRuntime, "controller" builds an AgentController per lead
+    think_time: seconds a lead waits between its turns
+    cassette: replay this cassette in process instead of streaming from the fake server
+    fake_redis: keep the history and state in memory with fakeredis instead of the Redis at redis_url,
+        no server is needed (pip install lolapy-lite-agent[testing]). The commands per turn aren't reported
+    """
+    leads: int = 100
+    turns: int = 3
+    think_time: float = 0.0
+    driver: str = "runtime"
+    redis_url: str = "redis://localhost:6379/0"
+    fake_redis: bool = False
+    prompt: str = DEFAULT_PROMPT
+    tools: bool = False
+    history_durability: str = WRITE_THROUGH
+    cassette: str = None
+    speed: float = 1.0
+    fake: FakeOpenAIConfig = field(default_factory=FakeOpenAIConfig)
+
+
+def lead_event(index: int, text: str) -> dict:
+    """Incoming message event shaped like example/event_generator.gen_event, with a lead per index"""
+    lead = {
+        'tenantId': 'load-tenant',
+        'assistantId': 'load-assistant',
+        'channelSource': 'load',
+        'conversationId': index,
+        'signature': None,
+        'metadata': {'id': f'load-{index}', 'name': f'Lead {index}', 'metadata': {}},
+    }
+    return {
+        'event': 'onTextMessage',
+        'lead': lead,
+        'data': {'message': {'type': 'message', 'lead': lead, 'text': text}},
+    }
+
+
+def lead_from_event(event: dict) -> ChatLead:
+    lead = event['lead']
+    return ChatLead(lead['metadata']['id'], lead['channelSource'], lead['tenantId'], lead['assistantId'],
+                    metadata=lead['metadata'], signature=lead.get('signature'))
+
+
+def percentiles(values: List[float]) -> dict:
+    """p50/p95/p99 (nearest rank), mean and max of values in seconds, reported in milliseconds"""
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def rank(p):
+        return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))] * 1000
+
+    return {
+        'p50': round(rank(50), 2),
+        'p95': round(rank(95), 2),
+        'p99': round(rank(99), 2),
+        'mean': round(sum(values) / len(values) * 1000, 2),
+        'max': round(values[-1] * 1000, 2),
+    }
+
+
+def _rss() -> int:
+    """Resident set size in bytes, the peak when /proc isn't available"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+async def _redis_commands(client) -> int:
+    # commands processed by the server, from every client of it, None when the server doesn't report them
+    try:
+        return (await client.info("stats"))["total_commands_processed"]
+    except (redis.RedisError, KeyError, TypeError, ValueError):
+        return None
+
+
+@lru_cache(maxsize=None)
+def _fake_redis_url() -> str:
+    # one fakeredis server for the process, shared by the sync and async pools of every loop
+    if fakeredis is None:
+        raise RuntimeError("fake_redis needs fakeredis, pip install lolapy-lite-agent[testing]")
+    # no PING health checks, fakeredis connections fail them
+    redis_pools.set_connection_class(FAKE_REDIS_URL, fakeredis.FakeConnection, fakeredis.aioredis.FakeConnection,
+                                     server=fakeredis.FakeServer(), health_check_interval=0)
+    return FAKE_REDIS_URL
+
+
+def _round_trips(redis_url) -> int:
+    # checkouts of this process' async pools, a command or a pipeline each
+    return (redis_pools.stats().get(redis_url, {}).get('async') or {}).get('checkouts', 0)
+
+
+class _Driver:
+    def __init__(self, config: LoadConfig, base_url, client):
+        self.config = config
+        self.runtime = None
+        self.controllers = {}
+        if config.driver == "runtime":
+            self.runtime = AgentRuntime("fake", redis_url=config.redis_url, base_url=base_url, client=client,
+                                        tools=config.tools, on_function_call=_function_response,
+                                        history_durability=config.history_durability)
+        elif config.driver != "controller":
+            raise ValueError(f"Unknown driver {config.driver}")
+        self._base_url = base_url
+        self._client = client
+
+    def open(self, lead: ChatLead):
+        if self.runtime is None:
+            self.controllers[lead.get_token()] = AgentController(
+                self.config.prompt, lead.get_token(), "fake",
+                on_function_call=_function_response,
+                redis_url=self.config.redis_url,
+                init_state={"name": "Lola"},
+                tools=self.config.tools,
+                base_url=self._base_url,
+                client=self._client)
+
+    def stream(self, lead: ChatLead, text: str):
+        if self.runtime is not None:
+            return self.runtime.stream_message(lead, self.config.prompt, text, init_state={"name": "Lola"})
+        return self.controllers[lead.get_token()].astream_message(text)
+
+    async def close(self):
+        if self.runtime is not None:
+            await self.runtime.aclose()
+        for controller in self.controllers.values():
+            await controller.agent.aclose()
+
+    async def clear(self, lead: ChatLead):
+        if self.runtime is not None:
+            await self.runtime.agent.aclear_history(lead)
+        else:
+            await self.controllers[lead.get_token()].agent.aclear_history(self.controllers[lead.get_token()].lead)
+
+
+def _function_response(lead, name, arguments):
+    return "BTC price is $50,000"
+
+
+async def run_load(config: LoadConfig) -> dict:
+    """Runs the load and returns the report"""
+    if config.fake_redis:
+        config = replace(config, redis_url=_fake_redis_url())
+    server = None
+    client = None
+    base_url = None
+    if config.cassette:
+        client = ReplayClient(Cassette.load(config.cassette), speed=config.speed)
+    else:
+        server = await FakeOpenAIServer(config.fake).start()
+        base_url = server.url
+
+    driver = _Driver(config, base_url, client)
+    # a turn of a lead outside the run first: imports, the compiled prompt, the pools and the clients are
+    # in memory before RSS is sampled, the growth is then what the leads cost
+    warm_up = lead_from_event(lead_event(config.leads, ""))
+    driver.open(warm_up)
+    try:
+        async for _ in driver.stream(warm_up, MESSAGES[0]):
+            pass
+    except Exception as e:
+        log.warning(f"Warm-up turn failed: {e}")
+    await driver.clear(warm_up)
+
+    redis_client = redis_pools.async_client(config.redis_url)
+    commands_before = await _redis_commands(redis_client)
+    round_trips_before = _round_trips(config.redis_url)
+    rss_before = _rss()
+
+    leads = [lead_from_event(lead_event(i, "")) for i in range(config.leads)]
+    for lead in leads:
+        driver.open(lead)
+
+    ttft, latency = [], []
+    errors = 0
+
+    async def run_lead(index, lead):
+        nonlocal errors
+        for turn in range(config.turns):
+            text = lead_event(index, MESSAGES[(index + turn) % len(MESSAGES)])['data']['message']['text']
+            start = time.perf_counter()
+            first = None
+            try:
+                async for _ in driver.stream(lead, text):
+                    if first is None:
+                        first = time.perf_counter()
+                        ttft.append(first - start)
+                latency.append(time.perf_counter() - start)
+            except Exception as e:
+                errors += 1
+                log.warning(f"Turn of {lead.get_token()} failed: {e}")
+            if config.think_time:
+                await asyncio.sleep(config.think_time)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[run_lead(i, lead) for i, lead in enumerate(leads)])
+    duration = time.perf_counter() - start
+    rss_after = _rss()
+    # the history written behind the responses, counted with the run's round trips
+    await driver.close()
+
+    turns = len(latency)
+    round_trips = _round_trips(config.redis_url) - round_trips_before
+    commands_after = await _redis_commands(redis_client)
+    commands = commands_after - commands_before if commands_after is not None and commands_before is not None else None
+
+    for lead in leads:
+        await driver.clear(lead)
+    # the shared clients of the run keep connections to the fake server open
+    await openai_clients.aclose()
+    if server is not None:
+        await server.close()
+
+    run = asdict(config)
+    run.pop('prompt')
+    return {
+        'version': _version(),
+        'python': platform.python_version(),
+        'config': run,
+        'turns': turns,
+        'errors': errors,
+        'duration_s': round(duration, 3),
+        'turns_per_s': round(turns / duration, 2) if duration else 0,
+        'ttft_ms': percentiles(ttft),
+        'turn_ms': percentiles(latency),
+        'redis': {
+            'commands_per_turn': round(commands / turns, 2) if turns and commands is not None else None,
+            'round_trips_per_turn': round(round_trips / turns, 2) if turns else 0,
+        },
+        'rss_mb': round(rss_after / 2 ** 20, 1),
+        # growth over the run: the leads with their sessions, connections and buffers under load
+        'rss_per_1k_leads_mb': round((rss_after - rss_before) / 2 ** 20 / config.leads * 1000, 2) if config.leads else 0,
+        'fake_openai': server.stats() if server is not None else None,
+    }
+
+
+def _version():
+    try:
+        return metadata.version('lolapy-lite-agent')
+    except metadata.PackageNotFoundError:
+        return None
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Concurrent load on the agent stack, prints a JSON report")
+    parser.add_argument("--leads", type=int, default=100)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--think-time", type=float, default=0.0)
+    parser.add_argument("--driver", choices=["runtime", "controller"], default="runtime")
+    parser.add_argument("--redis-url", default=os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+    parser.add_argument("--redis", choices=["server", "fake"], default="server",
+                        help="fake keeps the data in memory with fakeredis instead of the server at --redis-url")
+    parser.add_argument("--tools", action="store_true")
+    parser.add_argument("--history-durability", choices=DURABILITIES, default=WRITE_THROUGH)
+    parser.add_argument("--ttft", type=float, default=0.2)
+    parser.add_argument("--token-delay", type=float, default=0.02)
+    parser.add_argument("--function-call", action="store_true", help="the fake answers the first message with a function call")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--cassette", help="replay a cassette instead of the fake server")
+    parser.add_argument("--speed", type=float, default=1.0)
+    parser.add_argument("--out", help="write the report to this file")
+    args = parser.parse_args()
+
+    config = LoadConfig(
+        leads=args.leads,
+        turns=args.turns,
+        think_time=args.think_time,
+        driver=args.driver,
+        redis_url=args.redis_url,
+        fake_redis=args.redis == "fake",
+        tools=args.tools,
+        history_durability=args.history_durability,
+        cassette=args.cassette,
+        speed=args.speed,
+        fake=FakeOpenAIConfig(
+            ttft=args.ttft,
+            token_delay=args.token_delay,
+            function_calls=[{"name": "get_cryptocurrency_price", "arguments": '{"cryptocurrency": "BTC"}'}] if args.function_call else [],
+            error_rate=args.error_rate,
+            seed=0,
+        ),
+    )
+    report = json.dumps(asyncio.run(run_load(config)), indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(report + "\n")
+    print(report)
@@ -0,0 +1,424 @@
+import json
+import os
+import platform
+import sys
+import timeit
+from collections.abc import Callable
+from typing import Dict, List
+import redis
+from loguru import logger as log
+from lolapy_lite_agent.chat_lead import ChatLead
+from lolapy_lite_agent.handlebars_helpers import get_handlebars_compiler, get_helpers
+from lolapy_lite_agent.nlp_job import AgentJob
+from lolapy_lite_agent.pml.function_plugin import PmlFunctionsPlugin
+from lolapy_lite_agent.pml.pml_builder import PMLBuilder
+from lolapy_lite_agent.prompt_artifact import PromptArtifact
+from lolapy_lite_agent.token_counter import count_message_tokens
+
+# a benchmark fails the check when it is this much slower than its baseline, in percent
+DEFAULT_THRESHOLD = 15.0
+HISTORY_LENGTHS = (10, 100, 1000)
+
+_FUNCTION = """
+<function name="{name}" description="Get the current price of an asset, {name}">
+    <parameters type="object">
+        <param name="asset" type="string" description="The asset abbreviation eg. BTC, ETH" required="true"/>
+        <param name="currency" type="string" enum="USD,ARS,EUR" />
+        <param name="date" type="string" description="Date of the price, today when missing" />
+    </parameters>
+</function>
+"""
+
+_SMALL = """<settings model="gpt-4-0613" max_tokens="800"></settings>
+You are {{state.name}}, a helpful assistant."""
+
+_REALISTIC = """{{!-- banking assistant --}}
+<settings
+    model="gpt-4-0613"
+    temperature="0.0"
+    top_p="0.0"
+    max_tokens="800"
+    disable_tts="true"
+    max_history_length="10"
+></settings>
+
+Create an AI Assistant named {{state.name}} that provides support to the customers of a bank.
+The customer name is {{state.customer}}, answer in {{state.language}}.
+{{#if state.premium}}The customer is premium, offer the premium products first.{{else}}Offer the basic products.{{/if}}
+
+Products:
+- Personal loans, up to 12 months
+- Credit cards, with cashback
+- Savings accounts
+
+Customer data:
+{{key_value state.profile}}
+
+<!-- internal note, not sent -->
+<embedding collection="faq" query="{{message}}" maxDistance="0.30" knn="1"></embedding>
+""" + "".join(_FUNCTION.format(name=f"get_price_{i}") for i in range(3))
+
+# the realistic prompt with a long knowledge base, many functions and the history in the prompt
+_LARGE = (_REALISTIC
+          + "\nKnowledge base:\n" + "".join(f"- Question {i}: how do I do thing {i}? Answer: follow steps {i}.1 to {i}.9.\n" for i in range(400))
+          + "".join(_FUNCTION.format(name=f"get_rate_{i}") for i in range(40))
+          + "\nConversation so far:\n{{#each history}}{{role}}: {{content}}\n{{/each}}")
+
+PROMPTS = {'small': _SMALL, 'realistic': _REALISTIC, 'large': _LARGE}
+
+STATE = {
+    'name': 'Lola',
+    'customer': 'John Doe',
+    'language': 'English',
+    'premium': True,
+    'profile': {'age': 42, 'city': 'Buenos Aires', 'accounts': 3, 'cards': 2},
+}
+
+
+def _history(count):
+    return [{"role": "user" if i % 2 == 0 else "assistant", "content": f"Message number {i} of the conversation"} for i in range(count)]
+
+
+class Benchmark:
+    """A timed operation, setup builds it and returns the callable to time and an optional cleanup"""
+
+    def __init__(self, name: str, setup: Callable, redis=False):
+        self.name = name
+        self.setup = setup
+        self.redis = redis
+
+
+_benchmarks: List[Benchmark] = []
+
+
+def benchmark(name, redis=False):
+    def register(setup):
+        _benchmarks.append(Benchmark(name, setup, redis))
+        return setup
+    return register
+
+
+def measure(fn, min_time=0.2, repeat=5) -> float:
+    """Seconds per call, the best of repeat runs of about min_time seconds each"""
+    timer = timeit.Timer(fn)
+    number, elapsed = timer.autorange()
+    number = max(1, int(number * min_time / max(elapsed, 1e-9)))
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+# pml and templates
+
+for _size, _prompt in PROMPTS.items():
+    def _bind(size, prompt):
+        rendered = PromptArtifact(prompt).render({'state': STATE, 'history': _history(10), 'message': 'Hi'})
+
+        @benchmark(f"pml.compile.{size}")
+        def pml_compile(url):
+            def run():
+                functions = []
+                builder = PMLBuilder(rendered)
+                builder.register_plugin(PmlFunctionsPlugin(None, functions.append))
+                builder.compile()
+            return run, None
+
+        @benchmark(f"pml.compile_dom.{size}")
+        def pml_compile_dom(url):
+            def run():
+                functions = []
+                builder = PMLBuilder(rendered, engine="bs4")
+                # returns the replacement of the element, the DOM engine logs an error for None
+                builder.register_plugin(PmlFunctionsPlugin(None, lambda func: functions.append(func) or ''))
+                builder.compile()
+            return run, None
+
+        @benchmark(f"prompt.artifact.{size}")
+        def prompt_artifact(url):
+            # the cold path: a prompt seen for the first time
+            return lambda: PromptArtifact(prompt), None
+
+        @benchmark(f"prompt.compile.{size}", redis=True)
+        def prompt_compile(url):
+            from lolapy_lite_agent.history.history_redis_provider import RedisHistoryProvider
+            from lolapy_lite_agent.prompt_compiler import PromptCompiler
+            from lolapy_lite_agent.state.state_redis_provider import RedisChatStateProvider
+
+            lead = ChatLead(f"bench-prompt-{size}", "bench", "tenant", "assistant")
+            history_store = RedisHistoryProvider(url)
+            state_store = RedisChatStateProvider(url)
+            history_store.clear_history(lead)
+            for entry in _history(10):
+                history_store.append_to_history(lead, entry)
+            state_store.set_store(lead, {'customer': 'John Doe', 'language': 'English'})
+            compiler = PromptCompiler(AgentJob("bench", lead, "Hi", prompt=prompt), prompt, history_store, state_store)
+
+            def cleanup():
+                history_store.clear_history(lead)
+                state_store.clear_store(lead)
+            return lambda: compiler.process(init_state=STATE), cleanup
+
+    _bind(_size, _prompt)
+
+
+@benchmark("pml.functions_plugin")
+def functions_plugin(url):
+    from bs4 import BeautifulSoup
+
+    element = BeautifulSoup(_FUNCTION.format(name="get_price"), 'lxml').find("function")
+    plugin = PmlFunctionsPlugin(None, lambda func: None)
+    builder = PMLBuilder("")
+    return lambda: plugin.process(element, element.attrs, "", builder), None
+
+
+@benchmark("handlebars.helpers")
+def handlebars_helpers(url):
+    # if_equals and if_not_equals take options last, pybars passes it second to block helpers, they can't render
+    template = get_handlebars_compiler().compile(
+        '{{key_value state.profile}}{{json state.profile}}{{json_pretty state.profile}}{{json_pretty_no_escaping state}}')
+    helpers = get_helpers()
+    ctx = {'state': STATE}
+    return lambda: template(ctx, helpers=helpers), None
+
+
+# codecs of the stored values
+
+def _codecs():
+    from lolapy_lite_agent import serialization
+
+    codecs = {'json': serialization.default_codec, 'json_zlib': serialization.Codec(compression="zlib")}
+    if serialization.msgpack is not None:
+        codecs['msgpack'] = serialization.Codec("msgpack")
+    return codecs
+
+
+for _name, _codec in _codecs().items():
+    def _bind_codec(name, codec):
+        entries = _history(100)
+
+        @benchmark(f"codec.encode_history.{name}")
+        def codec_encode(url):
+            return lambda: [codec.encode(entry) for entry in entries], None
+
+        @benchmark(f"codec.decode_history.{name}")
+        def codec_decode(url):
+            values = [codec.encode(entry) for entry in entries]
+            return lambda: codec.decode_many(values), None
+
+    _bind_codec(_name, _codec)
+
+
+# history messages as the providers return them, and as the client takes them
+
+@benchmark("messages.load.100")
+def messages_load(url):
+    from lolapy_lite_agent.chat_message import load_messages
+
+    values = [json.dumps(entry).encode() for entry in _history(100)]
+    return lambda: load_messages(values), None
+
+
+@benchmark("messages.to_dict.100")
+def messages_to_dict(url):
+    from lolapy_lite_agent.chat_message import ChatMessage
+
+    messages = [ChatMessage.from_dict(entry) for entry in _history(100)]
+    return lambda: [m.to_dict() for m in messages], None
+
+
+# redis providers
+
+for _length in HISTORY_LENGTHS:
+    def _bind_history(length):
+        def provider(url):
+            from lolapy_lite_agent.history.history_redis_provider import RedisHistoryProvider
+
+            lead = ChatLead(f"bench-history-{length}", "bench", "tenant", "assistant")
+            store = RedisHistoryProvider(url)
+            store.clear_history(lead)
+            # seeded in one round trip, appending a thousand messages one by one dominates the run
+            pipe = store.client.pipeline(transaction=False)
+            for entry in _history(length):
+                pipe.rpush(store.get_key(lead), json.dumps(entry))
+                pipe.rpush(store.get_tokens_key(lead), count_message_tokens(entry))
+            pipe.execute()
+            return store, lead
+
+        @benchmark(f"history.get_history.{length}", redis=True)
+        def get_history(url):
+            store, lead = provider(url)
+            return lambda: store.get_history(lead), lambda: store.clear_history(lead)
+
+        @benchmark(f"history.get_last_messages.{length}", redis=True)
+        def get_last_messages(url):
+            store, lead = provider(url)
+            return lambda: store.get_last_messages(lead, 10), lambda: store.clear_history(lead)
+
+        @benchmark(f"history.append.{length}", redis=True)
+        def append(url):
+            store, lead = provider(url)
+            entry = {"role": "user", "content": "What is the BTC price?"}
+            return lambda: store.append_to_history(lead, entry), lambda: store.clear_history(lead)
+
+    _bind_history(_length)
+
+
+@benchmark("state.get_store", redis=True)
+def state_get_store(url):
+    from lolapy_lite_agent.state.state_redis_provider import RedisChatStateProvider
+
+    lead = ChatLead("bench-state", "bench", "tenant", "assistant")
+    store = RedisChatStateProvider(url)
+    store.set_store(lead, {k: json.dumps(v) if isinstance(v, dict) else v for k, v in STATE.items()})
+    return lambda: store.get_store(lead), lambda: store.clear_store(lead)
+
+
+def _cache_aside(url, wait_for_redis=True):
+    from lolapy_lite_agent.caching import MemRedisCacheAside
+
+    cache = MemRedisCacheAside(url, "bench:cache:", wait_for_redis=wait_for_redis)
+    cache.set("hit", STATE)
+    return cache
+
+
+@benchmark("cache_aside.get.memory_hit", redis=True)
+def cache_get_memory_hit(url):
+    cache = _cache_aside(url)
+    return lambda: cache.get("hit"), cache.clear_redis
+
+
+@benchmark("cache_aside.get.redis_hit", redis=True)
+def cache_get_redis_hit(url):
+    cache = _cache_aside(url)
+
+    def run():
+        cache.delete("hit")
+        cache.get("hit")
+    return run, cache.clear_redis
+
+
+@benchmark("cache_aside.get.miss", redis=True)
+def cache_get_miss(url):
+    cache = _cache_aside(url)
+    return lambda: cache.get("missing"), cache.clear_redis
+
+
+@benchmark("cache_aside.set", redis=True)
+def cache_set(url):
+    cache = _cache_aside(url)
+    return lambda: cache.set("key", STATE), cache.clear_redis
+
+
+def run_benchmarks(redis_url=None, only=None, min_time=0.2) -> Dict[str, dict]:
+    """Runs the benchmarks whose name contains only (all when None), the ones using Redis when it answers
+    and the ones whose dependencies are installed. Returns microseconds per call by name."""
+    if redis_url:
+        try:
+            redis.Redis.from_url(redis_url).ping()
+        except (redis.RedisError, ValueError) as e:
+            log.warning(f"Redis benchmarks skipped, {redis_url} is not reachable: {e}")
+            redis_url = None
+
+    results = {}
+    for bench in _benchmarks:
+        if only and only not in bench.name:
+            continue
+        if bench.redis and not redis_url:
+            continue
+        try:
+            fn, cleanup = bench.setup(redis_url)
+        except ImportError as e:
+            # e.g. the cache-aside benchmarks without the caching extras, the others still run
+            log.warning(f"{bench.name} skipped, its dependencies can't be imported: {e}")
+            continue
+        try:
+            results[bench.name] = {'us': round(measure(fn, min_time) * 1e6, 3)}
+        finally:
+            if cleanup:
+                cleanup()
+        log.info(f"{bench.name:40} {results[bench.name]['us']:12.3f} us")
+    return results
+
+
+def save_baseline(results: Dict[str, dict], path, thresholds: Dict[str, float] = None):
+    """Writes the results as a baseline, keeping the per benchmark thresholds of the file it replaces"""
+    try:
+        with open(path) as f:
+            thresholds = {**json.load(f).get('thresholds', {}), **(thresholds or {})}
+    except (OSError, ValueError):
+        pass
+    baseline = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': results,
+        'thresholds': thresholds or {},
+    }
+    with open(path, "w") as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def compare(results: Dict[str, dict], baseline: dict, threshold=DEFAULT_THRESHOLD) -> List[dict]:
+    """The benchmarks slower than their baseline by more than their threshold (the baseline's
+    per benchmark thresholds, threshold otherwise), benchmarks missing on one side are ignored, see missing"""
+    regressions = []
+    for name, base in baseline.get('results', {}).items():
+        current = results.get(name)
+        if current is None or not base.get('us'):
+            continue
+        limit = baseline.get('thresholds', {}).get(name, threshold)
+        change = (current['us'] / base['us'] - 1) * 100
+        if change > limit:
+            regressions.append({'name': name, 'baseline_us': base['us'], 'us': current['us'],
+                                'change': round(change, 1), 'threshold': limit})
+    return regressions
+
+
+def missing(results: Dict[str, dict], baseline: dict, only=None) -> List[str]:
+    """The benchmarks of the baseline (whose name contains only) that didn't run, e.g. skipped without Redis"""
+    return [name for name in baseline.get('results', {}) if (not only or only in name) and name not in results]
+
+
+def foreign(baseline: dict) -> List[str]:
+    """How the baseline's interpreter and machine differ from this one, timings only compare on the same"""
+    here = {'python': platform.python_version(), 'machine': platform.machine()}
+    return [f"{key} {baseline.get(key)} != {value}" for key, value in here.items() if baseline.get(key) != value]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the prompt compiler and the Redis providers")
+    sub = parser.add_subparsers(dest="command", required=True)
+    run_parser = sub.add_parser("run", help="run the benchmarks, optionally saving them as the baseline")
+    run_parser.add_argument("--save", metavar="BASELINE")
+    check_parser = sub.add_parser("check", help="run the benchmarks and fail when one regressed against the baseline")
+    # timings depend on the machine, the baseline is saved locally with run --save and not shipped
+    check_parser.add_argument("baseline", help="baseline saved on this machine with run --save")
+    check_parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="allowed slowdown in percent")
+    for p in (run_parser, check_parser):
+        p.add_argument("--redis-url", default=os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+        p.add_argument("--filter", help="only the benchmarks whose name contains this")
+        p.add_argument("--min-time", type=float, default=0.2, help="seconds per timed run")
+    args = parser.parse_args()
+
+    log.remove()
+    log.add(sys.stderr, level="INFO")
+    results = run_benchmarks(args.redis_url, args.filter, args.min_time)
+
+    if args.command == "run":
+        if args.save:
+            save_baseline(results, args.save)
+        print(json.dumps(results, indent=2))
+    else:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        for difference in foreign(baseline):
+            print(f"WARNING baseline from another environment: {difference}")
+        regressions = compare(results, baseline, args.threshold)
+        skipped = missing(results, baseline, args.filter)
+        for r in regressions:
+            print(f"REGRESSION {r['name']}: {r['baseline_us']} -> {r['us']} us (+{r['change']}%, threshold {r['threshold']}%)")
+        for name in skipped:
+            print(f"MISSING {name}: in the baseline but not run")
+        if not regressions and not skipped:
+            print(f"{len(results)} benchmarks within threshold")
+        sys.exit(1 if regressions or skipped else 0)
@@ -0,0 +1,171 @@
+import asyncio
+import json
+from collections.abc import Mapping
+from dataclasses import dataclass
+from functools import lru_cache
+from loguru import logger as log
+from lolapy_lite_agent.chat_message import ChatMessage
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+DEFAULT_ENCODING = "cl100k_base"
+# tokens the chat format adds around every message, and once to prime the reply
+MESSAGE_OVERHEAD = 3
+NAME_OVERHEAD = 1
+REPLY_OVERHEAD = 3
+# characters per token of the heuristic used when tiktoken is not installed or its encoding can't be loaded
+CHARS_PER_TOKEN = 4
+
+
+@lru_cache(maxsize=None)
+def _encoding(name=DEFAULT_ENCODING):
+    # tiktoken downloads the encoding on first use unless it is in its cache (TIKTOKEN_CACHE_DIR)
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding(name)
+    except Exception as e:
+        log.warning(f"Can't load the tiktoken encoding {name}, tokens are estimated: {e}")
+        return None
+
+
+async def load_encoding():
+    """Loads the encoding in a thread, so the first count doesn't block the event loop (see LolaAgent.warm_up)"""
+    if _encoding.cache_info().currsize == 0:
+        await asyncio.to_thread(_encoding)
+
+
+def count_tokens(text: str) -> int:
+    """Tokens of text with tiktoken, or an estimate of a token per 4 characters without its encoding"""
+    if not text:
+        return 0
+    encoding = _encoding()
+    if encoding is None:
+        return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(message) -> int:
+    """Tokens a history entry takes in the chat request, a ChatMessage is counted once"""
+    if isinstance(message, ChatMessage):
+        if message.tokens is None:
+            message.tokens = _count_message_tokens(message)
+        return message.tokens
+    return _count_message_tokens(message)
+
+
+def known_tokens(message):
+    """Token count of a ChatMessage already counted, None otherwise"""
+    return message.tokens if isinstance(message, ChatMessage) else None
+
+
+def complete_token_counts(entries: list, counts: list) -> list:
+    """Counts the entries whose count is None (not counted when they were written), in place"""
+    for i, count in enumerate(counts):
+        if count is None:
+            counts[i] = count_message_tokens(entries[i])
+    return counts
+
+
+def _count_message_tokens(message) -> int:
+    if not message:
+        return 0
+    if not isinstance(message, Mapping):
+        return MESSAGE_OVERHEAD + count_tokens(str(message))
+    tokens = MESSAGE_OVERHEAD + count_tokens(message.get("content") or "")
+    if message.get("name"):
+        tokens += NAME_OVERHEAD + count_tokens(message["name"])
+    function_call = message.get("function_call")
+    if function_call:
+        tokens += count_tokens(function_call.get("name") or "") + count_tokens(function_call.get("arguments") or "")
+    for tool_call in message.get("tool_calls") or []:
+        function = tool_call.get("function") or {}
+        tokens += count_tokens(function.get("name") or "") + count_tokens(function.get("arguments") or "")
+    return tokens
+
+
+def count_functions_tokens(functions: list) -> int:
+    """Estimate of the tokens the function schemas take, the API renders them in its own format"""
+    if not functions:
+        return 0
+    return count_tokens(json.dumps(functions, separators=(",", ":")))
+
+
+@dataclass
+class TokenSplit:
+    """Tokens of a chat request by part, history is the tokens of the messages of the window"""
+    prompt: int = 0
+    functions: int = 0
+    history: int = 0
+    history_messages: int = 0
+
+    @property
+    def total(self) -> int:
+        return self.prompt + self.functions + self.history + REPLY_OVERHEAD
+
+
+def _is_response(entry) -> bool:
+    return isinstance(entry, Mapping) and entry.get("role") in ("function", "tool")
+
+
+def select_history_window(entries: list, counts: list, budget: int, max_messages: int = None) -> int:
+    """Index of the first entry of the newest window of entries whose token counts fit in budget.
+
+    Entries are taken from the end. Function responses and the call before them (a function_call, or an
+    assistant message with tool_calls and all its tool responses) are taken together or not at all,
+    so the window never starts with an orphan response. The newest entry is always taken,
+    even when it alone is over the budget.
+    """
+    start = len(entries)
+    used = 0
+    while start > 0:
+        first = start - 1
+        entry = entries[first]
+        if _is_response(entry):
+            while first > 0 and _is_response(entries[first - 1]):
+                first -= 1
+            previous = entries[first - 1] if first > 0 else None
+            if isinstance(previous, Mapping) and (previous.get("function_call") or previous.get("tool_calls")):
+                first -= 1
+        cost = sum(counts[first:start])
+        if start < len(entries):
+            if used + cost > budget:
+                break
+            if max_messages is not None and len(entries) - first > max_messages:
+                break
+        used += cost
+        start = first
+    return start
+
+
+def orphan_responses(entries: list, decode=None) -> int:
+    """Number of function responses entries starts with. A window cut by count inside a group of function calls
+    starts with responses whose call is before it, the API rejects them without their call.
+    decode turns an entry into a message when it isn't one yet."""
+    count = 0
+    for entry in entries:
+        if not _is_response(decode(entry) if decode else entry):
+            break
+        count += 1
+    return count
+
+
+if __name__ == "__main__":
+    from lolapy_lite_agent.agents.utils import create_function_call_message, create_function_response_message, create_user_message
+
+    print(f"tiktoken: {tiktoken is not None}")
+    history = [
+        create_user_message("Hello! my name is John Doe " * 20),
+        create_user_message("What is the BTC price?"),
+        create_function_call_message("get_cryptocurrency_price", '{"cryptocurrency": "BTC"}'),
+        create_function_response_message("get_cryptocurrency_price", "BTC price is $50,000"),
+        create_user_message("Thanks"),
+    ]
+    counts = [count_message_tokens(m) for m in history]
+    print(counts)
+    for budget in (10, 40, 60, 1000):
+        start = select_history_window(history, counts, budget)
+        print(budget, [m["role"] for m in history[start:]], sum(counts[start:]))
@@ -0,0 +1,107 @@
+import asyncio
+import inspect
+import json
+from collections.abc import Callable
+from typing import List
+from loguru import logger as log
+from lolapy_lite_agent.agents.utils import create_function_call_message, create_function_response_message, create_tool_calls_message, create_tool_response_message
+from lolapy_lite_agent.chat_lead import ChatLead
+
+# seconds a function handler may take, its response is an error message after that
+DEFAULT_TOOL_TIMEOUT = 10
+# completions of a turn answered with function calls before the turn is given up
+DEFAULT_MAX_TOOL_ROUNDS = 5
+
+# handler: called with lead, function name and arguments, returns the response string or an awaitable resolving to it
+FunctionHandler = Callable[[ChatLead, str, str], str]
+
+
+async def call_function(handler: FunctionHandler, lead: ChatLead, name: str, arguments: str, timeout=DEFAULT_TOOL_TIMEOUT) -> str:
+    """Response of handler to a function call, an error message the model can read when it fails or times out.
+
+    Coroutine functions run on the loop, other handlers in a worker thread so a blocking lookup doesn't
+    hold the other calls of the round. A thread still running at the timeout is left to finish on its own.
+    """
+    if handler is None:
+        return f"Error: function {name} is not available"
+
+    async def run():
+        if inspect.iscoroutinefunction(handler):
+            res = await handler(lead, name, arguments)
+        else:
+            res = await asyncio.to_thread(handler, lead, name, arguments)
+        if inspect.isawaitable(res):
+            res = await res
+        return res
+
+    try:
+        res = await asyncio.wait_for(run(), timeout)
+    except TimeoutError:
+        log.warning(f"Function {name} timed out after {timeout}s")
+        return f"Error: function {name} timed out"
+    except Exception as e:
+        log.warning(f"Function {name} failed: {e}")
+        return f"Error: function {name} failed: {e}"
+
+    if res is None:
+        return ""
+    if not isinstance(res, str):
+        return json.dumps(res)
+    return res
+
+
+async def run_tool_calls(handler: FunctionHandler, lead: ChatLead, tool_calls: list, timeout=DEFAULT_TOOL_TIMEOUT) -> List[dict]:
+    """Runs the tool calls of a response concurrently, returns the history entries of the round:
+    the assistant message with the calls and a tool message per call, in the order of the calls"""
+    responses = await asyncio.gather(*[
+        call_function(handler, lead, call["function"]["name"], call["function"]["arguments"], timeout)
+        for call in tool_calls
+    ])
+    return [create_tool_calls_message(tool_calls)] + [
+        create_tool_response_message(call["id"], response)
+        for call, response in zip(tool_calls, responses)
+    ]
+
+
+async def run_function_call(handler: FunctionHandler, lead: ChatLead, function_call: dict, timeout=DEFAULT_TOOL_TIMEOUT) -> List[dict]:
+    """Same as run_tool_calls for a legacy function_call"""
+    name = function_call.get("name")
+    response = await call_function(handler, lead, name, function_call.get("arguments"), timeout)
+    return [create_function_call_message(name, function_call.get("arguments")),
+            create_function_response_message(name, response)]
+
+
+if __name__ == "__main__":
+    import time
+
+    # three lookups of 0.2s and one hanging: the round takes the timeout, not the sum
+    def get_price(lead, name, arguments):
+        time.sleep(0.2)
+        return f"{json.loads(arguments)['cryptocurrency']} price is $50,000"
+
+    async def get_rate(lead, name, arguments):
+        await asyncio.sleep(0.2)
+        return {"rate": 1.08}
+
+    async def slow(lead, name, arguments):
+        await asyncio.sleep(5)
+
+    def handler(lead, name, arguments):
+        # sync dispatcher, the async handlers' coroutines are awaited by call_function
+        return {"get_price": get_price, "get_rate": get_rate, "slow": slow}[name](lead, name, arguments)
+
+    calls = [
+        {"id": "call_1", "type": "function", "function": {"name": "get_price", "arguments": '{"cryptocurrency": "BTC"}'}},
+        {"id": "call_2", "type": "function", "function": {"name": "get_price", "arguments": '{"cryptocurrency": "ETH"}'}},
+        {"id": "call_3", "type": "function", "function": {"name": "get_rate", "arguments": "{}"}},
+        {"id": "call_4", "type": "function", "function": {"name": "slow", "arguments": "{}"}},
+    ]
+
+    async def main():
+        start = time.perf_counter()
+        entries = await run_tool_calls(handler, None, calls, timeout=0.5)
+        print(f"{len(calls)} calls in {time.perf_counter() - start:.2f}s")
+        for entry in entries:
+            print(entry)
+
+    asyncio.run(main())
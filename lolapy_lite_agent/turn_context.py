@@ -0,0 +1,54 @@
+from typing import List
+from lolapy_lite_agent.conversation_snapshot import ConversationSnapshot
+from lolapy_lite_agent.nlp_job import AgentJob
+from lolapy_lite_agent.prompt_compiler import PromptCompiled, PromptCompiler
+
+
+class TurnContext:
+    """What the completions of a turn share: the compiled prompt (settings and function schemas included)
+    and the snapshot of history and state it was compiled from.
+
+    The completions that follow function calls reuse them, the function messages are appended to the
+    snapshot instead of reading the history again. The prompt is rendered again from the snapshot only when
+    the template reads the history or the message, both change between completions. A handler that writes
+    the state must invalidate the turn (LolaAgent.invalidate_turn, the agent's state setters do it),
+    the next completion then reads the snapshot from Redis and compiles the prompt again.
+    """
+    __slots__ = ('job', 'compiler', 'snapshot', 'compiled', 'stale', 'compiles')
+
+    def __init__(self, job: AgentJob):
+        self.job = job
+        self.compiler: PromptCompiler = None
+        self.snapshot: ConversationSnapshot = None
+        self.compiled: PromptCompiled = None
+        self.stale = False
+        # prompt compilations of the turn, for logs
+        self.compiles = 0
+
+    @property
+    def loaded(self) -> bool:
+        """The snapshot is current, no read from Redis is needed"""
+        return self.snapshot is not None and not self.stale
+
+    @property
+    def reusable(self) -> bool:
+        """The compiled prompt is still the one the snapshot would render"""
+        if not self.loaded or self.compiled is None:
+            return False
+        dependencies = self.compiler.dependencies
+        return not dependencies.history and not dependencies.message
+
+    @property
+    def counts_tokens(self) -> bool:
+        """The messages of the turn are counted when written, the prompt has a max_history_tokens budget"""
+        return self.compiled is None or bool(self.compiled.get("settings", {}).get("max_history_tokens"))
+
+    def append(self, entries: List[dict]):
+        """Keeps the snapshot in sync with the messages written to the history between completions"""
+        if self.snapshot is not None:
+            for entry in entries:
+                self.snapshot.append(entry)
+
+    def invalidate(self):
+        """The state changed, the next completion reads it again and compiles the prompt"""
+        self.stale = True
@@ -0,0 +1,16 @@
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+import fakeredis.aioredis
+from lolapy_lite_agent.redis_pool import redis_pools
+
+# in-memory Redis shared by the sync and async pools, the history scripts need fakeredis[lua]
+FAKE_REDIS_URL = "redis://fakeredis-tests:6379/0"
+redis_pools.set_connection_class(FAKE_REDIS_URL, fakeredis.FakeConnection, fakeredis.aioredis.FakeConnection,
+                                 server=fakeredis.FakeServer(), health_check_interval=0)
+
+
+@pytest.fixture
+def redis_url():
+    yield FAKE_REDIS_URL
+    redis_pools.client(FAKE_REDIS_URL).flushdb()
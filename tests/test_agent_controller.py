@@ -0,0 +1,50 @@
+import threading
+from lolapy_lite_agent.agent_controller import AgentController
+from lolapy_lite_agent.background_loop import BackgroundLoop
+from lolapy_lite_agent.openai_clients import openai_clients
+from lolapy_lite_agent.redis_pool import redis_pools
+from lolapy_lite_agent.testing import FakeOpenAIConfig, FakeOpenAIServer
+
+PROMPT = """You are Lola
+<function name="get_cryptocurrency_price" description="Get the current cryptocurrency price">
+    <parameters type="object">
+        <param name="cryptocurrency" type="string" description="The cryptocurrency abbreviation eg. BTC, ETH"/>
+    </parameters>
+</function>
+"""
+
+
+def test_sync_wrappers_run_the_callbacks_off_the_calling_thread(redis_url):
+    loop = BackgroundLoop(name="test-loop")
+    threads = {}
+
+    def record(callback):
+        def handler(*args):
+            threads.setdefault(callback, set()).add(threading.current_thread().name)
+            return "BTC price is $50,000" if callback == "on_function_call" else None
+        return handler
+
+    server = loop.run(FakeOpenAIServer(FakeOpenAIConfig(
+        ttft=0, token_delay=0, reply="The price is $50,000",
+        function_calls=[{"name": "get_cryptocurrency_price", "arguments": '{"cryptocurrency": "BTC"}'}])).start())
+    controller = AgentController(PROMPT, "123", "fake", redis_url=redis_url, loop=loop, base_url=server.url,
+                                 on_text_received=record("on_text_received"),
+                                 on_function_call=record("on_function_call"),
+                                 on_update_state=record("on_update_state"))
+    try:
+        assert controller.process_message("/reset all") is None
+        assert controller.process_message("What is the BTC price?") == "The price is $50,000"
+        assert "".join(controller.stream_message("And now?")) == "The price is $50,000"
+        assert controller.tokens is not None
+    finally:
+        loop.run(controller.agent.aclose())
+        loop.run(openai_clients.aclose())
+        loop.run(server.close())
+        loop.run(redis_pools.aclose())
+        loop.stop()
+
+    assert threads["on_text_received"] == {"test-loop"}
+    assert threads["on_update_state"] == {"test-loop"}
+    # sync handlers run in a worker thread, the loop keeps serving the other messages
+    assert threading.current_thread().name not in threads["on_function_call"]
+    assert "test-loop" not in threads["on_function_call"]
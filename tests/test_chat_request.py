@@ -0,0 +1,113 @@
+import asyncio
+import json
+import pytest
+from lolapy_lite_agent.agents.lola import LolaAgent
+from lolapy_lite_agent.chat_lead import ChatLead
+from lolapy_lite_agent import chat_request
+from lolapy_lite_agent.chat_message import ChatMessage
+from lolapy_lite_agent.chat_request import RawJSON, decode_messages, encode_request
+from lolapy_lite_agent.nlp_job import AgentJob
+from lolapy_lite_agent.openai_clients import openai_clients
+from lolapy_lite_agent.redis_pool import redis_pools
+from lolapy_lite_agent.serialization import dumps_json
+from lolapy_lite_agent.testing import FakeOpenAIConfig, FakeOpenAIServer
+
+HISTORY = [
+    {"role": "system", "content": "You are Lola, answer in \"Spanish\".\n"},
+    {"role": "user", "content": "¿Cuánto vale el € hoy? 😀"},
+    {"role": "assistant", "content": None,
+     "tool_calls": [{"id": "call_1", "type": "function", "function": {"name": "get_rate", "arguments": "{\"currency\": \"EUR\"}"}}]},
+    {"role": "tool", "tool_call_id": "call_1", "content": "{\"rate\": 1.08}"},
+    {"role": "assistant", "content": "1,08 dólares", "extra": {"kept": [1, 2]}},
+    {"role": "function", "name": "get_price", "content": ""},
+]
+
+PARAMS = [
+    {},
+    {"model": "gpt-4", "temperature": 0.0, "max_tokens": 800, "stream": True},
+    {"model": "gpt-4", "functions": [{"name": "get_price", "parameters": {"type": "object", "properties": {}}}],
+     "tool_choice": "auto", "user": "ñandú"},
+]
+
+
+def as_sent(messages):
+    """The messages as each kind of entry reaches encode_request: stored JSON, ChatMessage and dict"""
+    kinds = [lambda m: RawJSON(json.dumps(m).encode()), lambda m: RawJSON(dumps_json(m)),
+             ChatMessage.from_dict, lambda m: ChatMessage.from_json(json.dumps(m, ensure_ascii=False).encode()),
+             lambda m: m]
+    return [kinds[i % len(kinds)](m) for i, m in enumerate(messages)]
+
+
+@pytest.mark.parametrize("params", PARAMS)
+def test_body_matches_json_dumps_of_the_decoded_history(params):
+    messages = as_sent(HISTORY)
+    body = encode_request({"messages": messages, **params})
+    assert decode_messages(messages) == HISTORY
+    assert json.loads(body) == json.loads(json.dumps({"messages": HISTORY, **params}))
+    assert list(json.loads(body)) == ["messages"] + [k for k in params if k != "messages"]
+
+
+def test_body_without_messages():
+    assert json.loads(encode_request({"messages": [], "model": "gpt-4"})) == {"messages": [], "model": "gpt-4"}
+    assert json.loads(encode_request({})) == {"messages": []}
+
+
+def without_call_ids(messages):
+    """The messages with the random call ids of the fake server numbered in order"""
+    ids = {}
+    text = json.dumps(messages)
+    for message in messages:
+        for call in message.get("tool_calls") or []:
+            ids.setdefault(call["id"], f"call_{len(ids)}")
+    for id, number in ids.items():
+        text = text.replace(id, number)
+    return json.loads(text)
+
+
+class RecordingServer(FakeOpenAIServer):
+    """Keeps the body of every streamed request"""
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.payloads = []
+
+    async def _stream(self, payload, writer):
+        self.payloads.append(payload)
+        return await super()._stream(payload, writer)
+
+
+def test_raw_history_sends_the_same_messages(redis_url):
+    prompt = """You are Lola
+<function name="get_rate" description="Currency rate"><parameters type="object">
+<param name="currency" type="string" description="Currency"/></parameters></function>"""
+
+    async def conversation(raw_history, lead):
+        server = await RecordingServer(FakeOpenAIConfig(
+            ttft=0, token_delay=0, reply="El € vale 1,08 \"dólares\" 😀",
+            function_calls=[{"name": "get_rate", "arguments": '{"currency": "EUR"}'}])).start()
+        agent = LolaAgent(api_key="fake", redis_url=redis_url, base_url=server.url, tools=True,
+                          raw_history=raw_history)
+
+        def on_function_call(lead, name, arguments):
+            return {"rate": 1.08, "name": "ñ"}
+
+        try:
+            for message in ["Hola", "¿Cuánto vale el €?", "Gracias"]:
+                job = AgentJob("job", lead, message, prompt=prompt)
+                [res async for res in agent.respond(job, on_function_call)]
+            return server.payloads
+        finally:
+            await agent.aclose()
+            await openai_clients.aclose()
+            await server.close()
+            await redis_pools.aclose()
+
+    raw = asyncio.run(conversation(True, ChatLead("1", "test", "tenant", "assistant")))
+    decoded = asyncio.run(conversation(False, ChatLead("2", "test", "tenant", "assistant")))
+    assert len(raw) == 6
+    # the raw bodies were sent, not the decoded fallback
+    assert chat_request._raw_bodies
+    for raw_payload, decoded_payload in zip(raw, decoded):
+        assert without_call_ids(raw_payload["messages"]) == without_call_ids(decoded_payload["messages"])
+        assert {k: v for k, v in raw_payload.items() if k != "messages"} == \
+            {k: v for k, v in decoded_payload.items() if k != "messages"}
@@ -0,0 +1,72 @@
+import asyncio
+from lolapy_lite_agent.chat_lead import ChatLead
+from lolapy_lite_agent.conversation_snapshot import load_conversation_snapshot
+from lolapy_lite_agent.history.history_append import APPEND_SHA
+from lolapy_lite_agent.history.history_redis_async_provider import AsyncRedisHistoryProvider
+from lolapy_lite_agent.redis_pool import redis_pools
+from lolapy_lite_agent.state.state_redis_async_provider import AsyncRedisChatStateProvider
+
+LEAD = ChatLead("123", "test", "tenant", "assistant")
+
+
+def message(i):
+    return {"role": "user", "content": f"message {i}"}
+
+
+def contents(entries):
+    return [e["content"] for e in entries]
+
+
+def test_trimming_keeps_summary_positions(redis_url):
+    async def main():
+        history = AsyncRedisHistoryProvider(redis_url, max_length=5)
+        try:
+            await history.append_many(LEAD, [message(i) for i in range(4)])
+            await history.set_summary(LEAD, "summary of 0..1", 2)
+            assert await history.get_summary_state(LEAD) == ("summary of 0..1", 2, 4)
+
+            # 0..3 trimmed, positions count them
+            await history.append_many(LEAD, [message(i) for i in range(4, 9)])
+            assert contents(await history.get_history(LEAD)) == [f"message {i}" for i in range(4, 9)]
+            assert await history.get_summary_state(LEAD) == ("summary of 0..1", 2, 9)
+            assert contents(await history.get_history_range(LEAD, 6, 7)) == ["message 6", "message 7"]
+            # the trimmed entries are skipped
+            assert contents(await history.get_history_range(LEAD, 2, 5)) == ["message 4", "message 5"]
+            assert await history.get_history_range(LEAD, 0, 3) == []
+
+            await history.set_summary(LEAD, "summary of 0..6", 7)
+            for i in range(9, 12):
+                await history.append_to_history(LEAD, message(i))
+            assert await history.get_summary_state(LEAD) == ("summary of 0..6", 7, 12)
+            assert contents(await history.get_history_range(LEAD, 7, 11)) == [f"message {i}" for i in range(7, 12)]
+            # the token counts are trimmed with their entries
+            entries, counts = await history.get_last_messages_with_tokens(LEAD)
+            assert contents(entries) == [f"message {i}" for i in range(7, 12)] and None not in counts
+            assert len(await history.client.lrange(history.get_tokens_key(LEAD), 0, -1)) == 5
+        finally:
+            await redis_pools.aclose()
+
+    asyncio.run(main())
+
+
+def test_pipelined_append_loads_the_script_once(redis_url):
+    async def main():
+        history = AsyncRedisHistoryProvider(redis_url, max_length=3)
+        state = AsyncRedisChatStateProvider(redis_url)
+        try:
+            pipe = history.client.pipeline(transaction=False)
+            history.pipe_append(pipe, LEAD, message(0))
+            assert pipe.command_stack[0][0][:2] == ("EVALSHA", APPEND_SHA)
+            await pipe.reset()
+
+            # Redis without the script, e.g. after a restart
+            await history.client.script_flush()
+            for i in range(5):
+                snapshot = await load_conversation_snapshot(history, state, LEAD, append=message(i))
+                assert contents(snapshot.entries) == [f"message {j}" for j in range(max(i - 2, 0), i + 1)]
+            assert await history.client.script_exists(APPEND_SHA) == [True]
+            assert await history.get_summary_state(LEAD) == (None, 0, 5)
+        finally:
+            await redis_pools.aclose()
+
+    asyncio.run(main())
@@ -0,0 +1,106 @@
+import asyncio
+import pytest
+from lolapy_lite_agent.chat_lead import ChatLead
+from lolapy_lite_agent.history.history_buffer import BACKGROUND, TURN, WRITE_THROUGH, HistoryBuffer
+from lolapy_lite_agent.history.history_redis_async_provider import AsyncRedisHistoryProvider
+from lolapy_lite_agent.redis_pool import redis_pools
+
+LEADS = [ChatLead(str(i), "test", "tenant", "assistant") for i in range(3)]
+
+
+def message(lead, i):
+    return {"role": "user", "content": f"{lead.id} message {i}"}
+
+
+def contents(entries):
+    return [e["content"] for e in entries]
+
+
+class FlakyHistoryProvider(AsyncRedisHistoryProvider):
+    """Fails the first failures writes, records the batches written"""
+
+    def __init__(self, redis_url, failures=0):
+        super().__init__(redis_url)
+        self.failures = failures
+        self.batches = []
+
+    async def append_many(self, lead, entries, ttl=None, tokens=True):
+        # give the other leads and the appends a chance to run while a batch is written
+        await asyncio.sleep(0)
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("Redis is down")
+        self.batches.append((lead.id, contents(entries)))
+        return await super().append_many(lead, entries, ttl, tokens)
+
+
+@pytest.mark.parametrize("durability", [WRITE_THROUGH, TURN, BACKGROUND])
+def test_writes_keep_the_order_of_each_lead(redis_url, durability):
+    async def main():
+        history = FlakyHistoryProvider(redis_url)
+        buffer = HistoryBuffer(history, durability, max_batch=3)
+        try:
+            for i in range(10):
+                for lead in LEADS:
+                    await buffer.append(lead, [message(lead, i)])
+                    if i % 4 == 0:
+                        await buffer.append(lead, [message(lead, f"{i}b"), message(lead, f"{i}c")])
+            await buffer.close()
+
+            assert buffer.stats() == {'leads': 0, 'pending': 0}
+            for lead in LEADS:
+                expected = []
+                for i in range(10):
+                    expected.append(f"{lead.id} message {i}")
+                    if i % 4 == 0:
+                        expected += [f"{lead.id} message {i}b", f"{lead.id} message {i}c"]
+                assert contents(await history.get_history(lead)) == expected
+            assert max(len(batch) for _, batch in history.batches) <= (3 if buffer.enabled else 2)
+            if buffer.enabled:
+                assert len(history.batches) < 3 * 13
+        finally:
+            await redis_pools.aclose()
+
+    asyncio.run(main())
+
+
+def test_readers_see_every_message_once(redis_url):
+    async def main():
+        history = FlakyHistoryProvider(redis_url)
+        buffer = HistoryBuffer(history, TURN, max_batch=2)
+        lead = LEADS[0]
+        try:
+            for i in range(7):
+                await buffer.append(lead, [message(lead, i)])
+                async with buffer.reading(lead) as pending:
+                    entries = await history.get_history(lead) + pending
+                assert contents(entries) == [f"0 message {j}" for j in range(i + 1)]
+            assert buffer.pending(lead)
+            await buffer.flush(lead)
+            assert buffer.pending(lead) == []
+        finally:
+            await redis_pools.aclose()
+
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize("failures, written", [
+    (2, ["0 message 0", "0 message 1", "0 message 2", "0 message 3"]),
+    # the third failure exceeds the retries, the first batch is dropped and the next one written
+    (3, ["0 message 2", "0 message 3"]),
+])
+def test_batch_dropped_after_its_retries(redis_url, failures, written):
+    async def main():
+        history = FlakyHistoryProvider(redis_url, failures=failures)
+        buffer = HistoryBuffer(history, BACKGROUND, max_batch=2, retries=2, retry_delay=0)
+        lead = LEADS[0]
+        try:
+            await buffer.append(lead, [message(lead, i) for i in range(4)])
+            await buffer.flush()
+            assert history.failures == 0
+            assert contents(await history.get_history(lead)) == written
+            assert buffer.stats() == {'leads': 0, 'pending': 0}
+        finally:
+            await redis_pools.aclose()
+
+    asyncio.run(main())
@@ -0,0 +1,110 @@
+import asyncio
+from types import SimpleNamespace
+from lolapy_lite_agent.agents.lola import LolaAgent
+from lolapy_lite_agent.chat_lead import ChatLead
+from lolapy_lite_agent.history.history_redis_async_provider import AsyncRedisHistoryProvider
+from lolapy_lite_agent.history.history_summarizer import HistorySummarizer
+from lolapy_lite_agent.nlp_job import AgentJob
+from lolapy_lite_agent.openai_clients import openai_clients
+from lolapy_lite_agent.redis_pool import redis_pools
+from lolapy_lite_agent.testing import FakeOpenAIConfig, FakeOpenAIServer
+
+LEAD = ChatLead("123", "test", "tenant", "assistant")
+
+
+class SummaryClient:
+    """Client answering summary requests with the dialogs folded so far, one per line"""
+
+    def __init__(self):
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+        self.requests = 0
+
+    async def create(self, messages, **params):
+        self.requests += 1
+        content = messages[-1]["content"]
+        summary, _, dialog = content.partition("New messages:\n")
+        summary = summary.replace("Current summary:\n", "").strip()
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(
+            content="\n".join(line for line in [summary, dialog] if line)))])
+
+
+def test_every_message_before_the_window_is_folded(redis_url):
+    async def main():
+        history = AsyncRedisHistoryProvider(redis_url, max_length=7)
+        client = SummaryClient()
+        summarizer = HistorySummarizer(history, lambda: client, "gpt-4")
+        window = 3
+        try:
+            for turn in range(8):
+                await history.append_many(LEAD, [{"role": "user", "content": f"question {turn}"},
+                                                 {"role": "assistant", "content": f"answer {turn}"}])
+                await summarizer.update(LEAD, window, {})
+                summary, folded, length = await history.get_summary_state(LEAD)
+                # the window of the next turn starts where the summary ends
+                assert folded == max(length + 1 - window, 0)
+                # summary and next window hold the whole conversation, trimmed messages included
+                start = folded - (length - len(await history.get_history(LEAD)))
+                window_messages = [m["content"] for m in (await history.get_history(LEAD))[start:]]
+                folded_messages = [line.split(": ", 1)[1] for line in (summary or "").splitlines()]
+                conversation = [f"{kind} {i}" for i in range(turn + 1) for kind in ("question", "answer")]
+                assert folded_messages + window_messages == conversation
+            return client.requests
+        finally:
+            await redis_pools.aclose()
+
+    # nothing left the window after the first turn
+    assert asyncio.run(main()) == 7
+
+
+def test_update_without_new_messages_out_of_the_window(redis_url):
+    async def main():
+        history = AsyncRedisHistoryProvider(redis_url)
+        client = SummaryClient()
+        summarizer = HistorySummarizer(history, lambda: client, "gpt-4")
+        try:
+            await history.append_many(LEAD, [{"role": "user", "content": "hi"}, {"role": "assistant", "content": "hello"}])
+            await summarizer.update(LEAD, 10, {})
+            await summarizer.update(LEAD, 2, {})
+            await summarizer.update(LEAD, 2, {})
+            return client.requests, await history.get_summary_state(LEAD)
+        finally:
+            await redis_pools.aclose()
+
+    assert asyncio.run(main()) == (1, ("user: hi", 1, 2))
+
+
+def test_agent_sends_the_summary_before_the_window(redis_url):
+    prompt = '<settings summarize_history="true" max_history_length="2"></settings>You are Lola'
+    payloads = []
+
+    class RecordingServer(FakeOpenAIServer):
+        async def _stream(self, payload, writer):
+            payloads.append(payload)
+            return await super()._stream(payload, writer)
+
+        def _completion(self, payload):
+            # the summary request, answered with its dialog
+            completion = super()._completion(payload)
+            completion["choices"][0]["message"]["content"] = payload["messages"][-1]["content"]
+            return completion
+
+    async def main():
+        server = await RecordingServer(FakeOpenAIConfig(ttft=0, token_delay=0, reply="Hi")).start()
+        agent = LolaAgent(api_key="fake", redis_url=redis_url, base_url=server.url)
+        try:
+            for i in range(4):
+                [res async for res in agent.respond(AgentJob("job", LEAD, f"message {i}", prompt=prompt))]
+                await agent.wait_summaries()
+        finally:
+            await agent.aclose()
+            await openai_clients.aclose()
+            await server.close()
+            await redis_pools.aclose()
+
+    asyncio.run(main())
+    last = payloads[-1]["messages"]
+    assert [m["content"] for m in last[-2:]] == ["Hi", "message 3"]
+    assert last[1]["role"] == "system" and "Summary of the earlier conversation" in last[1]["content"]
+    for i in range(3):
+        assert f"user: message {i}" in last[1]["content"]
+    assert last[1]["content"].count("assistant: Hi") == 2
@@ -0,0 +1,91 @@
+import asyncio
+from types import SimpleNamespace
+from lolapy_lite_agent.agents import lola
+from lolapy_lite_agent.agents.lola import TIMEOUT_ERROR_MESSAGE, LolaAgent
+from lolapy_lite_agent.agents.utils import create_assistant_message, create_user_message
+from lolapy_lite_agent.chat_lead import ChatLead
+from lolapy_lite_agent.nlp_job import AgentJob
+from lolapy_lite_agent.openai_clients import openai_clients
+from lolapy_lite_agent.prompt_compiler import PromptCompiler
+from lolapy_lite_agent.redis_pool import redis_pools
+from lolapy_lite_agent.testing import FakeOpenAIConfig, FakeOpenAIServer
+from lolapy_lite_agent.token_counter import count_message_tokens
+
+
+class HangingClient:
+    """Client whose completions never start"""
+
+    def __init__(self):
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, **params):
+        await asyncio.sleep(60)
+
+
+def test_respond_create_timeout(redis_url, monkeypatch):
+    monkeypatch.setattr(lola, "REQUEST_TIMEOUT", 0.05)
+    agent = LolaAgent(api_key="fake", redis_url=redis_url, client=HangingClient())
+    lead = ChatLead("123", "test", "tenant", "assistant")
+    job = AgentJob("job", lead, "Hello", prompt="You are Lola")
+
+    async def run():
+        try:
+            return [res async for res in agent.respond(job)]
+        finally:
+            await agent.aclose()
+            await redis_pools.aclose()
+
+    assert asyncio.run(run()) == [{"content": TIMEOUT_ERROR_MESSAGE}]
+
+
+def test_respond_records_tokens_without_session(redis_url):
+    lead = ChatLead("123", "test", "tenant", "assistant")
+    job = AgentJob("job", lead, "Hello", prompt="You are Lola")
+
+    async def run():
+        server = await FakeOpenAIServer(FakeOpenAIConfig(ttft=0, token_delay=0, reply="Hi there")).start()
+        agent = LolaAgent(api_key="fake", redis_url=redis_url, base_url=server.url)
+        try:
+            return "".join([res["content"] async for res in agent.respond(job)])
+        finally:
+            await agent.aclose()
+            await openai_clients.aclose()
+            await server.close()
+            await redis_pools.aclose()
+
+    assert asyncio.run(run()) == "Hi there"
+    assert job.tokens is not None
+    assert job.tokens.prompt > 0
+    assert job.tokens.total > job.tokens.prompt
+
+
+def test_tokens_of_count_window(redis_url):
+    """Without a max_history_tokens budget the split still has the tokens of the history window"""
+    lead = ChatLead("123", "test", "tenant", "assistant")
+    jobs = [AgentJob(f"job{i}", lead, message, prompt="You are Lola") for i, message in enumerate(["Hello", "How are you?"])]
+
+    async def run():
+        server = await FakeOpenAIServer(FakeOpenAIConfig(ttft=0, token_delay=0, reply="Hi there")).start()
+        agent = LolaAgent(api_key="fake", redis_url=redis_url, base_url=server.url)
+        try:
+            for job in jobs:
+                [res async for res in agent.respond(job)]
+            # without a snapshot, the window is read with its stored counts
+            compiled = await PromptCompiler(jobs[1], jobs[1].prompt, agent._asyncHistoryStore,
+                                            agent._asyncStateStore).process_async()
+            direct = AgentJob("direct", lead, None, prompt="You are Lola")
+            [res async for res in agent.request_stream(direct, compiled)]
+            return direct
+        finally:
+            await agent.aclose()
+            await openai_clients.aclose()
+            await server.close()
+            await redis_pools.aclose()
+
+    direct = asyncio.run(run())
+    hello = count_message_tokens(create_user_message("Hello"))
+    how = count_message_tokens(create_user_message("How are you?"))
+    reply = count_message_tokens(create_assistant_message("Hi there"))
+    assert (jobs[0].tokens.history, jobs[0].tokens.history_messages) == (hello, 1)
+    assert (jobs[1].tokens.history, jobs[1].tokens.history_messages) == (hello + reply + how, 3)
+    assert (direct.tokens.history, direct.tokens.history_messages) == (hello + 2 * reply + how, 4)
@@ -0,0 +1,46 @@
+import asyncio
+import pytest
+from lolapy_lite_agent.chat_lead import ChatLead
+from lolapy_lite_agent.lola_plugin import LolaPlugin
+from lolapy_lite_agent.openai_clients import openai_clients
+from lolapy_lite_agent.redis_pool import redis_pools
+from lolapy_lite_agent.testing import FakeOpenAIConfig, FakeOpenAIServer
+
+PROMPT = """You are Lola
+<function name="get_cryptocurrency_price" description="Get the current cryptocurrency price">
+    <parameters type="object">
+        <param name="cryptocurrency" type="string" description="The cryptocurrency abbreviation eg. BTC, ETH"/>
+    </parameters>
+</function>
+"""
+
+
+@pytest.mark.parametrize("tools", [False, True])
+def test_plugin_handler_gets_the_function_call(redis_url, tools):
+    calls = []
+
+    def on_function_call(lead, name, arguments):
+        calls.append((lead.get_token(), name, arguments))
+        return "BTC price is $50,000"
+
+    async def run():
+        server = await FakeOpenAIServer(FakeOpenAIConfig(
+            ttft=0, token_delay=0, reply="Done",
+            function_calls=[{"name": "get_cryptocurrency_price", "arguments": '{"cryptocurrency": "BTC"}'}])).start()
+        plugin = LolaPlugin("123", PROMPT, "fake", on_function_call=on_function_call, tools=tools,
+                            redis_url=redis_url, base_url=server.url)
+        try:
+            text = "".join([t async for t in plugin.add_message("What is the BTC price?")])
+            history = await plugin.agent._asyncHistoryStore.get_history(plugin.lead)
+            return text, history
+        finally:
+            await plugin.aclose()
+            await openai_clients.aclose()
+            await server.close()
+            await redis_pools.aclose()
+
+    text, history = asyncio.run(run())
+    assert text == "Done"
+    lead = ChatLead("123", "test", "tenant", "assistant")
+    assert calls == [(lead.get_token(), "get_cryptocurrency_price", '{"cryptocurrency": "BTC"}')]
+    assert [m["content"] for m in history if m["role"] in ("function", "tool")] == ["BTC price is $50,000"]
@@ -0,0 +1,60 @@
+import io
+import os
+from contextlib import redirect_stdout
+
+import pytest
+from lolapy_lite_agent.pml.function_plugin import PmlFunctionsPlugin
+from lolapy_lite_agent.pml.pml_builder import PMLBuilder
+from lolapy_lite_agent.pml.pml_engine import PMLFallback
+
+SAMPLE = os.path.join(os.path.dirname(__file__), os.pardir, "lolapy_lite_agent", "pml", "sample_prompt.pml")
+
+with open(SAMPLE, "r") as f:
+    SAMPLE_PML = f.read()
+
+SOURCES = [
+    SAMPLE_PML,
+    SAMPLE_PML * 3,
+    "Hello <b>John</b>,<br>answer in English.<br/>Be kind.",
+    "\n\n   You are Lola.\n\n\n\nThe customer is John &amp; Jane &lt;VIP&gt; &copy; &#65;&#x42;",
+    "<!-- a comment -->You are Lola.<!-- another\nmultiline comment -->\nBye",
+    '<settings model="gpt-4" temperature="0.5"></settings><settings model="ignored"></settings>Hi',
+    "<mood>happy</mood><command>reset</command><test>ignored</test>You are Lola.<script>var x = '<b>';</script>",
+    "<tracker entry=\"entities\"><var name=\"city\" description=\"The city\" /></tracker>Ask for the city.",
+    '<function name="f" description="d"><parameters type="object">'
+    '<param name="a" type="string" required="true"/><param name="b" enum="X,Y"/></parameters></function>'
+    'Call f when asked.<function name="g"></function>',
+    "Prices: 1 < 2 > 0 and a & b, <p>paragraph</p><div>div <span>span</span></div>",
+    "",
+    "   ",
+]
+
+
+def compile_with(engine, source):
+    functions = []
+    builder = PMLBuilder(source, engine=engine)
+    builder.register_plugin(PmlFunctionsPlugin(None, lambda func: functions.append(func)))
+    # bs4 prints an error for every plugin returning None
+    with redirect_stdout(io.StringIO()):
+        return builder.compile(), functions
+
+
+@pytest.mark.parametrize("source", SOURCES)
+def test_fast_engine_matches_bs4(source):
+    assert compile_with("fast", source) == compile_with("bs4", source)
+
+
+@pytest.mark.parametrize("source", SOURCES)
+def test_fast_engine_compiles_without_the_dom(source):
+    builder = PMLBuilder(source)
+    builder.register_plugin(PmlFunctionsPlugin(None, lambda func: None))
+    builder.compile_fast()
+    assert builder._root is None
+
+
+def test_unsupported_markup_falls_back_to_bs4():
+    source = "<textarea>  keep   this  </textarea>You are Lola."
+    builder = PMLBuilder(source)
+    with pytest.raises(PMLFallback):
+        builder.compile_fast()
+    assert compile_with("fast", source) == compile_with("bs4", source)
@@ -0,0 +1,73 @@
+import pytest
+from lolapy_lite_agent.handlebars_helpers import get_helpers
+from lolapy_lite_agent.prompt_artifact import PromptArtifact
+from lolapy_lite_agent.template_cache import compile_handlebars
+
+FUNCTION = """
+<function name="get_cryptocurrency_price" description="Get the current cryptocurrency price">
+    <parameters type="object">
+        <param name="cryptocurrency" type="string" description="The cryptocurrency abbreviation eg. BTC, ETH"/>
+    </parameters>
+</function>
+"""
+
+# templates whose dynamic chunks only render text, compiled once to a static artifact
+STATIC = [
+    "Create an assistant called {{state.name}}" + FUNCTION,
+    "{{state.name}} is the assistant of {{state.bank}}.\nBe kind." + FUNCTION,
+    "\n\n  Hello {{state.name}}, answer in {{state.language}}.",
+    '<settings model="gpt-4" max_tokens="400"></settings>\n{{state.name}} helps {{state.customer}}.' + FUNCTION,
+    '<settings model="gpt-4"></settings>\nYou are {{state.name}}.\n{{#if state.premium}}Offer premium.{{else}}Offer basic.{{/if}}',
+    "You are Lola.\n{{#each history}}{{role}}: {{content}}\n{{/each}}Last message: {{message}}",
+    "Create an assistant called {{state.name}} &amp; friends.\n<!-- note -->\nCustomer: {{key_value state.profile}}",
+]
+
+# chunks landing in markup or settings are rendered with the whole template on every turn
+DYNAMIC = [
+    '<settings model="{{state.model}}"></settings>You are {{state.name}}',
+    "You are Lola {{{state.raw}}}",
+    "<function name=\"{{state.function}}\" description=\"x\"></function>Hi",
+]
+
+CONTEXTS = [
+    {'state': {'name': 'Lola', 'bank': 'Leap', 'language': 'English', 'customer': 'John', 'premium': True,
+               'profile': {'age': 42}, 'model': 'gpt-4', 'raw': '<b>x</b>', 'function': 'f'},
+     'history': [{'role': 'user', 'content': 'Hi'}, {'role': 'assistant', 'content': 'Hello & welcome'}],
+     'message': 'What is <BTC>?'},
+    {'state': {'name': '', 'bank': '  ', 'language': '\n', 'customer': 'A & B', 'premium': False, 'profile': {},
+               'model': 'gpt-3', 'raw': '', 'function': 'g'},
+     'history': [], 'message': ''},
+    {'state': {'name': '  Lola  ', 'bank': '"Leap"', 'language': "<es>", 'customer': '&amp;',
+               'profile': {'a': '<1>'}, 'model': '', 'raw': '\n', 'function': ''},
+     'history': [], 'message': None},
+]
+
+
+def full_compile(artifact, ctx):
+    return artifact._compile_pml(compile_handlebars(artifact.prompt)(ctx, helpers=get_helpers()), ctx)
+
+
+@pytest.mark.parametrize("prompt", STATIC)
+def test_text_chunks_compile_to_a_static_artifact(prompt):
+    assert PromptArtifact(prompt).is_static
+
+
+@pytest.mark.parametrize("prompt", DYNAMIC)
+def test_chunks_in_markup_render_the_whole_template(prompt):
+    assert not PromptArtifact(prompt).is_static
+
+
+@pytest.mark.parametrize("prompt", STATIC + DYNAMIC)
+@pytest.mark.parametrize("ctx", CONTEXTS)
+def test_artifact_compiles_like_a_full_render(prompt, ctx):
+    artifact = PromptArtifact(prompt)
+    assert artifact.render(ctx) == compile_handlebars(prompt)(ctx, helpers=get_helpers())
+    assert artifact.compile(ctx) == full_compile(artifact, ctx)
+
+
+def test_static_artifact_shares_settings_and_functions():
+    artifact = PromptArtifact(STATIC[3])
+    first, second = artifact.compile(CONTEXTS[0]), artifact.compile(CONTEXTS[1])
+    assert first['settings'] is second['settings'] and first['settings'] == {'model': 'gpt-4', 'max_tokens': '400'}
+    assert first['functions'] is second['functions'] and first['functions'][0]['name'] == 'get_cryptocurrency_price'
+    assert first["prompt"].startswith("Lola helps John.")
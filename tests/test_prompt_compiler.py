@@ -0,0 +1,67 @@
+import asyncio
+from lolapy_lite_agent.chat_lead import ChatLead
+from lolapy_lite_agent.nlp_job import AgentJob
+from lolapy_lite_agent.prompt_compiler import PromptCompiler
+from lolapy_lite_agent.state.base_state_provider import BaseChatStateProvider
+
+
+class MemoryStateProvider(BaseChatStateProvider):
+    """State in a dict, only the methods of the base interface"""
+
+    def __init__(self):
+        self.stores = {}
+
+    def get_key(self, lead):
+        return lead.get_token()
+
+    def set_key_value(self, lead, key, value, ttl_in_seconds=None):
+        self.stores.setdefault(self.get_key(lead), {})[key] = value
+
+    def get_key_value(self, lead, key):
+        return self.stores.get(self.get_key(lead), {}).get(key)
+
+    def clear_store(self, lead):
+        self.stores.pop(self.get_key(lead), None)
+
+    def clear_all_stores(self, tenant_id, assistant_id):
+        self.stores.clear()
+
+    def get_store(self, lead):
+        return self.stores.get(self.get_key(lead))
+
+    def set_store(self, lead, store, ttl=None):
+        self.stores.setdefault(self.get_key(lead), {}).update(store)
+
+
+class AsyncMemoryStateProvider(MemoryStateProvider):
+
+    async def get_store(self, lead):
+        return super().get_store(lead)
+
+
+LEAD = ChatLead("123", "test", "tenant", "assistant")
+PROMPT = "Hello {{state.name}}, you are in {{state.city}}"
+
+
+def test_get_values_falls_back_to_get_store():
+    provider = MemoryStateProvider()
+    assert provider.get_values(LEAD, ["name"]) == {}
+    provider.set_store(LEAD, {"name": "Lola", "city": "Rosario", "age": 3})
+    assert provider.get_values(LEAD, ["name", "city", "missing"]) == {"name": "Lola", "city": "Rosario"}
+
+
+def test_compile_with_base_state_provider():
+    provider = MemoryStateProvider()
+    provider.set_store(LEAD, {"name": "Lola", "city": "Rosario"})
+    compiler = PromptCompiler(AgentJob("job", LEAD, "Hi"), PROMPT, None, provider)
+
+    assert compiler.process()["prompt"].strip() == "Hello Lola, you are in Rosario"
+
+
+def test_compile_async_with_base_state_provider():
+    provider = AsyncMemoryStateProvider()
+    provider.set_store(LEAD, {"name": "Lola", "city": "Rosario"})
+    compiler = PromptCompiler(AgentJob("job", LEAD, "Hi"), PROMPT, None, provider)
+
+    compiled = asyncio.run(compiler.process_async())
+    assert compiled["prompt"].strip() == "Hello Lola, you are in Rosario"
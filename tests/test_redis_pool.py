@@ -0,0 +1,78 @@
+import asyncio
+import socket
+import threading
+import time
+from lolapy_lite_agent.redis_pool import RedisPoolRegistry
+
+
+class PongServer:
+    """TCP server answering +PONG to every command, counts the connections the clients left open"""
+
+    def __init__(self):
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.url = f"redis://127.0.0.1:{self.listener.getsockname()[1]}/0"
+        self.open = 0
+        self._lock = threading.Lock()
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                connection, _ = self.listener.accept()
+            except OSError:
+                return
+            with self._lock:
+                self.open += 1
+            threading.Thread(target=self._serve, args=(connection,), daemon=True).start()
+
+    def _serve(self, connection):
+        with connection:
+            while True:
+                try:
+                    data = connection.recv(65536)
+                except OSError:
+                    data = b""
+                if not data:
+                    break
+                # one reply per command, every command starts with an array header
+                connection.sendall(b"+PONG\r\n" * data.count(b"*"))
+        with self._lock:
+            self.open -= 1
+
+    def wait_open(self, count, timeout=5):
+        deadline = time.monotonic() + timeout
+        while self.open != count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return self.open
+
+    def close(self):
+        self.listener.close()
+
+
+def test_pools_of_closed_loops_are_disconnected():
+    server = PongServer()
+    registry = RedisPoolRegistry(health_check_interval=0)
+
+    async def ping(concurrency):
+        client = registry.async_client(server.url)
+        await asyncio.gather(*[client.ping() for _ in range(concurrency)])
+        return client
+
+    try:
+        # asyncio.run per call without aclose, each loop leaves its pool behind
+        first = asyncio.run(ping(3))
+        assert server.wait_open(3) == 3
+        second = asyncio.run(ping(2))
+        assert second is not first
+        assert server.wait_open(2) == 2
+        assert len(registry._async_clients) == 1
+
+        async def ping_and_close():
+            await ping(1)
+            await registry.aclose()
+
+        asyncio.run(ping_and_close())
+        assert server.wait_open(0) == 0
+        assert registry._async_clients == {}
+    finally:
+        server.close()
@@ -0,0 +1,68 @@
+import random
+import pytest
+from lolapy_lite_agent.sentence_splitter import SentenceSplitter, split_sentences
+
+SAMPLES = [
+    ("Hello Mr. Smith! The BTC price is $50,123.45 today. Do you want the ETH price too? Let me know...", "en"),
+    ("Hola Sr. García, ¿cómo está? El precio es de 1.234,56 USD aprox. según EE.UU. hoy. ¡Gracias!", "es"),
+    ("Steps:\n1. Open the app.\n2. Tap J. Doe's profile, e.g. the first one. Then wait.", "en"),
+    ("This is a very long sentence without a period that keeps going, and going, with clauses; "
+     "so the speech engine can start before it ends, because waiting for the end would take a while, "
+     "and nobody likes silence on a call", None),
+]
+
+
+def stream(text, language=None, seed=0):
+    rng = random.Random(seed)
+    splitter = SentenceSplitter(language)
+    chunks = []
+    pos = 0
+    while pos < len(text):
+        size = rng.randint(1, 4)
+        chunks += splitter.push(text[pos:pos + size])
+        pos += size
+    rest = splitter.flush()
+    return chunks + [rest] if rest else chunks
+
+
+@pytest.mark.parametrize("text,language", SAMPLES)
+@pytest.mark.parametrize("seed", range(5))
+def test_streamed_deltas_split_like_the_whole_text(text, language, seed):
+    chunks = stream(text, language, seed)
+    assert "".join(chunks) == text
+    assert chunks == split_sentences(text, language)
+
+
+def test_abbreviations_and_numbers():
+    assert split_sentences(SAMPLES[0][0], "en") == [
+        "Hello Mr. Smith! ", "The BTC price is $50,123.45 today. ", "Do you want the ETH price too? ", "Let me know...",
+    ]
+    assert split_sentences(SAMPLES[1][0], "es") == [
+        "Hola Sr. García, ¿cómo está? ", "El precio es de 1.234,56 USD aprox. según EE.UU. hoy. ", "¡Gracias!",
+    ]
+    assert split_sentences(SAMPLES[2][0]) == [
+        "Steps:\n", "1. Open the app.\n", "2. Tap J. Doe's profile, e.g. the first one. ", "Then wait.",
+    ]
+
+
+@pytest.mark.parametrize("language", [None, "en", "es"])
+def test_common_words_end_sentences(language):
+    assert split_sentences("Creo que no. Gracias por preguntar.", language) == ["Creo que no. ", "Gracias por preguntar."]
+    assert split_sentences("The answer is no. Sorry about that.", language) == ["The answer is no. ", "Sorry about that."]
+    assert split_sentences("Yes, you may. Anything else?", language) == ["Yes, you may. ", "Anything else?"]
+
+
+def test_no_before_a_number():
+    assert split_sentences("See No. 5 on the list. Thanks.") == ["See No. 5 on the list. ", "Thanks."]
+
+
+def test_languages_are_not_merged():
+    # Spanish abbreviations end English sentences by default
+    assert split_sentences("Call the Sra. Lopez") == ["Call the Sra. ", "Lopez"]
+    assert split_sentences("Call the Sra. Lopez", "es") == ["Call the Sra. Lopez"]
+
+
+def test_long_sentences_cut_at_clauses():
+    chunks = split_sentences(SAMPLES[3][0])
+    assert len(chunks) > 1
+    assert all(len(chunk) <= 150 for chunk in chunks[:-1])
@@ -0,0 +1,124 @@
+import asyncio
+import json
+import pytest
+from lolapy_lite_agent.chat_lead import ChatLead
+from lolapy_lite_agent.redis_pool import redis_pools
+from lolapy_lite_agent.serialization import COMPRESSIONS, FORMAT_VERSION, SERIALIZERS, Codec, default_codec
+from lolapy_lite_agent.state.state_redis_async_provider import AsyncRedisChatStateProvider
+from lolapy_lite_agent.state.state_redis_provider import RedisChatStateProvider
+
+VALUES = [
+    "Lola", "", 42, -1.5, True, False, None, [], {}, [1, "two", [3.0]],
+    {"role": "user", "content": "¿Cuánto vale el € hoy? " * 100, "tool_calls": None},
+    {"name": "John", "age": 42, "tags": ["vip"], "profile": {"city": "Rosario"}},
+]
+
+
+def codecs():
+    yield default_codec
+    yield Codec(compression="zlib", compress_threshold=64)
+    try:
+        yield Codec("msgpack")
+        yield Codec("msgpack", compression="zlib", compress_threshold=64)
+    except ValueError:
+        pass
+    try:
+        yield Codec(compression="zstd", compress_threshold=64)
+    except ValueError:
+        pass
+
+
+CODECS = list(codecs())
+
+
+@pytest.mark.parametrize("codec", CODECS, ids=repr)
+@pytest.mark.parametrize("value", VALUES, ids=range(len(VALUES)))
+def test_round_trip(codec, value):
+    data = codec.encode(value)
+    assert codec.decode(data) == value
+    # any codec reads what another wrote
+    for other in CODECS:
+        assert other.decode(data) == value
+
+
+def test_json_is_written_without_a_header():
+    for value in VALUES:
+        data = default_codec.encode(value)
+        assert data[0] != FORMAT_VERSION
+        assert json.loads(data) == value
+    # values written before codecs, by json.dumps
+    assert default_codec.decode(json.dumps({"a": "ñ"})) == {"a": "ñ"}
+    assert default_codec.decode(json.dumps({"a": "ñ"}).encode()) == {"a": "ñ"}
+
+
+def test_header_names_serializer_and_compression():
+    codec = Codec(compression="zlib", compress_threshold=64)
+    small, large = codec.encode("small"), codec.encode("large " * 100)
+    # below the threshold the value is plain JSON
+    assert small == b'"small"'
+    assert large[:2] == bytes((FORMAT_VERSION, SERIALIZERS["json"] | COMPRESSIONS["zlib"] << 4))
+    assert len(large) < 600
+    assert codec.frame(b'"small"') == small
+
+
+def test_msgpack_header():
+    pytest.importorskip("msgpack")
+    codec = Codec("msgpack")
+    assert codec.encode({"a": 1})[:2] == bytes((FORMAT_VERSION, SERIALIZERS["msgpack"]))
+
+
+def test_missing_libraries_and_unknown_formats():
+    with pytest.raises(ValueError):
+        Codec("pickle")
+    with pytest.raises(ValueError):
+        Codec(compression="lz4")
+    with pytest.raises(ValueError):
+        default_codec.decode(bytes((FORMAT_VERSION, 0x0F)) + b"{}")
+    with pytest.raises(ValueError):
+        default_codec.decode(bytes((FORMAT_VERSION, 0x70)) + b"{}")
+
+
+@pytest.mark.parametrize("codec", CODECS, ids=repr)
+def test_decode_many(codec):
+    values = [codec.encode(v) for v in VALUES]
+    assert codec.decode_many(values) == VALUES
+    # values written by other codecs and by json.dumps, one by one
+    mixed = [other.encode(v) for other in CODECS for v in VALUES] + [json.dumps(v).encode() for v in VALUES]
+    assert codec.decode_many(mixed) == VALUES * (len(CODECS) + 1)
+    assert codec.decode_many([]) == []
+    assert codec.decode_many(iter(values)) == VALUES
+
+
+def test_decode_many_raises_on_values_that_are_not_one_json_value():
+    with pytest.raises(ValueError):
+        default_codec.decode_many([b'1', b'2, 3'])
+
+
+def test_decode_fields():
+    codec = Codec(compression="zlib", compress_threshold=64)
+    fields = {f"key{i}".encode(): codec.encode(v) for i, v in enumerate(VALUES)}
+    assert codec.decode_fields(fields) == {f"key{i}": v for i, v in enumerate(VALUES)}
+    assert default_codec.decode_fields({}) == {}
+
+
+LEAD = ChatLead("123", "test", "tenant", "assistant")
+STATE = {"name": "Lola", "age": 3, "premium": False, "profile": {"city": "Rosario"}, "notes": "n" * 2000}
+
+
+@pytest.mark.parametrize("codec", CODECS, ids=repr)
+def test_state_providers_decode_the_store(redis_url, codec):
+    provider = RedisChatStateProvider(redis_url, codec=codec)
+    provider.set_store(LEAD, STATE)
+    assert provider.get_store(LEAD) == STATE
+    assert provider.get_values(LEAD, ["name", "missing", "profile"]) == {"name": "Lola", "profile": {"city": "Rosario"}}
+
+    async def main():
+        provider = AsyncRedisChatStateProvider(redis_url, codec=codec)
+        try:
+            return await provider.get_store(LEAD), await provider.get_values(LEAD, ["missing", "age", "notes"])
+        finally:
+            await redis_pools.aclose()
+
+    store, values = asyncio.run(main())
+    assert store == STATE
+    assert values == {"age": 3, "notes": STATE["notes"]}
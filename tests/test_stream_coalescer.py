@@ -0,0 +1,101 @@
+import asyncio
+import pytest
+from lolapy_lite_agent.agents.lola import LolaAgent
+from lolapy_lite_agent.chat_lead import ChatLead
+from lolapy_lite_agent.nlp_job import AgentJob
+from lolapy_lite_agent.openai_clients import openai_clients
+from lolapy_lite_agent.redis_pool import redis_pools
+from lolapy_lite_agent.stream_coalescer import PER_CHUNK, FlushPolicy, TextCoalescer
+from lolapy_lite_agent.testing import FakeOpenAIConfig, FakeOpenAIServer
+
+DELTAS = ["Hel", "lo", ", ", "the ", "price ", "of ", "bitcoin ", "is ", "68", "000 ", "€", "."]
+
+
+def test_per_chunk_delivers_every_delta():
+    coalescer = TextCoalescer()
+    assert coalescer.policy == PER_CHUNK
+    assert [coalescer.push(delta, i) for i, delta in enumerate(DELTAS)] == DELTAS
+    assert coalescer.due is None
+    assert coalescer.flush() is None
+
+
+def test_max_bytes_counts_utf8_bytes():
+    coalescer = TextCoalescer(FlushPolicy(max_bytes=4))
+    assert coalescer.push("ab", 0) is None
+    # "€" is 3 bytes
+    assert coalescer.push("€", 0) == "ab€"
+    assert coalescer.push("abcd", 0) == "abcd"
+    assert coalescer.push("a", 0) is None
+    assert coalescer.due is None
+    assert coalescer.flush() == "a"
+    assert coalescer.flush() is None
+
+
+def test_max_delay_counts_from_the_oldest_delta():
+    coalescer = TextCoalescer(FlushPolicy(max_delay=0.05))
+    assert coalescer.due is None
+    assert coalescer.push("a", 10.0) is None
+    assert coalescer.due == pytest.approx(10.05)
+    assert coalescer.push("b", 10.04) is None
+    # the delay runs from the first buffered delta, not the last one
+    assert coalescer.due == pytest.approx(10.05)
+    assert coalescer.push("c", 10.05) == "abc"
+    assert coalescer.due is None
+    assert coalescer.push("d", 10.06) is None
+    assert coalescer.due == pytest.approx(10.11)
+
+
+def test_first_limit_reached_wins():
+    coalescer = TextCoalescer(FlushPolicy(max_bytes=6, max_delay=1.0))
+    assert coalescer.push("abc", 0) is None
+    assert coalescer.push("def", 0.1) == "abcdef"
+    assert coalescer.push("g", 1.0) is None
+    assert coalescer.push("h", 2.0) == "gh"
+
+
+@pytest.mark.parametrize("policy", [PER_CHUNK, FlushPolicy(max_bytes=16), FlushPolicy(max_delay=0.05),
+                                    FlushPolicy(max_bytes=16, max_delay=0.05)])
+def test_delivered_pieces_join_into_the_text(policy):
+    coalescer = TextCoalescer(policy)
+    pieces = []
+    for i, delta in enumerate(DELTAS):
+        now = i * 0.02
+        due = coalescer.due
+        if due is not None and due <= now:
+            pieces.append(coalescer.flush())
+        pieces.append(coalescer.push(delta, now))
+    pieces.append(coalescer.flush())
+    pieces = [p for p in pieces if p]
+    assert "".join(pieces) == "".join(DELTAS)
+    if policy.max_bytes and not policy.max_delay:
+        assert all(len(p.encode()) >= policy.max_bytes for p in pieces[:-1])
+    if policy.enabled:
+        assert len(pieces) < len(DELTAS)
+
+
+@pytest.mark.parametrize("policy", [PER_CHUNK, FlushPolicy(max_bytes=24), FlushPolicy(max_delay=0.02)])
+def test_agent_stream_delivers_coalesced_text(redis_url, policy):
+    reply = "Sure, the current price of bitcoin is 68000 dollars, do you want the price of ether too?"
+    lead = ChatLead("123", "test", "tenant", "assistant")
+    job = AgentJob("job", lead, "Hello", prompt="You are Lola")
+    received = []
+
+    async def run():
+        server = await FakeOpenAIServer(FakeOpenAIConfig(ttft=0, token_delay=0.005, reply=reply)).start()
+        agent = LolaAgent(api_key="fake", redis_url=redis_url, base_url=server.url, flush_policy=policy,
+                          on_text_received=received.append)
+        try:
+            return [res["content"] async for res in agent.respond(job)]
+        finally:
+            await agent.aclose()
+            await openai_clients.aclose()
+            await server.close()
+            await redis_pools.aclose()
+
+    pieces = asyncio.run(run())
+    assert "".join(pieces) == reply
+    assert received == pieces
+    if policy.max_bytes and not policy.max_delay:
+        assert all(len(p.encode()) >= policy.max_bytes for p in pieces[:-1])
+    if policy.enabled:
+        assert len(pieces) < len(reply.split(" "))
@@ -0,0 +1,153 @@
+import asyncio
+import json
+import time
+import pytest
+from lolapy_lite_agent.agents.lola import LolaAgent
+from lolapy_lite_agent.chat_lead import ChatLead
+from lolapy_lite_agent.nlp_job import AgentJob
+from lolapy_lite_agent.openai_clients import openai_clients
+from lolapy_lite_agent.redis_pool import redis_pools
+from lolapy_lite_agent.testing import FakeOpenAIConfig, FakeOpenAIServer
+from lolapy_lite_agent.tool_calls import run_function_call, run_tool_calls
+
+LEAD = ChatLead("123", "test", "tenant", "assistant")
+
+PROMPT = """You are Lola
+<function name="get_price" description="Get the current cryptocurrency price">
+    <parameters type="object">
+        <param name="cryptocurrency" type="string" description="The cryptocurrency abbreviation eg. BTC, ETH"/>
+    </parameters>
+</function>
+"""
+
+
+def tool_call(id, name, arguments="{}"):
+    return {"id": id, "type": "function", "function": {"name": name, "arguments": arguments}}
+
+
+async def get_price(lead, name, arguments):
+    await asyncio.sleep(0.1)
+    return f"{json.loads(arguments)['cryptocurrency']} price is $50,000"
+
+
+def get_rate(lead, name, arguments):
+    # blocking handlers run in a worker thread
+    time.sleep(0.1)
+    return {"rate": 1.08}
+
+
+async def slow(lead, name, arguments):
+    await asyncio.sleep(5)
+
+
+def fail(lead, name, arguments):
+    raise ValueError("no quote")
+
+
+def handler(lead, name, arguments):
+    return {"get_price": get_price, "get_rate": get_rate, "slow": slow, "fail": fail}[name](lead, name, arguments)
+
+
+def test_tool_calls_run_concurrently_in_call_order():
+    calls = [tool_call("call_1", "get_price", '{"cryptocurrency": "BTC"}'), tool_call("call_2", "get_rate"),
+             tool_call("call_3", "get_price", '{"cryptocurrency": "ETH"}'), tool_call("call_4", "slow"),
+             tool_call("call_5", "fail")]
+
+    async def run():
+        start = time.perf_counter()
+        entries = await run_tool_calls(handler, LEAD, calls, timeout=0.3)
+        return entries, time.perf_counter() - start
+
+    entries, seconds = asyncio.run(run())
+    # the round takes the timeout, not the sum of the calls
+    assert seconds < 0.6
+    assert entries[0] == {"role": "assistant", "content": None, "tool_calls": calls}
+    assert [(e["role"], e["tool_call_id"], e["content"]) for e in entries[1:]] == [
+        ("tool", "call_1", "BTC price is $50,000"),
+        ("tool", "call_2", '{"rate": 1.08}'),
+        ("tool", "call_3", "ETH price is $50,000"),
+        ("tool", "call_4", "Error: function slow timed out"),
+        ("tool", "call_5", "Error: function fail failed: no quote"),
+    ]
+
+
+def test_function_call_without_handler():
+    entries = asyncio.run(run_function_call(None, LEAD, {"name": "get_price", "arguments": "{}"}))
+    assert entries[0]["function_call"] == {"name": "get_price", "arguments": "{}"}
+    assert entries[1]["role"] == "function"
+    assert entries[1]["content"] == "Error: function get_price is not available"
+
+
+class RoundsServer(FakeOpenAIServer):
+    """Answers with the configured calls until rounds rounds of them were answered, with the reply after"""
+
+    def __init__(self, config, rounds):
+        super().__init__(config)
+        self.rounds = rounds
+
+    def _calls(self, payload):
+        answered = sum(1 for m in payload.get("messages") or [] if m.get("role") == "tool")
+        if answered >= self.rounds * len(self.config.function_calls):
+            return None
+        return "tool_calls", self.config.function_calls
+
+
+def respond(redis_url, rounds, on_function_call, **kwargs):
+    job = AgentJob("job", LEAD, "BTC and ETH prices?", prompt=PROMPT)
+    config = FakeOpenAIConfig(ttft=0, token_delay=0, reply="Done", function_calls=[
+        {"name": "get_price", "arguments": '{"cryptocurrency": "BTC"}'},
+        {"name": "get_price", "arguments": '{"cryptocurrency": "ETH"}'},
+    ])
+
+    async def run():
+        server = await RoundsServer(config, rounds).start()
+        agent = LolaAgent(api_key="fake", redis_url=redis_url, base_url=server.url, tools=True)
+        try:
+            text = "".join([res["content"] async for res in agent.respond(job, on_function_call, **kwargs)])
+            return text, await agent._asyncHistoryStore.get_history(LEAD)
+        finally:
+            await agent.aclose()
+            await openai_clients.aclose()
+            await server.close()
+            await redis_pools.aclose()
+
+    return asyncio.run(run())
+
+
+def test_respond_answers_rounds_of_calls(redis_url):
+    calls = []
+
+    async def on_function_call(lead, name, arguments):
+        calls.append(arguments)
+        return await get_price(lead, name, arguments)
+
+    text, history = respond(redis_url, 3, on_function_call)
+    assert text == "Done"
+    assert calls == ['{"cryptocurrency": "BTC"}', '{"cryptocurrency": "ETH"}'] * 3
+    assert [m["role"] for m in history] == ["user"] + ["assistant", "tool", "tool"] * 3 + ["assistant"]
+    for i in range(1, 10, 3):
+        ids = [call["id"] for call in history[i]["tool_calls"]]
+        assert [m["tool_call_id"] for m in history[i + 1:i + 3]] == ids
+        assert [m["content"] for m in history[i + 1:i + 3]] == ["BTC price is $50,000", "ETH price is $50,000"]
+
+
+def test_respond_stops_after_max_rounds(redis_url):
+    calls = []
+
+    def on_function_call(lead, name, arguments):
+        calls.append(arguments)
+        return "price"
+
+    text, history = respond(redis_url, 10, on_function_call, max_rounds=2)
+    assert text == ""
+    # the calls of the third response aren't answered
+    assert len(calls) == 4
+    assert [m["role"] for m in history] == ["user"] + ["assistant", "tool", "tool"] * 2
+
+
+def test_respond_tool_timeout(redis_url):
+    start = time.perf_counter()
+    text, history = respond(redis_url, 1, slow, tool_timeout=0.1)
+    assert time.perf_counter() - start < 3
+    assert text == "Done"
+    assert [m["content"] for m in history if m["role"] == "tool"] == ["Error: function get_price timed out"] * 2